@@ -0,0 +1,20 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .revocation import revocation_cache
+
+
+class RevocableJWTAuthentication(JWTAuthentication):
+    """
+    `JWTAuthentication` that also rejects revoked tokens, checked against
+    the in-process `revocation_cache` rather than the database.
+    """
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if revocation_cache.is_stale():
+            revocation_cache.refresh()
+        if revocation_cache.is_revoked(token[api_settings.JTI_CLAIM]):
+            raise InvalidToken("Token is blacklisted")
+        return token
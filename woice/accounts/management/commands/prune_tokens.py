@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.revocation import delete_expired_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired outstanding and blacklisted tokens in bounded batches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.TOKEN_PRUNE_BATCH_SIZE,
+            help="Maximum number of tokens deleted per query",
+        )
+
+    def handle(self, *args, **options):
+        deleted = delete_expired_tokens(options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Deleted {deleted} expired token(s)")
+        )
@@ -0,0 +1,131 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+
+class RevocationCache:
+    """
+    Per-process set of revoked token ids, mirrored from the simplejwt
+    blacklist tables so that checking a token costs no query.
+
+    Callers refresh the set when `is_stale()`, from a thread and never
+    the event loop, which fetches the blacklist rows created since
+    `overlap` seconds before the previous refresh; tokens revoked in
+    this process are added immediately. Rows
+    are not committed in the order they are created, so the window
+    re-scans what earlier refreshes saw to catch a revocation committed
+    up to `overlap` seconds after it was stamped. Ids of expired tokens
+    are dropped, so the set only ever holds tokens that could still be
+    presented.
+    """
+
+    def __init__(self, interval, overlap):
+        self.interval = interval
+        self.overlap = timedelta(seconds=overlap)
+        self.revoked = {}
+        self.scanned = None
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return (
+            self.refreshed is None
+            or time.monotonic() - self.refreshed >= self.interval
+        )
+
+    def is_revoked(self, jti):
+        # Membership only: refreshing queries, and this is also called
+        # from the event loop.
+        return jti in self.revoked
+
+    def revoke(self, jti, expires):
+        with self.lock:
+            self.revoked[jti] = expires
+        return None
+
+    def refresh(self):
+        with self.lock:
+            now = timezone.now()
+            rows = BlacklistedToken.objects.filter(token__expires_at__gt=now)
+            if self.scanned is not None:
+                rows = rows.filter(
+                    blacklisted_at__gte=self.scanned - self.overlap
+                )
+            self.revoked.update(
+                rows.values_list("token__jti", "token__expires_at")
+            )
+            self.scanned = now
+
+            self.revoked = {
+                jti: expires
+                for jti, expires in self.revoked.items()
+                if expires > now
+            }
+            self.refreshed = time.monotonic()
+        return None
+
+
+def revoke_token(token, user):
+    """
+    Blacklist a validated access `token`, which simplejwt itself only does
+    for refresh tokens, and revoke it in this process right away.
+
+    Args:
+        token: The `AccessToken` to revoke
+        user: The user the token was issued to
+    """
+    jti = token[api_settings.JTI_CLAIM]
+    expires = datetime_from_epoch(token["exp"])
+    outstanding, _ = OutstandingToken.objects.get_or_create(
+        jti=jti,
+        defaults={
+            "user": user,
+            "token": str(token),
+            "created_at": token.current_time,
+            "expires_at": expires,
+        },
+    )
+    BlacklistedToken.objects.get_or_create(token=outstanding)
+    revocation_cache.revoke(jti, expires)
+    return None
+
+
+def delete_expired_tokens(batch_size, max_batches=None):
+    """
+    Delete outstanding tokens past their expiry, and with them their
+    blacklist entries, at most `batch_size` rows per query. Stops after
+    `max_batches` batches if given. Returns the number of tokens deleted.
+    """
+    deleted = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        queryset = OutstandingToken.objects.filter(
+            expires_at__lte=timezone.now()
+        )
+        ids = list(queryset.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            break
+
+        BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        count, _ = OutstandingToken.objects.filter(pk__in=ids).delete()
+        deleted += count
+        batches += 1
+        if len(ids) < batch_size:
+            break
+
+    return deleted
+
+
+revocation_cache = RevocationCache(
+    interval=settings.REVOCATION_REFRESH, overlap=settings.REVOCATION_OVERLAP
+)
@@ -1,3 +1,213 @@
-from django.test import TestCase
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from woice.auth_middleware import JWTAuthMiddleware, user_cache
+from woice.db import database_sync_to_async, pool
+from woice.query_budget import track
+
+from .revocation import RevocationCache, revocation_cache
+
+# Every test runs under `QueryBudgetTestRunner`, so a view going over its
+# query budget fails the test with `QueryBudgetExceeded`.
+
+PASSWORD = "correct-horse-battery"
+
+
+class AccountViewTests(APITestCase):
+    def setUp(self):
+        # Refresh revoked tokens on every request, the most a request can
+        # be charged for it.
+        patcher = mock.patch.object(revocation_cache, "interval", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = get_user_model().objects.create_user(
+            username="user", password=PASSWORD
+        )
+
+    def login(self):
+        response = self.client.post(
+            "/accounts/login/",
+            {"username": "user", "password": PASSWORD},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_register(self):
+        response = self.client.post(
+            "/accounts/register/",
+            {"username": "newcomer", "password": PASSWORD},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("password", response.data)
+        self.assertTrue(
+            get_user_model()
+            .objects.get(username="newcomer")
+            .has_usable_password()
+        )
+
+    def test_login(self):
+        tokens = self.login()
+        self.assertEqual(set(tokens), {"access", "refresh"})
+
+    def test_login_refresh(self):
+        tokens = self.login()
+        response = self.client.post(
+            "/accounts/login/refresh/",
+            {"refresh": tokens["refresh"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("access", response.data)
+
+    def test_logout(self):
+        tokens = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f"JWT {tokens['access']}")
+        response = self.client.post(
+            "/accounts/logout/", {"refresh": tokens["refresh"]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_205_RESET_CONTENT)
+
+        # Both tokens are revoked.
+        response = self.client.post(
+            "/accounts/logout/", {"refresh": tokens["refresh"]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(
+            "/accounts/login/refresh/",
+            {"refresh": tokens["refresh"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class RevocationCacheTests(TestCase):
+    def setUp(self):
+        self.cache = RevocationCache(interval=0, overlap=60)
+        self.user = get_user_model().objects.create_user(
+            username="user", password=PASSWORD
+        )
+
+    def blacklist(self, jti, age):
+        # As committed `age` seconds after it was stamped.
+        token = OutstandingToken.objects.create(
+            user=self.user,
+            jti=jti,
+            token=jti,
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+        blacklisted = BlacklistedToken.objects.create(token=token)
+        BlacklistedToken.objects.filter(pk=blacklisted.pk).update(
+            blacklisted_at=blacklisted.blacklisted_at - timedelta(seconds=age)
+        )
+        return None
+
+    def test_refresh_reads_revocations_committed_late(self):
+        self.cache.refresh()
+        self.blacklist("late", age=30)
+        self.cache.refresh()
+        self.assertTrue(self.cache.is_revoked("late"))
+
+    def test_refresh_drops_expired_tokens(self):
+        self.cache.revoke("expired", timezone.now() - timedelta(seconds=1))
+        self.cache.refresh()
+        self.assertFalse(self.cache.is_revoked("expired"))
+
+
+class JWTAuthMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        for target, attribute, value in [
+            # Users are looked up from the pool's threads, whose
+            # connections must not outlive the test database.
+            (pool, "max_age", 0),
+            # Fresh, so that checking a token costs no query.
+            (revocation_cache, "revoked", {}),
+            (revocation_cache, "scanned", None),
+            (revocation_cache, "refreshed", time.monotonic()),
+            (revocation_cache, "interval", 3600),
+        ]:
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(user_cache.clear)
+
+        self.user = get_user_model().objects.create_user(
+            username="user", password=PASSWORD
+        )
+        self.middleware = JWTAuthMiddleware(application=None)
+
+    def blacklist(self, token):
+        outstanding = OutstandingToken.objects.create(
+            user=self.user,
+            jti=token["jti"],
+            token=str(token),
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+        BlacklistedToken.objects.create(token=outstanding)
+        return None
+
+    async def test_valid_token(self):
+        user = await self.middleware.authenticate(
+            str(AccessToken.for_user(self.user))
+        )
+        self.assertEqual(user, self.user)
+
+    async def test_invalid_tokens(self):
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=-timedelta(seconds=1))
+        refresh = await database_sync_to_async(RefreshToken.for_user)(self.user)
+        for raw_token in [
+            "not-a-token",
+            str(expired),
+            # Refresh tokens can't stand in for access tokens.
+            str(refresh),
+        ]:
+            user = await self.middleware.authenticate(raw_token)
+            self.assertIsInstance(user, AnonymousUser)
+
+    async def test_user_is_cached(self):
+        token = str(AccessToken.for_user(self.user))
+        await self.middleware.authenticate(token)
+        with track("authenticate", 0):
+            user = await self.middleware.authenticate(token)
+        self.assertEqual(user, self.user)
+
+    async def test_inactive_user(self):
+        self.user.is_active = False
+        await database_sync_to_async(self.user.save)()
+        user = await self.middleware.authenticate(
+            str(AccessToken.for_user(self.user))
+        )
+        self.assertIsInstance(user, AnonymousUser)
+
+    async def test_stale_revocations_refreshed_off_the_loop(self):
+        token = AccessToken.for_user(self.user)
+        await database_sync_to_async(self.blacklist)(token)
+        revocation_cache.refreshed = None
+        # Raises `SynchronousOnlyOperation` if refreshed on the loop.
+        user = await self.middleware.authenticate(str(token))
+        self.assertIsInstance(user, AnonymousUser)
+        self.assertFalse(revocation_cache.is_stale())
+
+    async def test_revoked_token(self):
+        token = AccessToken.for_user(self.user)
+        revocation_cache.revoke(
+            token["jti"], timezone.now() + timedelta(hours=1)
+        )
+        user = await self.middleware.authenticate(str(token))
+        self.assertIsInstance(user, AnonymousUser)
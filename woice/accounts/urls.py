@@ -1,11 +1,10 @@
 from django.urls import path
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
-from .views import UserCreateView, LogoutView
+from .views import LoginRefreshView, LoginView, LogoutView, UserCreateView
 
 urlpatterns = [
     path("register/", UserCreateView.as_view(), name="register"),
-    path("login/", TokenObtainPairView.as_view(), name="login"),
-    path("login/refresh/", TokenRefreshView.as_view(), name="login-refresh"),
+    path("login/", LoginView.as_view(), name="login"),
+    path("login/refresh/", LoginRefreshView.as_view(), name="login-refresh"),
     path("logout/", LogoutView.as_view(), name="logout"),
 ]
@@ -5,24 +5,40 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from woice.query_budget import QueryBudgetMixin
 
+from .revocation import revoke_token
 from .serializers import UserSerializer
 
 
-class UserCreateView(CreateAPIView):
+class UserCreateView(QueryBudgetMixin, CreateAPIView):
     model = get_user_model()
     permission_classes = [AllowAny]
     serializer_class = UserSerializer
+    query_budget = 2
 
 
-class LogoutView(APIView):
+class LoginView(QueryBudgetMixin, TokenObtainPairView):
+    query_budget = 3
+
+
+class LoginRefreshView(QueryBudgetMixin, TokenRefreshView):
+    query_budget = 1
+
+
+class LogoutView(QueryBudgetMixin, APIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 10
 
     def post(self, request, *args, **kwargs):
         try:
             refresh = request.data["refresh"]
             token = RefreshToken(refresh)
             token.blacklist()
+            # The access token used for this request would otherwise stay
+            # valid until it expires.
+            revoke_token(request.auth, request.user)
 
             return Response(status=status.HTTP_205_RESET_CONTENT)
         except Exception as e:
@@ -1,25 +1,41 @@
 from django.contrib import admin
 
-from .models import ChatRoom, ChatRoomMember, ChatRoomMessage, InviteLink
+from .models import (
+    ChatRoom,
+    ChatRoomMember,
+    ChatRoomMessage,
+    InviteLink,
+    MessageArchive,
+)
 
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
     list_display = ["id", "name", "creator", "type", "created", "updated"]
     list_filter = ["creator", "type"]
+    list_select_related = ["creator"]
 
 
 @admin.register(ChatRoomMember)
 class ChatRoomMemberAdmin(admin.ModelAdmin):
     list_display = ["user", "chatroom", "is_admin"]
     list_filter = ["is_admin"]
+    list_select_related = ["user", "chatroom__creator"]
 
 
 @admin.register(InviteLink)
 class InviteLinkAdmin(admin.ModelAdmin):
     list_display = ["email", "chatroom", "expires", "has_expired"]
+    list_select_related = ["chatroom__creator"]
 
 
 @admin.register(ChatRoomMessage)
 class ChatRoomMessageAdmin(admin.ModelAdmin):
     list_display = ["user", "chatroom", "created", "updated", "edited"]
+    list_select_related = ["user", "chatroom__creator"]
+
+
+@admin.register(MessageArchive)
+class MessageArchiveAdmin(admin.ModelAdmin):
+    list_display = ["chatroom", "start", "end", "message_count", "path"]
+    list_select_related = ["chatroom__creator"]
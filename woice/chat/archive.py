@@ -0,0 +1,334 @@
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .cache import TTLCache
+from .models import ChatRoom, ChatRoomMember, ChatRoomMessage, MessageArchive
+from .partitions import TABLE, get_partitions, is_partitioned
+
+# Columns kept for each archived message, enough to rebuild the instances
+# `ChatRoomMessageSerializer` expects. Archives written before `seq` was
+# added rebuild messages with the default sequence number.
+FIELDS = ["id", "user_id", "message", "edited", "created", "updated", "seq"]
+CREATED = FIELDS.index("created")
+
+
+def write_archive(path, rows, chunk_size):
+    """
+    Write `rows`, lists of `FIELDS` values, to the gzipped JSON lines file
+    at `path`, as one gzip member per `chunk_size` rows so that they can be
+    read back separately. The file is written next to its final path and
+    renamed, so readers never see a partial archive.
+
+    Returns the index of the chunks: for each, its byte offset, the
+    `created` and id of its first row, and its smallest and largest ids.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.partial"
+    chunks = []
+    with open(partial, "wb") as file:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start : start + chunk_size]
+            ids = [row[0] for row in chunk]
+            chunks.append(
+                [
+                    file.tell(),
+                    str(chunk[0][CREATED]),
+                    ids[0],
+                    min(ids),
+                    max(ids),
+                ]
+            )
+            lines = "".join(
+                json.dumps(row, default=str) + "\n" for row in chunk
+            )
+            file.write(gzip.compress(lines.encode("utf-8")))
+    os.replace(partial, path)
+    return chunks
+
+
+def archive_partition(name, start, end):
+    """
+    Move the messages of partition `name` into one archive file per room,
+    then drop the partition. Rooms remember the latest change archived, as
+    clients that haven't seen it can no longer catch up on changes.
+    Tombstones aren't archived but moved to the default partition, where
+    they stay until `purge_tombstones` finds every reader past them. Must
+    run in a transaction. Returns `(rooms, messages)` archived.
+    """
+    quote = connection.ops.quote_name
+    archives = []
+
+    def flush(room, rows):
+        relative = os.path.join(name, f"{room}.jsonl.gz")
+        chunks = write_archive(
+            os.path.join(settings.MESSAGE_ARCHIVE_DIR, relative),
+            rows,
+            settings.MESSAGE_ARCHIVE_CHUNK_SIZE,
+        )
+        archives.append(
+            MessageArchive(
+                chatroom_id=room,
+                path=relative,
+                chunks=chunks,
+                start=start,
+                end=end,
+                first_id=min(row[0] for row in rows),
+                last_id=max(row[0] for row in rows),
+                message_count=len(rows),
+            )
+        )
+
+    # Streamed through a server-side cursor, holding one room at a time.
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(
+            f"SELECT chatroom_id, {', '.join(FIELDS)} FROM {quote(name)} "
+            "WHERE NOT deleted ORDER BY chatroom_id, created, id"
+        )
+        room, rows = None, []
+        for chatroom_id, *row in cursor:
+            if chatroom_id != room and rows:
+                flush(room, rows)
+                rows = []
+            room = chatroom_id
+            rows.append(row)
+        if rows:
+            flush(room, rows)
+
+    MessageArchive.objects.bulk_create(archives)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {quote(ChatRoom._meta.db_table)} room
+            SET archived_seq = GREATEST(room.archived_seq, archived.seq)
+            FROM (
+                SELECT chatroom_id, max(seq) AS seq FROM {quote(name)}
+                WHERE NOT deleted
+                GROUP BY chatroom_id
+            ) archived
+            WHERE room.id = archived.chatroom_id
+            """)
+        cursor.execute(
+            f"ALTER TABLE {quote(TABLE)} DETACH PARTITION {quote(name)}"
+        )
+        # No partition covers the month anymore.
+        cursor.execute(
+            f"INSERT INTO {quote(TABLE)} "
+            f"SELECT * FROM {quote(name)} WHERE deleted"
+        )
+        cursor.execute(f"DROP TABLE {quote(name)}")
+    return len(archives), sum(archive.message_count for archive in archives)
+
+
+def archive_messages(before, dry_run=False):
+    """
+    Archive every monthly message partition that ends at or before
+    `before`, oldest first, each in its own transaction. Returns a list of
+    `(partition, rooms, messages)`.
+    """
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return None
+        partitions = [
+            partition
+            for partition in get_partitions(cursor)
+            if partition[2] <= before
+        ]
+
+    archived = []
+    for name, start, end in partitions:
+        if dry_run:
+            archived.append((name, None, None))
+            continue
+        with transaction.atomic():
+            rooms, messages = archive_partition(name, start, end)
+        archived.append((name, rooms, messages))
+    return archived
+
+
+def purge_tombstones(before):
+    """
+    Delete the tombstones of messages created before `before`, kept when
+    their partition was archived, once every member of their room has
+    counted past them (see `chat.counters.deleted_since_counted`). Rooms
+    remember the latest change purged, like archived ones. Returns the
+    number of tombstones deleted.
+    """
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH purged AS (
+                DELETE FROM {quote(TABLE)} message
+                WHERE message.deleted
+                AND message.created < %s
+                AND NOT EXISTS (
+                    SELECT 1 FROM {quote(ChatRoomMember._meta.db_table)} member
+                    WHERE member.chatroom_id = message.chatroom_id
+                    AND member.counted_seq < message.seq
+                )
+                RETURNING message.chatroom_id, message.seq
+            ), rooms AS (
+                UPDATE {quote(ChatRoom._meta.db_table)} room
+                SET archived_seq = GREATEST(room.archived_seq, purged.seq)
+                FROM (
+                    SELECT chatroom_id, max(seq) AS seq FROM purged
+                    GROUP BY chatroom_id
+                ) purged
+                WHERE room.id = purged.chatroom_id
+            )
+            SELECT count(*) FROM purged
+            """,
+            [before],
+        )
+        (purged,) = cursor.fetchone()
+    return purged
+
+
+class ArchiveReader:
+    """
+    Reads archived messages back as unsaved `ChatRoomMessage` instances,
+    for history pages older than the messages still in the database.
+
+    Only the chunks of an archive holding the rows a page needs are read,
+    found from the index kept in `MessageArchive.chunks`; archives written
+    before it was added are read whole, as a single chunk. Archive files
+    never change once written, so parsed chunks are kept in a small
+    per-process cache.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.chunks = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def index(self, archive):
+        """
+        `(offset, end, first, min_id, max_id)` of each chunk of `archive`,
+        oldest first, where `first` is the `(created, id)` of its first row
+        and `end` is None for the last chunk. `first`, `min_id` and
+        `max_id` are None if unknown.
+        """
+        if archive.chunks is None:
+            return [(0, None, None, None, None)]
+        offsets = [chunk[0] for chunk in archive.chunks[1:]] + [None]
+        return [
+            (offset, end, (parse_datetime(created), first_id), min_id, max_id)
+            for (offset, created, first_id, min_id, max_id), end in zip(
+                archive.chunks, offsets
+            )
+        ]
+
+    def load(self, archive, offset, end):
+        """
+        Messages of the chunk of `archive` between byte `offset` and `end`,
+        as `(created, id, row)` tuples, oldest first.
+        """
+        key = (archive.path, offset)
+        messages = self.chunks.get(key)
+        if messages is None:
+            path = os.path.join(settings.MESSAGE_ARCHIVE_DIR, archive.path)
+            with open(path, "rb") as file:
+                file.seek(offset)
+                data = file.read() if end is None else file.read(end - offset)
+            # Archives written before chunking are a single gzip member.
+            lines = gzip.decompress(data).decode("utf-8").splitlines()
+            messages = []
+            for line in lines:
+                row = dict(zip(FIELDS, json.loads(line)))
+                row["created"] = parse_datetime(row["created"])
+                row["updated"] = parse_datetime(row["updated"])
+                messages.append((row["created"], row["id"], row))
+            self.chunks.set(key, messages)
+        return messages
+
+    def older(self, room, before, limit):
+        """
+        Up to `limit` archived messages of `room` older than `before`, a
+        `(created, id)` tuple or None for the newest ones, newest first.
+        """
+        archives = MessageArchive.objects.filter(chatroom_id=room)
+        if before is not None:
+            archives = archives.filter(start__lte=before[0])
+
+        messages = []
+        for archive in archives.order_by("-start"):
+            for offset, end, first, _, _ in reversed(self.index(archive)):
+                # Chunks starting at or after `before` hold none of it.
+                if before is not None and first is not None and first >= before:
+                    continue
+                rows = self.load(archive, offset, end)
+                messages += [
+                    row
+                    for created, message_id, row in reversed(rows)
+                    if before is None or (created, message_id) < before
+                ][: limit - len(messages)]
+                if len(messages) >= limit:
+                    return self.build(room, messages)
+        return self.build(room, messages)
+
+    def newer(self, room, after, limit):
+        """
+        Up to `limit` archived messages of `room` newer than `after`, a
+        `(created, id)` tuple, oldest first.
+        """
+        archives = MessageArchive.objects.filter(
+            chatroom_id=room, end__gt=after[0]
+        )
+
+        messages = []
+        for archive in archives.order_by("start"):
+            chunks = self.index(archive)
+            for position, (offset, end, _, _, _) in enumerate(chunks):
+                # Chunks followed by one starting at or before `after` hold
+                # none of the newer rows.
+                following = chunks[position + 1][2] if end is not None else None
+                if following is not None and following <= after:
+                    continue
+                rows = self.load(archive, offset, end)
+                messages += [
+                    row
+                    for created, message_id, row in rows
+                    if (created, message_id) > after
+                ][: limit - len(messages)]
+                if len(messages) >= limit:
+                    return self.build(room, messages)
+        return self.build(room, messages)
+
+    def locate(self, room, message_id):
+        """
+        `(created, id)` of the archived message `message_id` of `room`, or
+        None if it isn't archived.
+        """
+        archives = MessageArchive.objects.filter(
+            chatroom_id=room, first_id__lte=message_id, last_id__gte=message_id
+        )
+        for archive in archives:
+            for offset, end, _, min_id, max_id in self.index(archive):
+                if min_id is not None and not min_id <= message_id <= max_id:
+                    continue
+                for created, archived_id, row in self.load(
+                    archive, offset, end
+                ):
+                    if archived_id == message_id:
+                        return created, archived_id
+        return None
+
+    def build(self, room, rows):
+        users = get_user_model().objects.in_bulk(
+            {row["user_id"] for row in rows}
+        )
+        messages = []
+        for row in rows:
+            message = ChatRoomMessage(chatroom_id=room, **row)
+            message.user = users[row["user_id"]]
+            messages.append(message)
+        return messages
+
+
+archive_reader = ArchiveReader(
+    maxsize=settings.MESSAGE_ARCHIVE_CACHE_SIZE,
+    ttl=settings.MESSAGE_ARCHIVE_CACHE_TTL,
+)
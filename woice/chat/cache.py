@@ -0,0 +1,86 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded LRU mapping whose entries expire `ttl`
+    seconds after they are set. A `ttl` or `maxsize` of 0 disables the
+    cache, so every lookup misses.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                return default
+
+            if expires <= time.monotonic():
+                del self.data[key]
+                return default
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return None
+
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return None
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+        return None
+
+    def __len__(self):
+        return len(self.data)
+
+
+# Rooms by id and known memberships by (room id, user id), used by the
+# websocket handshake. Only positive membership is cached, so a fresh
+# invite or membership always takes effect immediately.
+room_cache = TTLCache(
+    maxsize=settings.HANDSHAKE_CACHE_SIZE, ttl=settings.HANDSHAKE_CACHE_TTL
+)
+membership_cache = TTLCache(
+    maxsize=settings.HANDSHAKE_CACHE_SIZE, ttl=settings.HANDSHAKE_CACHE_TTL
+)
+
+
+# Cached room directory responses are keyed by a version stored in the
+# shared cache, so a single write invalidates them in every process.
+DIRECTORY_VERSION_KEY = "chat:directory:version"
+
+
+def directory_cache_key(path):
+    version = cache.get_or_set(DIRECTORY_VERSION_KEY, uuid.uuid4().hex, None)
+    return f"chat:directory:{version}:{path}"
+
+
+def bump_directory_version():
+    cache.set(DIRECTORY_VERSION_KEY, uuid.uuid4().hex, None)
+    return None
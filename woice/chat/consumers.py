@@ -1,10 +1,20 @@
 import json
+import uuid
+from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from woice.db import database_sync_to_async
+from woice.query_budget import query_budget
 
+from .cache import membership_cache, room_cache
+from .counters import next_seq, record_delete
+from .eventlog import event_log, parse_event_id
+from .history import history_cache
 from .models import (
     ChatRoom,
     ChatRoomMember,
@@ -12,75 +22,110 @@ from .models import (
     InviteLink,
     RoomType,
 )
+from .persistence import MessageBufferFull, message_buffer
+from .presence import presence_tracker
+from .serializers import ChatRoomMessageSerializer
+from .shutdown import graceful_shutdown
+from .typing import typing_aggregator
+from .utils import encode_event
 
 
 class ChatRoomConsumer(AsyncWebsocketConsumer):
+    @query_budget(5)
     async def connect(self):
         self.user = self.scope["user"]
         self.room_id = self.scope["url_route"]["kwargs"]["pk"]
         self.room_group_name = self.room_id
+        self.chatroom = None
+        self.typists = {}
+        self.replayed = None
 
+        await self.accept()
+
+        if graceful_shutdown.draining:
+            await self.server_shutdown({})
+            return None
+
+        if not self.user.is_authenticated:
+            await self.send(
+                text_data=json.dumps({"message": "You must login to continue!"})
+            )
+            await self.close(code=4001)
+            return None
+
+        try:
+            self.chatroom, joined = await self.join_room(
+                self.room_id, self.user
+            )
+        except ObjectDoesNotExist:
+            await self.send(
+                text_data=json.dumps({"message": "Chatroom doesn't exist!"})
+            )
+            await self.close()
+            return None
+        except PermissionDenied:
+            await self.send(
+                text_data=json.dumps(
+                    {"message": "You need an invite to join this group!"}
+                )
+            )
+            await self.close(code=4001)
+            return None
+
+        # Only subscribe to the room once the socket is known to be allowed
+        # in, so rejected sockets never receive room traffic. Other members
+        # learn about the new socket from the next presence diff.
+        self.room_group_name = str(self.chatroom.pk)
         await self.channel_layer.group_add(
             self.room_group_name, self.channel_name
         )
+        presence_tracker.connect(self.room_group_name, self.user)
+        history_cache.subscribe(self.room_group_name)
+        graceful_shutdown.add(self)
 
-        if self.user.is_authenticated:
-            await self.accept()
-            try:
-                self.chatroom = await self.get_chatroom(self.room_id)
-            except ObjectDoesNotExist:
-                await self.send(
-                    text_data=json.dumps({"message": "Chatroom doesn't exist!"})
-                )
-                await self.close()
-
-            if self.chatroom.type == RoomType.PRIVATE:
-                invite = await self.verify_invite(self.chatroom, self.user)
-                if invite:
-                    invite = await self.get_invite(self.chatroom, self.user)
-                    await self.expire_invite(invite)
-                else:
-                    membership = await self.verify_membership(
-                        self.chatroom, self.user
-                    )
-                    if not membership:
-                        await self.send(
-                            text_data=json.dumps(
-                                {
-                                    "message": "You need an invite to join this group!"
-                                }
-                            )
-                        )
-                        await self.close(code=4001)
+        if not joined:
+            await self.send(text_data=json.dumps({"message": "Welcome back!"}))
 
-            try:
-                await self.add_member(self.chatroom, self.user)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
+        query = parse_qs(self.scope.get("query_string", b"").decode("utf8"))
+        if "last_event_id" in query:
+            await self.replay(query["last_event_id"][0])
+
+    async def replay(self, last_event_id):
+        # The socket joined the room group first, so events logged from now
+        # on arrive live too, and those already replayed are skipped then.
+        events = await event_log.replay(self.room_group_name, last_event_id)
+        if events is None:
+            await self.send(
+                text_data=json.dumps(
                     {
-                        "type": "join",
-                        "message": f"{self.user.username} joined",
-                    },
-                )
-            except IntegrityError:
-                await self.send(
-                    text_data=json.dumps({"message": "Welcome back!"})
+                        "type": "RESYNC",
+                        "message": "Missed events are gone, reload the "
+                        "messages!",
+                    }
                 )
-        else:
-            await self.accept()
-            await self.send(
-                text_data=json.dumps({"message": "You must login to continue!"})
             )
-            await self.close(code=4001)
+            return None
 
-    async def join(self, event):
-        await self.send(text_data=json.dumps({"message": event["message"]}))
+        for _, text in events:
+            await self.send(text_data=text)
+        self.replayed = parse_event_id(
+            events[-1][0] if events else last_event_id
+        )
 
+    @query_budget(0)
     async def disconnect(self, close_code):
+        graceful_shutdown.discard(self)
+        if self.chatroom is None:
+            return None
+
+        typing_aggregator.not_typing(self.room_group_name, self.channel_name)
+        presence_tracker.disconnect(self.room_group_name, self.user)
+        history_cache.unsubscribe(self.room_group_name)
         await self.channel_layer.group_discard(
             self.room_group_name, self.channel_name
         )
 
+    @query_budget(7)
     async def receive(self, text_data):
         data = json.loads(text_data)
         type = data.get("type")
@@ -89,169 +134,290 @@ class ChatRoomConsumer(AsyncWebsocketConsumer):
         message_id = data.get("message_id")
 
         if type == "NEW_MESSAGE":
-            new_message = await self.store_message(self.chatroom, self.user, message)
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            new_message = await self.persist_message(
+                self.chatroom, self.user, message
+            )
+            await self.broadcast(
+                "new_message",
                 {
-                    "type": "new_message",
+                    "type": "NEW_MESSAGE",
                     "message": message,
                     "username": username,
                     "message_id": new_message.id,
+                    # None until written, for messages in the write buffer.
+                    "seq": new_message.seq,
                 },
+                data=dict(ChatRoomMessageSerializer(new_message).data),
             )
         elif type == "EDIT_MESSAGE":
+            message_id = self.parse_message_id(message_id)
             if message_id:
+                await message_buffer.flush_message(message_id)
                 try:
-                    edited = await self.get_message(message_id)
+                    edited = await self.get_message(self.chatroom, message_id)
                 except ObjectDoesNotExist:
                     await self.send(
-                        text_data=json.dumps({"message": "Message doesn't exist!"})
+                        text_data=json.dumps(
+                            {"message": "Message doesn't exist!"}
+                        )
                     )
                     await self.close()
+                    return None
 
-                await self.replace_message(edited, message)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
+                seq = await self.replace_message(edited, message)
+                await self.broadcast(
+                    "edit_message",
                     {
-                        "type": "edit_message",
+                        "type": "EDIT_MESSAGE",
                         "message": message,
                         "username": username,
                         "message_id": message_id,
+                        "seq": seq,
                     },
+                    message_id=message_id,
+                    message=message,
+                    seq=seq,
                 )
         elif type == "DELETE_MESSAGE":
+            message_id = self.parse_message_id(message_id)
             if message_id:
-                print("In DELETE_MESSAGE: ", message_id)
+                await message_buffer.flush_message(message_id)
                 try:
-                    await self.delete_message(message_id)
+                    seq = await self.remove_message(self.chatroom, message_id)
                 except ObjectDoesNotExist:
                     await self.send(
-                        text_data=json.dumps({"message": "Message doesn't exist!"})
+                        text_data=json.dumps(
+                            {"message": "Message doesn't exist!"}
+                        )
                     )
                     await self.close()
+                    return None
 
-                await self.channel_layer.group_send(
-                    self.room_group_name,
+                await self.broadcast(
+                    "delete_message",
                     {
-                        "type": "delete_message",
+                        "type": "DELETE_MESSAGE",
                         "message": "Message deleted",
                         "username": username,
+                        "message_id": message_id,
+                        "seq": seq,
                     },
+                    message_id=message_id,
                 )
         elif type == "TYPING":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "typing",
-                    "message": message,
-                    "username": username,
-                },
+            typing_aggregator.typing(
+                self.room_group_name, self.channel_name, self.user.username
             )
         elif type == "NOT_TYPING":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "not_typing",
-                    "message": message,
-                    "username": username,
-                },
+            typing_aggregator.not_typing(
+                self.room_group_name, self.channel_name
             )
 
-    async def new_message(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "NEW_MESSAGE",
-                    "message": event["message"],
-                    "username": event["username"],
-                    "message_id": event["message_id"],
-                }
-            )
+    async def broadcast(self, handler, frame, **extra):
+        event_id = await event_log.append(self.room_group_name, frame)
+        if event_id is not None:
+            frame = {**frame, "event_id": event_id}
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            encode_event(handler, frame, event_id=event_id, **extra),
         )
 
+    async def forward(self, event):
+        # Room events carry their wire form, encoded once by the sender, so
+        # fanning out to every member costs no serialization here. These
+        # handlers run once per member and never query, so they carry no
+        # query budget either.
+        if self.is_replayed(event):
+            return None
+        await self.send(text_data=event["text"])
+
+    presence = forward
+
+    async def new_message(self, event):
+        history_cache.add(self.room_group_name, event["data"])
+        await self.forward(event)
+
     async def edit_message(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "EDIT_MESSAGE",
-                    "message": event["message"],
-                    "username": event["username"],
-                    "message_id": event["message_id"],
-                }
-            )
+        history_cache.edit(
+            self.room_group_name,
+            event["message_id"],
+            event["message"],
+            event["seq"],
         )
+        await self.forward(event)
 
     async def delete_message(self, event):
-        await self.send(
-            text_data=json.dumps(
+        history_cache.remove(self.room_group_name, event["message_id"])
+        await self.forward(event)
+
+    async def typing_state(self, event):
+        # Users don't need to be told that they themselves are typing, and
+        # a list that is unchanged once they are filtered out is skipped.
+        # Only typists pay for re-encoding a filtered list.
+        usernames = event["usernames"]
+        if self.user.username in usernames:
+            usernames = [
+                username
+                for username in usernames
+                if username != self.user.username
+            ]
+            text = json.dumps(
                 {
-                    "type": "DELETE_MESSAGE",
-                    "message": event["message"],
-                    "username": event["username"],
+                    "type": "TYPING",
+                    "source": event["source"],
+                    "usernames": usernames,
                 }
             )
-        )
+        else:
+            text = event["text"]
 
-    async def typing(self, event):
-        if self.user.username != event["username"]:
+        if self.typists.get(event["source"], []) == usernames:
+            return None
+
+        self.typists[event["source"]] = usernames
+        await self.send(text_data=text)
+
+    @query_budget(0)
+    async def server_shutdown(self, event):
+        # Sent by this process when it is about to exit. Clients reconnect
+        # to another worker with the `event_id` of the last event they got,
+        # to have the ones in between replayed. The socket counts as
+        # drained even if its client is already gone.
+        try:
             await self.send(
                 text_data=json.dumps(
-                    {"type": "TYPING", "message": event["message"]}
+                    {
+                        "type": "RECONNECT",
+                        "message": "Server is restarting, reconnect!",
+                    }
                 )
             )
+            await self.close(code=1012)
+        finally:
+            graceful_shutdown.discard(self)
 
-    async def not_typing(self, event):
-        if self.user.username != event["username"]:
-            await self.send(text_data=json.dumps({"type": "NOT_TYPING"}))
+    def is_replayed(self, event):
+        if self.replayed is None or event.get("event_id") is None:
+            return False
+        return parse_event_id(event["event_id"]) <= self.replayed
 
-    @database_sync_to_async
-    def get_chatroom(self, room_id):
-        return ChatRoom.objects.get(pk=room_id)
+    def parse_message_id(self, message_id):
+        try:
+            return int(message_id)
+        except (TypeError, ValueError):
+            return None
 
-    @database_sync_to_async
-    def add_member(self, chatroom, user):
-        return ChatRoomMember.objects.create(chatroom=chatroom, user=user)
+    async def persist_message(self, chatroom, user, message):
+        if settings.MESSAGE_PERSISTENCE == "batched":
+            try:
+                return await message_buffer.add(chatroom, user, message)
+            except MessageBufferFull:
+                # Written straight away instead, which holds this socket
+                # back to the pace of the database.
+                pass
+        return await self.store_message(chatroom, user, message)
 
     @database_sync_to_async
-    def get_invite(self, chatroom, user):
-        return InviteLink.objects.get(chatroom=chatroom, email=user.email)
+    def join_room(self, room_id, user):
+        """
+        Resolve the whole handshake in one round trip to the thread pool:
+        fetch the room together with the user's membership and pending
+        invite, then consume the invite and add the member if needed.
+        Returns `(chatroom, joined)`, where `joined` is False for
+        returning members.
 
-    @database_sync_to_async
-    def verify_invite(self, chatroom, user):
-        return InviteLink.objects.filter(
-            chatroom=chatroom, email=user.email, has_expired=False
-        ).exists()
+        Raises `ChatRoom.DoesNotExist` for unknown rooms and
+        `PermissionDenied` for private rooms without an invite.
+        """
+        try:
+            room_id = str(uuid.UUID(room_id))
+        except ValueError:
+            raise ChatRoom.DoesNotExist
 
-    @database_sync_to_async
-    def verify_membership(self, chatroom, user):
-        return ChatRoomMember.objects.filter(
-            chatroom=chatroom, user=user
-        ).exists()
+        chatroom = room_cache.get(room_id)
+        if chatroom is not None and membership_cache.get((room_id, user.pk)):
+            return chatroom, False
 
-    @database_sync_to_async
-    def expire_invite(self, invite):
-        invite.has_expired = True
-        invite.save(update_fields=["has_expired"])
-        return None
+        chatroom = ChatRoom.objects.annotate(
+            is_member=Exists(
+                ChatRoomMember.objects.filter(
+                    chatroom=OuterRef("pk"), user=user
+                )
+            ),
+            has_invite=Exists(
+                InviteLink.objects.filter(
+                    chatroom=OuterRef("pk"),
+                    email=user.email,
+                    expires__gt=timezone.now(),
+                    has_expired=False,
+                )
+            ),
+        ).get(pk=room_id)
+        room_cache.set(room_id, chatroom)
+
+        if (
+            chatroom.type == RoomType.PRIVATE
+            and not chatroom.is_member
+            and not chatroom.has_invite
+        ):
+            raise PermissionDenied
+
+        if chatroom.has_invite:
+            InviteLink.objects.filter(
+                chatroom=chatroom, email=user.email
+            ).update(has_expired=True)
+
+        joined = False
+        if not chatroom.is_member:
+            try:
+                ChatRoomMember.objects.create(chatroom=chatroom, user=user)
+                joined = True
+            except IntegrityError:
+                pass
+
+        membership_cache.set((room_id, user.pk), True)
+        return chatroom, joined
 
     @database_sync_to_async
     def store_message(self, chatroom, user, message):
-        return ChatRoomMessage.objects.create(
-            chatroom=chatroom, user=user, message=message
-        )
+        with transaction.atomic():
+            seq = next_seq(chatroom.pk)
+            return ChatRoomMessage.objects.create(
+                chatroom=chatroom,
+                user=user,
+                message=message,
+                seq=seq,
+                created_seq=seq,
+            )
 
     @database_sync_to_async
-    def get_message(self, message_id):
-        return ChatRoomMessage.objects.get(pk=message_id)
+    def get_message(self, chatroom, message_id):
+        return ChatRoomMessage.objects.get(
+            pk=message_id, chatroom=chatroom, deleted=False
+        )
 
     @database_sync_to_async
     def replace_message(self, instance, message):
-        instance.message = message
-        instance.edited = True
-        instance.save(update_fields=["message", "edited"])
-        return None
+        with transaction.atomic():
+            instance.message = message
+            instance.edited = True
+            instance.seq = next_seq(instance.chatroom_id)
+            instance.save(update_fields=["message", "edited", "seq"])
+        return instance.seq
 
     @database_sync_to_async
-    def delete_message(self, message_id):
-        print("In delete message: ", message_id)
-        return ChatRoomMessage.objects.get(pk=message_id).delete()
+    def remove_message(self, chatroom, message_id):
+        """
+        Replace message `message_id` with an empty tombstone, so clients
+        catching up on changes learn about the deletion. Returns its new
+        sequence number.
+        """
+        with transaction.atomic():
+            seq = next_seq(chatroom.pk)
+            deleted = ChatRoomMessage.objects.filter(
+                pk=message_id, chatroom=chatroom, deleted=False
+            ).update(message="", deleted=True, seq=seq)
+            if not deleted:
+                raise ChatRoomMessage.DoesNotExist
+            record_delete(ChatRoomMessage(pk=message_id, chatroom=chatroom))
+        return seq
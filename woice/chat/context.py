@@ -0,0 +1,41 @@
+import uuid
+
+from django.db.models import Exists, OuterRef
+
+from .models import ChatRoom, ChatRoomMember
+
+
+def get_room(request, pk):
+    """
+    Returns chatroom `pk`, annotated with whether the requesting user is a
+    member (`is_member`) and an admin (`is_admin`) of it, or None if it
+    doesn't exist. The room is loaded in one query the first time it is
+    asked for, and memoized on the request for permissions and views.
+    Args:
+        request: the current request
+        pk: id of the chatroom
+    """
+    rooms = request.__dict__.setdefault("_chat_rooms", {})
+    if pk not in rooms:
+        rooms[pk] = load_room(request.user, pk)
+    return rooms[pk]
+
+
+def load_room(user, pk):
+    try:
+        pk = uuid.UUID(str(pk))
+    except ValueError:
+        return None
+
+    membership = ChatRoomMember.objects.filter(
+        chatroom=OuterRef("pk"), user_id=user.pk
+    )
+    return (
+        ChatRoom.objects.select_related("creator")
+        .annotate(
+            is_member=Exists(membership),
+            is_admin=Exists(membership.filter(is_admin=True)),
+        )
+        .filter(pk=pk)
+        .first()
+    )
@@ -0,0 +1,328 @@
+from itertools import groupby
+from operator import attrgetter
+
+from django.db import connection, transaction
+from django.db.models import (
+    BigIntegerField,
+    Case,
+    CharField,
+    Count,
+    DateTimeField,
+    F,
+    IntegerField,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Greatest, Left
+
+from .cache import bump_directory_version
+from .models import (
+    LAST_MESSAGE_PREVIEW_LENGTH,
+    ChatRoom,
+    ChatRoomMember,
+    ChatRoomMessage,
+    MessageArchive,
+)
+
+# The denormalized counters and last-message fields of `ChatRoom` are
+# maintained here with single-row `F()` updates, so they never need a
+# read-modify-write and stay correct under concurrent writers. Counters
+# that drift anyway (e.g. rows changed with raw SQL) are repaired by
+# `manage.py recount_rooms`. Deleted messages are kept as tombstones (see
+# `ChatRoomMessage.seq`), and never counted.
+#
+# `F()` updates don't send `post_save`, so every helper changing fields the
+# room directory shows invalidates its cached responses itself, once the
+# change commits.
+
+
+def preview(text):
+    return text[:LAST_MESSAGE_PREVIEW_LENGTH]
+
+
+def aggregate(queryset, function):
+    """
+    Subquery computing `function` over `queryset`, which is filtered on an
+    outer reference, or 0 if it is empty.
+    """
+    return Coalesce(
+        Subquery(
+            queryset.order_by()
+            .values("chatroom")
+            .annotate(value=function)
+            .values("value"),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def next_seq(chatroom_id, count=1):
+    """
+    Allocate `count` sequence numbers for changes to the messages of room
+    `chatroom_id`, and return the last of them, or None if the room doesn't
+    exist. Must run in the transaction that stores the changes: the room
+    stays locked until it ends, so changes to a room commit in sequence
+    order, and a client that has seen a sequence number has seen every
+    change before it.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {connection.ops.quote_name(ChatRoom._meta.db_table)} "
+            "SET last_seq = last_seq + %s WHERE id = %s RETURNING last_seq",
+            [
+                count,
+                ChatRoom._meta.pk.get_db_prep_value(chatroom_id, connection),
+            ],
+        )
+        row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+def assign_seqs(messages):
+    """
+    Give every message in `messages`, not yet stored, a sequence number of
+    its room, in order. Must run in the transaction that stores them.
+    """
+    key = attrgetter("chatroom_id")
+    for chatroom_id, stored in groupby(sorted(messages, key=key), key):
+        stored = list(stored)
+        last = next_seq(chatroom_id, len(stored))
+        for offset, message in enumerate(reversed(stored)):
+            message.seq = None if last is None else last - offset
+            message.created_seq = message.seq
+    return None
+
+
+def record_members(chatroom_id, delta):
+    ChatRoom.objects.filter(pk=chatroom_id).update(
+        member_count=Greatest(F("member_count") + delta, 0)
+    )
+    transaction.on_commit(bump_directory_version)
+    return None
+
+
+def record_messages(messages):
+    """
+    Count newly stored messages, and make the newest of each room its last
+    message unless a newer one has already been recorded.
+
+    Args:
+        messages: The stored `ChatRoomMessage` instances
+    """
+    key = attrgetter("chatroom_id")
+    for chatroom_id, stored in groupby(sorted(messages, key=key), key):
+        stored = list(stored)
+        last = max(stored, key=attrgetter("created", "id"))
+        is_newer = Q(last_message_at__isnull=True) | Q(
+            last_message_at__lte=last.created
+        )
+        ChatRoom.objects.filter(pk=chatroom_id).update(
+            message_count=F("message_count") + len(stored),
+            last_message_id=Case(
+                When(is_newer, then=Value(last.id, BigIntegerField())),
+                default=F("last_message_id"),
+            ),
+            last_message_at=Case(
+                When(is_newer, then=Value(last.created, DateTimeField())),
+                default=F("last_message_at"),
+            ),
+            last_message_preview=Case(
+                When(is_newer, then=Value(preview(last.message), CharField())),
+                default=F("last_message_preview"),
+            ),
+        )
+    transaction.on_commit(bump_directory_version)
+    return None
+
+
+def record_edit(message):
+    updated = ChatRoom.objects.filter(
+        pk=message.chatroom_id, last_message_id=message.id
+    ).update(last_message_preview=preview(message.message))
+    if updated:
+        transaction.on_commit(bump_directory_version)
+    return None
+
+
+def record_delete(message):
+    ChatRoom.objects.filter(pk=message.chatroom_id).update(
+        message_count=Greatest(F("message_count") - 1, 0)
+    )
+
+    # Only the deletion of the last message needs the next one looked up.
+    # Read counts are left alone: see `deleted_since_counted`.
+    ChatRoom.objects.filter(
+        pk=message.chatroom_id, last_message_id=message.id
+    ).update(**last_message_fields())
+    transaction.on_commit(bump_directory_version)
+    return None
+
+
+def deleted_since_counted():
+    """
+    Subquery counting, for the `ChatRoomMember` it is evaluated on, the
+    messages its `read_count` includes that have been deleted since it was
+    counted. Deleting a message then costs no write per member.
+    """
+    return aggregate(
+        ChatRoomMessage.objects.filter(
+            chatroom_id=OuterRef("chatroom_id"),
+            deleted=True,
+            seq__gt=OuterRef("counted_seq"),
+            created_seq__lte=OuterRef("last_read_seq"),
+        ),
+        Count("pk"),
+    )
+
+
+def unread_count():
+    """
+    Expression for the unread count of the `ChatRoomMember` it is
+    evaluated on, from the counters of the member and its room.
+    """
+    return Greatest(
+        F("chatroom__message_count")
+        - F("read_count")
+        + deleted_since_counted(),
+        0,
+    )
+
+
+def mark_read(members):
+    """
+    Move the read pointer of every member in `members` to the last message
+    of their room, as when they join it.
+    """
+    room = ChatRoom.objects.filter(pk=OuterRef("chatroom_id"))
+    return members.update(
+        last_read_id=Subquery(room.values("last_message_id")),
+        last_read_seq=Subquery(room.values("last_seq")),
+        read_count=Subquery(room.values("message_count")),
+        counted_seq=Subquery(room.values("last_seq")),
+    )
+
+
+def record_read(chatroom_id, user_id, message_id, pending=False):
+    """
+    Move a member's read pointer forward to message `message_id` of the
+    room, counting the messages passed and those deleted since the last
+    count, in a single UPDATE. Returns False if the pointer was already at
+    or past it, or if the room has no such message.
+
+    Messages still `pending` in a write buffer have no sequence number yet,
+    so reading one moves the pointer to the last stored message instead.
+    """
+    stored = ChatRoomMessage.objects.filter(chatroom_id=chatroom_id)
+    room = ChatRoom.objects.filter(pk=chatroom_id)
+    target = Subquery(stored.filter(pk=message_id).values("pk"))
+    if pending:
+        target = Coalesce(
+            target,
+            Subquery(room.values("last_message_id")),
+            output_field=BigIntegerField(),
+        )
+    seq = Subquery(stored.filter(pk=target).values("created_seq"))
+    passed = stored.filter(
+        deleted=False,
+        created_seq__gt=OuterRef("last_read_seq"),
+        created_seq__lte=seq,
+    )
+    updated = ChatRoomMember.objects.filter(
+        chatroom_id=chatroom_id, user_id=user_id, last_read_seq__lt=seq
+    ).update(
+        last_read_id=target,
+        last_read_seq=seq,
+        read_count=Greatest(F("read_count") - deleted_since_counted(), 0)
+        + aggregate(passed, Count("pk")),
+        counted_seq=Subquery(room.values("last_seq")),
+    )
+    return updated > 0
+
+
+def last_message_fields():
+    latest = ChatRoomMessage.objects.filter(
+        chatroom_id=OuterRef("pk"), deleted=False
+    ).order_by("-created", "-id")
+    return {
+        "last_message_id": Subquery(latest.values("id")[:1]),
+        "last_message_at": Subquery(latest.values("created")[:1]),
+        "last_message_preview": Coalesce(
+            Left(
+                Subquery(latest.values("message")[:1]),
+                LAST_MESSAGE_PREVIEW_LENGTH,
+            ),
+            Value(""),
+        ),
+    }
+
+
+def recount(queryset):
+    """
+    Recompute the counters and last message of every room in `queryset`
+    from scratch, in one UPDATE. Archived messages still count, tombstones
+    don't. Returns the number of rooms updated.
+    """
+    updated = queryset.update(
+        member_count=aggregate(
+            ChatRoomMember.objects.filter(chatroom_id=OuterRef("pk")),
+            Count("pk"),
+        ),
+        message_count=aggregate(
+            ChatRoomMessage.objects.filter(
+                chatroom_id=OuterRef("pk"), deleted=False
+            ),
+            Count("pk"),
+        )
+        + aggregate(
+            MessageArchive.objects.filter(chatroom_id=OuterRef("pk")),
+            Sum("message_count"),
+        ),
+        # Sequence numbers are never reused, so this only ever catches up.
+        last_seq=Greatest(
+            F("last_seq"),
+            aggregate(
+                ChatRoomMessage.objects.filter(chatroom_id=OuterRef("pk")),
+                Max("seq"),
+            ),
+        ),
+        **last_message_fields(),
+    )
+    transaction.on_commit(bump_directory_version)
+    return updated
+
+
+def recount_reads(members):
+    """
+    Recompute the read count of every member in `members` from its read
+    pointer, in one UPDATE. Returns the number of members updated.
+    """
+    return members.update(
+        read_count=aggregate(
+            ChatRoomMessage.objects.filter(
+                chatroom_id=OuterRef("chatroom_id"),
+                created_seq__lte=OuterRef("last_read_seq"),
+                deleted=False,
+            ),
+            Count("pk"),
+        )
+        # Archives span whole months, much longer than ids can be out of
+        # commit order, so they are compared by id.
+        + aggregate(
+            MessageArchive.objects.filter(
+                chatroom_id=OuterRef("chatroom_id"),
+                last_id__lte=OuterRef("last_read_id"),
+            ),
+            Sum("message_count"),
+        ),
+        counted_seq=Subquery(
+            ChatRoom.objects.filter(pk=OuterRef("chatroom_id")).values(
+                "last_seq"
+            )
+        ),
+    )
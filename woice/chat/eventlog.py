@@ -0,0 +1,177 @@
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def parse_event_id(event_id):
+    """
+    `(milliseconds, sequence)` of an event id, as assigned by Redis streams,
+    or None if `event_id` isn't one.
+    """
+    try:
+        milliseconds, sequence = str(event_id).split("-")
+        return int(milliseconds), int(sequence)
+    except ValueError:
+        return None
+
+
+class MemoryEventLogStore:
+    """
+    Single-process stand-in for `RedisEventLogStore`, assigning event ids of
+    the same form.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # Least recently appended to first, so idle rooms are dropped from
+        # the front.
+        self.rooms = OrderedDict()
+        self.last_id = (0, 0)
+
+    async def append(self, room, text):
+        now = time.time()
+        milliseconds, sequence = self.last_id
+        self.last_id = max((int(now * 1000), 0), (milliseconds, sequence + 1))
+        event_id = "%d-%d" % self.last_id
+
+        events = self.rooms.get(room)
+        if events is None:
+            events = self.rooms[room] = deque(maxlen=self.size)
+        events.append((event_id, text, now + self.ttl))
+        self.rooms.move_to_end(room)
+
+        while self.rooms:
+            oldest = next(iter(self.rooms.values()))
+            if oldest[-1][2] > now:
+                break
+            self.rooms.popitem(last=False)
+        return event_id
+
+    async def range(self, room, start):
+        begin = parse_event_id(start)
+        return [
+            (event_id, text)
+            for event_id, text, _ in self.rooms.get(room, ())
+            if parse_event_id(event_id) >= begin
+        ]
+
+
+class RedisEventLogStore:
+    """
+    Events kept in the channel layer's Redis, as one stream per room capped
+    at about `size` entries, which expires once the room has been quiet for
+    `ttl` seconds.
+    """
+
+    key_prefix = "events:"
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+
+    def connection(self, key):
+        layer = get_channel_layer()
+        return layer.connection(layer.consistent_hash(key))
+
+    async def append(self, room, text):
+        key = self.key_prefix + room
+        async with self.connection(key) as connection:
+            pipeline = connection.pipeline()
+            event_id = pipeline.xadd(key, {"text": text}, max_len=self.size)
+            pipeline.expire(key, int(self.ttl) + 1)
+            await pipeline.execute()
+        return (await event_id).decode("utf8")
+
+    async def range(self, room, start):
+        key = self.key_prefix + room
+        async with self.connection(key) as connection:
+            events = await connection.xrange(key, start=start)
+        return [
+            (event_id.decode("utf8"), fields[b"text"].decode("utf8"))
+            for event_id, fields in events
+        ]
+
+
+class EventLog:
+    """
+    Bounded, time-limited log of the message events of each room, so that
+    sockets reconnecting within `ttl` seconds and `size` events get the
+    ones they missed replayed instead of reloading the messages.
+
+    Every logged event is broadcast with its `event_id`. Ids grow with
+    every event of a room, and a replay starts after the last one the
+    client saw, which must still be in the log: otherwise events may have
+    been dropped, and the client has to resync.
+    """
+
+    def __init__(self, store, size, ttl):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+
+    async def append(self, room, frame):
+        """
+        Log `frame` for `room` and return its event id, or None if the log
+        is disabled or unavailable. Events are broadcast either way.
+        """
+        if self.size <= 0:
+            return None
+        try:
+            return await self.store.append(room, json.dumps(frame))
+        except Exception:
+            logger.exception("Failed to log event for %s", room)
+            return None
+
+    async def replay(self, room, last_event_id):
+        """
+        `(event_id, text)` of the events of `room` after `last_event_id`,
+        oldest first, with their event ids, or None if some of them may no
+        longer be in the log.
+        """
+        after = parse_event_id(last_event_id)
+        if (
+            self.size <= 0
+            or after is None
+            or after[0] < (time.time() - self.ttl) * 1000
+        ):
+            return None
+
+        last_event_id = "%d-%d" % after
+        try:
+            events = await self.store.range(room, last_event_id)
+        except Exception:
+            logger.exception("Failed to read events of %s", room)
+            return None
+        if not events or events[0][0] != last_event_id:
+            return None
+
+        replayed = []
+        for event_id, text in events[1:]:
+            frame = json.loads(text)
+            frame["event_id"] = event_id
+            replayed.append((event_id, json.dumps(frame)))
+        return replayed
+
+
+def get_event_log_store():
+    if settings.EVENT_LOG_BACKEND == "memory":
+        return MemoryEventLogStore(
+            size=settings.EVENT_LOG_SIZE, ttl=settings.EVENT_LOG_TTL
+        )
+    return RedisEventLogStore(
+        size=settings.EVENT_LOG_SIZE, ttl=settings.EVENT_LOG_TTL
+    )
+
+
+event_log = EventLog(
+    store=get_event_log_store(),
+    size=settings.EVENT_LOG_SIZE,
+    ttl=settings.EVENT_LOG_TTL,
+)
@@ -0,0 +1,211 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+
+class RoomHistory:
+    def __init__(self, messages, complete):
+        # Serialized messages, newest first.
+        self.messages = messages
+        # Sequence number of each cached message, by id.
+        self.seqs = {message["id"]: message.get("seq") for message in messages}
+        # True when `messages` holds every message in the room.
+        self.complete = complete
+
+
+class RoomHistoryCache:
+    """
+    Per-process cache of the newest `size` serialized messages of each
+    room, so the first page of `MessageListView` can be served without a
+    query.
+
+    Only rooms with a consumer connected to this process are cached: those
+    consumers receive every room event, and keep the cache current from
+    the new, edit and delete broadcasts. At most `max_rooms` rooms are kept,
+    evicting the least recently used. Every mutation bumps a per-room
+    version so that a page read from the database concurrently is never
+    cached over a newer update.
+
+    Messages from a write buffer, in this process or another, are broadcast
+    before they are written, without a `seq`. A page read in between misses
+    them, so a room isn't filled until every such message broadcast to it
+    shows up in a page read, is deleted, or `unflushed_ttl` seconds have
+    passed.
+    """
+
+    def __init__(self, size, max_rooms, unflushed_ttl=60):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.unflushed_ttl = unflushed_ttl
+        self.rooms = OrderedDict()
+        self.versions = Counter()
+        # Per room, expiry of each message broadcast before it was written.
+        self.unflushed = {}
+        self.subscribers = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, room):
+        with self.lock:
+            self.subscribers[room] += 1
+        return None
+
+    def unsubscribe(self, room):
+        with self.lock:
+            self.subscribers[room] -= 1
+            if self.subscribers[room] <= 0:
+                del self.subscribers[room]
+                self.rooms.pop(room, None)
+                self.versions.pop(room, None)
+                self.unflushed.pop(room, None)
+        return None
+
+    def version(self, room):
+        with self.lock:
+            return self.versions[room]
+
+    def get(self, room, count):
+        """
+        Return `(messages, has_more)` for the newest `count` messages of
+        `room`, or None if they aren't cached.
+        """
+        with self.lock:
+            history = self.rooms.get(room)
+            if history is None or (
+                len(history.messages) < count and not history.complete
+            ):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.rooms.move_to_end(room)
+            return (
+                history.messages[:count],
+                len(history.messages) > count or not history.complete,
+            )
+
+    def fill(self, room, messages, complete, version):
+        with self.lock:
+            if (
+                self.size <= 0
+                or room not in self.subscribers
+                or self.versions[room] != version
+                or self.is_unsettled(room, messages)
+            ):
+                return None
+
+            self.rooms[room] = RoomHistory(
+                list(messages[: self.size]),
+                complete and len(messages) <= self.size,
+            )
+            self.rooms.move_to_end(room)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        return None
+
+    def add(self, room, message):
+        with self.lock:
+            self.touch(room)
+            if message.get("seq") is None and room in self.subscribers:
+                self.unflushed.setdefault(room, {})[message["id"]] = (
+                    time.monotonic() + self.unflushed_ttl
+                )
+
+            history = self.rooms.get(room)
+            if history is None or message["id"] in history.seqs:
+                return None
+
+            history.messages.insert(0, message)
+            history.seqs[message["id"]] = message.get("seq")
+            if len(history.messages) > self.size:
+                dropped = history.messages.pop()
+                del history.seqs[dropped["id"]]
+                history.complete = False
+        return None
+
+    def edit(self, room, message_id, text, seq):
+        with self.lock:
+            self.touch(room)
+            history = self.rooms.get(room)
+            if history is None or message_id not in history.seqs:
+                return None
+            # Every socket of the room delivers the same edit, and only the
+            # first one needs to find the message.
+            if seq is not None and history.seqs[message_id] == seq:
+                return None
+
+            history.seqs[message_id] = seq
+            for index, message in enumerate(history.messages):
+                if message["id"] == message_id:
+                    history.messages[index] = {
+                        **message,
+                        "message": text,
+                        "edited": True,
+                        "seq": seq,
+                    }
+                    break
+        return None
+
+    def remove(self, room, message_id):
+        with self.lock:
+            self.touch(room)
+            self.unflushed.get(room, {}).pop(message_id, None)
+            history = self.rooms.get(room)
+            if history is None or message_id not in history.seqs:
+                return None
+
+            if history.complete:
+                history.messages = [
+                    message
+                    for message in history.messages
+                    if message["id"] != message_id
+                ]
+                del history.seqs[message_id]
+            else:
+                # The next message down isn't cached, so refill instead.
+                del self.rooms[room]
+        return None
+
+    def is_unsettled(self, room, messages):
+        """
+        Whether messages broadcast to `room` before they were written may
+        be missing from `messages`, read from the database. Called with the
+        lock held.
+        """
+        unflushed = self.unflushed.get(room)
+        if not unflushed:
+            return False
+
+        now = time.monotonic()
+        read = {message["id"] for message in messages}
+        for message_id, expires in list(unflushed.items()):
+            if message_id in read or expires <= now:
+                del unflushed[message_id]
+        if not unflushed:
+            del self.unflushed[room]
+            return False
+        return True
+
+    def touch(self, room):
+        # Called with the lock held on every mutation, cached or not, so a
+        # page read from the database before it is never cached after it.
+        if room in self.subscribers:
+            self.versions[room] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "rooms": len(self.rooms),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+history_cache = RoomHistoryCache(
+    size=settings.HISTORY_CACHE_SIZE, max_rooms=settings.HISTORY_CACHE_ROOMS
+)
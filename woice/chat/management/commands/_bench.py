@@ -0,0 +1,105 @@
+import json
+import platform
+import threading
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+def percentile(timings, q):
+    """
+    Nearest-rank percentile of `timings`, which must be sorted.
+    Args:
+        timings: sorted list of numbers
+        q: percentile, between 0 and 100
+    """
+    if not timings:
+        return None
+    index = max(0, min(len(timings) - 1, round(q / 100 * len(timings)) - 1))
+    return timings[index]
+
+
+def summarize(timings):
+    """
+    Summary of a list of durations, in seconds, as milliseconds.
+    """
+    timings = sorted(timings)
+    if not timings:
+        return {"count": 0}
+    return {
+        "count": len(timings),
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "max_ms": timings[-1] * 1000,
+    }
+
+
+class QueryCounter:
+    """
+    Counts queries run on every database connection, including those
+    opened later by the thread pool behind `database_sync_to_async`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+        connection_created.connect(self.on_connection_created)
+        return None
+
+    def uninstall(self):
+        connection_created.disconnect(self.on_connection_created)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+        return None
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def save_results(path, results):
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        **results,
+    }
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+    return None
+
+
+def compare(stdout, baseline_path, results, metrics):
+    """
+    Write the change of each of `metrics` from the baseline run saved at
+    `baseline_path`.
+    Args:
+        stdout: the command's output stream
+        baseline_path: JSON file written by an earlier run
+        results: the results of this run
+        metrics: `(section, key)` pairs to compare
+    """
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    stdout.write(f"Compared to {baseline_path}:")
+    for section, key in metrics:
+        before = baseline.get(section, {}).get(key)
+        after = results.get(section, {}).get(key)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        stdout.write(
+            f"{section:>16} {key:<16} {before:10.3f} -> {after:10.3f} "
+            f"({change:+.1f}%)"
+        )
+    return None
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from chat.archive import archive_messages, purge_tombstones
+from chat.partitions import add_months, month_start
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the monthly message partitions older than a number of months "
+        "into compressed per-room archive files, and drop them along with "
+        "the tombstones every member has counted"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--after",
+            type=int,
+            default=settings.MESSAGE_ARCHIVE_AFTER,
+            help="Archive partitions that ended this many months ago or more",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List the partitions that would be archived",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Archiving requires PostgreSQL")
+
+        before = add_months(month_start(timezone.now()), -options["after"])
+        archived = archive_messages(before, dry_run=options["dry_run"])
+        if archived is None:
+            raise CommandError(
+                "Messages aren't partitioned, see `manage.py partition_messages`"
+            )
+
+        for name, rooms, messages in archived:
+            if options["dry_run"]:
+                self.stdout.write(f"Would archive {name}")
+            else:
+                self.stdout.write(
+                    f"Archived {messages} message(s) of {rooms} room(s) "
+                    f"from {name}"
+                )
+        self.stdout.write(
+            self.style.SUCCESS(f"Archived {len(archived)} partition(s)")
+        )
+
+        if not options["dry_run"]:
+            purged = purge_tombstones(before)
+            self.stdout.write(
+                self.style.SUCCESS(f"Purged {purged} archived tombstone(s)")
+            )
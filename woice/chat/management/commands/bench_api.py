@@ -0,0 +1,241 @@
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat.models import ChatRoom, ChatRoomMessage, InviteLink, RoomType
+from chat.views import (
+    ChatRoomViewSet,
+    MemberSearchView,
+    MessageChangesView,
+    MessageListView,
+)
+
+from ._bench import compare, save_results, summarize
+
+ENDPOINTS = [
+    "history",
+    "history_page",
+    "changes",
+    "member_search",
+    "room_list",
+    "room_list_cached",
+    "my_rooms",
+    "invite",
+]
+
+INVITE_PREFIX = "bench-invite-"
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the message history and changes, member search, room list, my "
+        "rooms and invite endpoints against the largest rooms and the "
+        "busiest user in the database, recording latencies and query counts"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=100)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--endpoints",
+            nargs="+",
+            choices=ENDPOINTS,
+            default=ENDPOINTS,
+            help="Endpoints to time (all by default)",
+        )
+        parser.add_argument("--output", help="Save the results as JSON")
+        parser.add_argument(
+            "--baseline", help="JSON results of an earlier run to compare to"
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        public = (
+            ChatRoom.objects.filter(type=RoomType.PUBLIC)
+            .select_related("creator")
+            .order_by("-message_count")
+            .first()
+        )
+        private = (
+            ChatRoom.objects.filter(type=RoomType.PRIVATE)
+            .select_related("creator")
+            .order_by("-member_count")
+            .first()
+        )
+        if public is None or private is None:
+            raise CommandError(
+                "Needs at least one public and one private room; "
+                "see `manage.py generate_dataset`"
+            )
+        self.stdout.write(
+            f"Public room {public.pk}: {public.member_count} members, "
+            f"{public.message_count} messages"
+        )
+        self.stdout.write(
+            f"Private room {private.pk}: {private.member_count} members"
+        )
+        busiest = (
+            get_user_model()
+            .objects.annotate(rooms=Count("chatroommember"))
+            .order_by("-rooms")
+            .first()
+        )
+        self.stdout.write(f"User {busiest.username}: {busiest.rooms} rooms")
+
+        message_ids = list(
+            ChatRoomMessage.objects.filter(chatroom=public)
+            .order_by("?")
+            .values_list("pk", flat=True)[: options["requests"]]
+        )
+        usernames = list(
+            public.chatroom_member.values_list("user__username", flat=True)
+        )
+        # Room list pages that exist, up to the fifth.
+        pages = min(
+            5,
+            max(
+                1,
+                ChatRoom.objects.exclude(type=RoomType.PRIVATE).count()
+                // settings.REST_FRAMEWORK["PAGE_SIZE"],
+            ),
+        )
+        factory = APIRequestFactory()
+        viewset = ChatRoomViewSet.as_view({"get": "list"})
+        invite = ChatRoomViewSet.as_view({"post": "invite"})
+        mine = ChatRoomViewSet.as_view({"get": "mine"})
+
+        def history(i):
+            return MessageListView.as_view(), factory.get("/"), public.pk
+
+        def history_page(i):
+            before = message_ids[i % len(message_ids)]
+            return (
+                MessageListView.as_view(),
+                factory.get("/", {"before": before}),
+                public.pk,
+            )
+
+        def changes(i):
+            # A client catching up on the last page of changes.
+            since = max(
+                public.last_seq - settings.REST_FRAMEWORK["PAGE_SIZE"], 0
+            )
+            return (
+                MessageChangesView.as_view(),
+                factory.get("/", {"since": since}),
+                public.pk,
+            )
+
+        def member_search(i):
+            username = rng.choice(usernames)
+            term = username[: rng.randint(1, len(username))]
+            return (
+                MemberSearchView.as_view(),
+                factory.get("/", {"q": term}),
+                public.pk,
+            )
+
+        def room_list(i):
+            cache.clear()
+            return viewset, factory.get("/", {"page": i % pages + 1}), None
+
+        def room_list_cached(i):
+            return viewset, factory.get("/", {"page": i % pages + 1}), None
+
+        def my_rooms(i):
+            return mine, factory.get("/"), None
+
+        def send_invite(i):
+            recipients = [
+                f"{INVITE_PREFIX}{time.time_ns()}-{n}@example.com"
+                for n in range(5)
+            ]
+            request = factory.post(
+                "/", {"recipients": recipients}, format="json"
+            )
+            return invite, request, private.pk
+
+        endpoints = {
+            "history": (history, public.creator),
+            "history_page": (history_page, public.creator),
+            "changes": (changes, public.creator),
+            "member_search": (member_search, public.creator),
+            "room_list": (room_list, public.creator),
+            "room_list_cached": (room_list_cached, public.creator),
+            "my_rooms": (my_rooms, busiest),
+            "invite": (send_invite, private.creator),
+        }
+
+        results = {}
+        try:
+            with override_settings(
+                EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+            ):
+                for name in options["endpoints"]:
+                    build, user = endpoints[name]
+                    results[name] = self.measure(
+                        build, user, options["requests"]
+                    )
+                    self.stdout.write(
+                        f"{name:>17}: {self.format(results[name])}"
+                    )
+        finally:
+            # Invites are sent for real, so the dataset stays as it was.
+            InviteLink.objects.filter(
+                chatroom=private, email__startswith=INVITE_PREFIX
+            ).delete()
+
+        results["config"] = {"requests": options["requests"]}
+        if options["output"]:
+            save_results(options["output"], results)
+            self.stdout.write(f"Saved results to {options['output']}")
+        if options["baseline"]:
+            compare(
+                self.stdout,
+                options["baseline"],
+                results,
+                [
+                    (name, key)
+                    for name in options["endpoints"]
+                    for key in ["p50_ms", "p99_ms", "queries_per_request"]
+                ],
+            )
+
+    def measure(self, build, user, requests):
+        timings = []
+        queries = 0
+        for i in range(requests):
+            view, request, pk = build(i)
+            force_authenticate(request, user=user)
+            kwargs = {} if pk is None else {"pk": str(pk)}
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = view(request, **kwargs)
+                response.render()
+                timings.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise CommandError(
+                    f"{request.path} returned {response.status_code}: "
+                    f"{response.data}"
+                )
+            queries += len(captured)
+
+        return {
+            **summarize(timings),
+            "queries_per_request": queries / requests if requests else 0,
+        }
+
+    def format(self, stats):
+        return (
+            f"p50 {stats['p50_ms']:8.2f} ms, p99 {stats['p99_ms']:8.2f} ms, "
+            f"{stats['queries_per_request']:.2f} queries/request"
+        )
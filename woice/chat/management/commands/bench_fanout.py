@@ -0,0 +1,163 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatRoomConsumer
+from chat.history import history_cache
+from chat.utils import encode_event
+
+ROOM = "bench"
+
+# Consumer handler of each room event, and the type of its frame.
+EVENTS = {
+    "new_message": "NEW_MESSAGE",
+    "edit_message": "EDIT_MESSAGE",
+    "delete_message": "DELETE_MESSAGE",
+}
+
+
+class Recipient(ChatRoomConsumer):
+    """
+    Consumer whose socket is a no-op, so only the handler's own work is
+    measured.
+    """
+
+    def __init__(self, username, room):
+        super().__init__()
+        # What `connect` sets up for a socket that joined `room`.
+        self.user = SimpleNamespace(username=username)
+        self.room_group_name = room
+        self.typists = {}
+        self.replayed = None
+        self.sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.sent += 1
+
+
+def frame(handler, message_id, message):
+    return {
+        "type": EVENTS[handler],
+        "message": message,
+        "username": "sender",
+        "message_id": message_id,
+        "seq": message_id,
+    }
+
+
+async def legacy_handler(consumer, event):
+    # The handlers as they were before events carried their wire form: the
+    # frame is rebuilt and encoded for every recipient.
+    await consumer.send(
+        text_data=json.dumps(
+            {
+                "type": EVENTS[event["type"]],
+                "message": event["message"],
+                "username": event["username"],
+                "message_id": event["message_id"],
+                "seq": event["seq"],
+            }
+        )
+    )
+
+
+def legacy_event(handler, message_id, message):
+    return {**frame(handler, message_id, message), "type": handler}
+
+
+def encoded_event(handler, message_id, message):
+    # As broadcast by `ChatRoomConsumer.receive`.
+    extra = {"event_id": None}
+    if handler == "new_message":
+        extra["data"] = {
+            "id": message_id,
+            "user": {"id": 1, "username": "sender"},
+            "message": message,
+            "edited": False,
+            "deleted": False,
+            "seq": message_id,
+        }
+    elif handler == "edit_message":
+        extra.update(message_id=message_id, message=message, seq=message_id)
+    else:
+        extra["message_id"] = message_id
+    return encode_event(handler, frame(handler, message_id, message), **extra)
+
+
+async def handle_event(consumer, event):
+    await getattr(consumer, event["type"])(event)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure CPU spent fanning room message events (new, edit, delete) "
+        "out to every member, with per-recipient encoding versus the "
+        "consumer's serialize-once handlers"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=5000)
+        parser.add_argument("--messages", type=int, default=50)
+        parser.add_argument("--message-size", type=int, default=200)
+
+    def handle(self, *args, **options):
+        recipients = [
+            Recipient(f"user{i}", ROOM) for i in range(options["recipients"])
+        ]
+        # Rooms with sockets connected are in the history cache, which the
+        # handlers keep current.
+        history_cache.subscribe(ROOM)
+        history_cache.fill(ROOM, [], True, history_cache.version(ROOM))
+
+        message = "x" * options["message_size"]
+        runs = [
+            ("per-recipient", legacy_event, legacy_handler),
+            ("serialize-once", encoded_event, handle_event),
+        ]
+
+        self.stdout.write(
+            f"{options['recipients']} recipients, "
+            f"{options['messages']} messages of {len(message)} chars"
+        )
+        for handler in EVENTS:
+            results = {}
+            for name, build_event, handle in runs:
+                cpu = asyncio.run(
+                    self.fan_out(
+                        recipients,
+                        handler,
+                        build_event,
+                        handle,
+                        options["messages"],
+                        message,
+                    )
+                )
+                per_message = cpu / options["messages"]
+                results[name] = per_message
+                self.stdout.write(
+                    f"{handler:>14} {name:>15}: "
+                    f"{per_message * 1000:8.3f} ms CPU per message, "
+                    f"{per_message / len(recipients) * 1e6:6.2f} us per "
+                    "delivery"
+                )
+
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{handler:>14} speedup: "
+                    f"{results['per-recipient'] / results['serialize-once']:.1f}x"
+                )
+            )
+        history_cache.unsubscribe(ROOM)
+
+    async def fan_out(
+        self, recipients, handler, build_event, handle, messages, text
+    ):
+        start = time.process_time()
+        for message_id in range(messages):
+            event = build_event(handler, message_id, text)
+            for recipient in recipients:
+                await handle(recipient, event)
+        return time.process_time() - start
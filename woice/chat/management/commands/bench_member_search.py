@@ -0,0 +1,166 @@
+import random
+import string
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat.counters import record_members
+from chat.models import ChatRoom, ChatRoomMember
+from chat.views import MemberSearchView
+
+from ._bench import compare, save_results, summarize
+
+ROOM_NAME = "bench-member-search"
+
+
+def random_username(rng):
+    length = rng.randint(6, 14)
+    return "".join(
+        rng.choices(string.ascii_lowercase + string.digits, k=length)
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure MemberSearchView latency against a room with many members, "
+        "creating the room on first use, and check its p99 against a target"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=100000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--target-p99-ms",
+            type=float,
+            default=20.0,
+            help="Fail if the p99 latency is over this many milliseconds",
+        )
+        parser.add_argument("--output", help="Save the results as JSON")
+        parser.add_argument(
+            "--baseline", help="JSON results of an earlier run to compare to"
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print the query plans of the prefix and trigram lookups",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        chatroom = self.get_room(options, rng)
+        usernames = list(
+            ChatRoomMember.objects.filter(chatroom=chatroom).values_list(
+                "user__username", flat=True
+            )
+        )
+        self.stdout.write(f"{len(usernames)} members in {chatroom.pk}")
+
+        # Mix of the terms an autocomplete box sends: short and long
+        # prefixes of real names, and misspelt fragments.
+        terms = []
+        for _ in range(options["queries"]):
+            username = rng.choice(usernames)
+            kind = rng.random()
+            if kind < 0.4:
+                terms.append(username[: rng.randint(1, 3)])
+            elif kind < 0.8:
+                terms.append(username[: rng.randint(4, len(username))])
+            else:
+                fragment = list(username[1:])
+                fragment[0], fragment[1] = fragment[1], fragment[0]
+                terms.append("".join(fragment))
+
+        if options["explain"]:
+            self.explain(chatroom, terms[0])
+
+        factory = APIRequestFactory()
+        view = MemberSearchView.as_view()
+        timings = []
+        for term in terms:
+            request = factory.get("/", {"q": term})
+            force_authenticate(request, user=chatroom.creator)
+            start = time.perf_counter()
+            response = view(request, pk=str(chatroom.pk))
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.data
+
+        stats = summarize(timings)
+        self.stdout.write(
+            f"{stats['count']} searches: "
+            f"p50 {stats['p50_ms']:.2f} ms, "
+            f"p99 {stats['p99_ms']:.2f} ms, "
+            f"max {stats['max_ms']:.2f} ms"
+        )
+
+        results = {
+            "member_search": stats,
+            "config": {
+                "members": len(usernames),
+                "queries": options["queries"],
+                "target_p99_ms": options["target_p99_ms"],
+            },
+        }
+        if options["output"]:
+            save_results(options["output"], results)
+            self.stdout.write(f"Saved results to {options['output']}")
+        if options["baseline"]:
+            compare(
+                self.stdout,
+                options["baseline"],
+                results,
+                [("member_search", key) for key in ["p50_ms", "p99_ms"]],
+            )
+
+        if stats["p99_ms"] > options["target_p99_ms"]:
+            raise CommandError(
+                f"p99 of {stats['p99_ms']:.2f} ms is over the "
+                f"{options['target_p99_ms']:g} ms target"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"p99 is within the {options['target_p99_ms']:g} ms target"
+            )
+        )
+
+    def get_room(self, options, rng):
+        chatroom = ChatRoom.objects.filter(name=ROOM_NAME).first()
+        if chatroom is not None:
+            return chatroom
+
+        self.stdout.write(f"Creating a room with {options['members']} members")
+        creator = User.objects.create_user(
+            username=f"bench-{random_username(rng)}",
+            email="bench@example.com",
+        )
+        chatroom = ChatRoom.objects.create(name=ROOM_NAME, creator=creator)
+
+        created = 0
+        while created < options["members"]:
+            count = min(options["batch_size"], options["members"] - created)
+            users = User.objects.bulk_create(
+                [
+                    User(username=f"{random_username(rng)}{created + i}")
+                    for i in range(count)
+                ]
+            )
+            ChatRoomMember.objects.bulk_create(
+                [ChatRoomMember(chatroom=chatroom, user=user) for user in users]
+            )
+            record_members(chatroom.pk, len(users))
+            created += count
+        return chatroom
+
+    def explain(self, chatroom, term):
+        members = ChatRoomMember.objects.filter(chatroom=chatroom)
+        lookups = [
+            ("prefix", members.filter(user__username__istartswith=term)),
+            ("trigram", members.filter(user__username__trigram_similar=term)),
+        ]
+        for name, queryset in lookups:
+            self.stdout.write(f"{name} ({term!r}):")
+            self.stdout.write(queryset.explain(analyze=True))
+        return None
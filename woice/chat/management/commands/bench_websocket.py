@@ -0,0 +1,298 @@
+import asyncio
+import json
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chat.eventlog import MemoryEventLogStore, event_log
+from chat.models import ChatRoom, ChatRoomMember
+from chat.presence import MemoryPresenceStore, presence_tracker
+from chat.routing import websocket_urlpatterns
+
+from ._bench import QueryCounter, compare, save_results, summarize
+
+ROOM_NAME = "bench-websocket"
+
+IN_MEMORY_LAYER = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+
+
+class Client:
+    def __init__(self, user, communicator):
+        self.user = user
+        self.communicator = communicator
+
+    async def send(self, frame):
+        await self.communicator.send_to(text_data=json.dumps(frame))
+
+    async def wait_for(self, type, timeout, key="type"):
+        """
+        Returns the time at which the next frame whose `key` is `type`
+        arrived, skipping other traffic such as presence updates.
+        """
+        while True:
+            frame = json.loads(
+                await self.communicator.receive_from(timeout=timeout)
+            )
+            if frame.get(key) == type:
+                return time.perf_counter(), frame
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive many simulated clients against ChatRoomConsumer and report "
+        "connect rate, delivery latency and queries per event"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=100)
+        parser.add_argument("--events", type=int, default=50)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=20,
+            help="Number of clients connecting at the same time",
+        )
+        parser.add_argument(
+            "--layer",
+            choices=["memory", "default"],
+            default="memory",
+            help="Use an in-memory channel layer, or CHANNEL_LAYERS",
+        )
+        parser.add_argument(
+            "--persistence",
+            choices=["sync", "batched"],
+            help="Override MESSAGE_PERSISTENCE",
+        )
+        parser.add_argument("--timeout", type=float, default=10)
+        parser.add_argument("--output", help="Save the results as JSON")
+        parser.add_argument(
+            "--baseline", help="JSON results of an earlier run to compare to"
+        )
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options["layer"] == "memory":
+            overrides["CHANNEL_LAYERS"] = IN_MEMORY_LAYER
+            # The Redis presence and event log stores live in the channel
+            # layer's Redis.
+            presence_tracker.store = MemoryPresenceStore()
+            event_log.store = MemoryEventLogStore(
+                size=settings.EVENT_LOG_SIZE, ttl=settings.EVENT_LOG_TTL
+            )
+        if options["persistence"]:
+            overrides["MESSAGE_PERSISTENCE"] = options["persistence"]
+
+        users, chatroom = self.get_users_and_room(options["clients"])
+        counter = QueryCounter()
+        counter.install()
+
+        try:
+            with override_settings(**overrides):
+                results = asyncio.run(
+                    self.run(users, chatroom, counter, options)
+                )
+        finally:
+            counter.uninstall()
+        results["config"] = {
+            key: options[key]
+            for key in ["clients", "events", "concurrency", "layer"]
+        }
+        results["config"]["persistence"] = options["persistence"]
+
+        for section, stats in results.items():
+            if section != "config":
+                self.stdout.write(f"{section:>13}: {self.format(stats)}")
+
+        if options["output"]:
+            save_results(options["output"], results)
+            self.stdout.write(f"Saved results to {options['output']}")
+        if options["baseline"]:
+            compare(
+                self.stdout,
+                options["baseline"],
+                results,
+                [
+                    (section, key)
+                    for section in [
+                        "connect",
+                        "NEW_MESSAGE",
+                        "EDIT_MESSAGE",
+                        "TYPING",
+                    ]
+                    for key in ["p50_ms", "p99_ms", "queries_per_event"]
+                ]
+                + [("connect", "per_second")],
+            )
+
+    def get_users_and_room(self, count):
+        User = get_user_model()
+        users = [
+            User.objects.get_or_create(
+                username=f"bench-ws-{i}",
+                defaults={"email": f"bench-ws-{i}@example.com"},
+            )[0]
+            for i in range(count)
+        ]
+        chatroom, _ = ChatRoom.objects.get_or_create(
+            name=ROOM_NAME, creator=users[0]
+        )
+        # Everyone connects as a returning member, as in a reconnect storm.
+        for user in users:
+            ChatRoomMember.objects.get_or_create(chatroom=chatroom, user=user)
+        return users, chatroom
+
+    async def run(self, users, chatroom, counter, options):
+        app = URLRouter(websocket_urlpatterns)
+        timeout = options["timeout"]
+        results = {}
+
+        clients = []
+        timings = []
+        queries = counter.count
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(options["concurrency"])
+
+        async def connect(user):
+            async with semaphore:
+                communicator = WebsocketCommunicator(
+                    app, f"/ws/chat/{chatroom.pk}/"
+                )
+                communicator.scope["user"] = user
+                client = Client(user, communicator)
+                began = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=timeout)
+                assert connected, f"{user.username} couldn't connect"
+                # The socket is accepted before the room is resolved, and
+                # returning members are welcomed once that is done.
+                received, _ = await client.wait_for(
+                    "Welcome back!", timeout, key="message"
+                )
+                timings.append(received - began)
+                clients.append(client)
+
+        await asyncio.gather(*(connect(user) for user in users))
+        elapsed = time.perf_counter() - start
+        results["connect"] = {
+            **summarize(timings),
+            "per_second": len(users) / elapsed,
+            "queries_per_event": (counter.count - queries) / len(users),
+        }
+
+        try:
+            message_ids = []
+            results["NEW_MESSAGE"] = await self.measure(
+                clients,
+                counter,
+                options["events"],
+                lambda i: {
+                    "type": "NEW_MESSAGE",
+                    "message": f"Benchmark message {i}",
+                    "username": clients[i % len(clients)].user.username,
+                },
+                "NEW_MESSAGE",
+                timeout,
+                on_delivered=lambda frame: message_ids.append(
+                    frame["message_id"]
+                ),
+            )
+            results["EDIT_MESSAGE"] = await self.measure(
+                clients,
+                counter,
+                options["events"],
+                lambda i: {
+                    "type": "EDIT_MESSAGE",
+                    "message": f"Edited benchmark message {i}",
+                    "username": clients[i % len(clients)].user.username,
+                    "message_id": message_ids[i % len(message_ids)],
+                },
+                "EDIT_MESSAGE",
+                timeout,
+            )
+            results["TYPING"] = await self.measure(
+                clients,
+                counter,
+                options["events"],
+                lambda i: {"type": "TYPING"},
+                "TYPING",
+                timeout,
+                skip_sender=True,
+                reset={"type": "NOT_TYPING"},
+            )
+        finally:
+            for client in clients:
+                await client.communicator.disconnect()
+
+        return results
+
+    async def measure(
+        self,
+        clients,
+        counter,
+        events,
+        build_frame,
+        type,
+        timeout,
+        on_delivered=None,
+        skip_sender=False,
+        reset=None,
+    ):
+        """
+        Send `events` frames, one at a time and from each client in turn,
+        and time their delivery to every recipient.
+        """
+        timings = []
+        queries = 0
+        for i in range(events):
+            sender = clients[i % len(clients)]
+            recipients = [
+                client
+                for client in clients
+                if not (skip_sender and client is sender)
+            ]
+
+            before = counter.count
+            sent = time.perf_counter()
+            waiters = [
+                asyncio.ensure_future(client.wait_for(type, timeout))
+                for client in recipients
+            ]
+            await sender.send(build_frame(i))
+            delivered = await asyncio.gather(*waiters)
+            queries += counter.count - before
+
+            timings += [received - sent for received, _ in delivered]
+            if on_delivered is not None:
+                on_delivered(delivered[0][1])
+
+            if reset is not None:
+                # Wait for the cleared state too, so that the next event
+                # starts from the same point.
+                waiters = [
+                    asyncio.ensure_future(client.wait_for(type, timeout))
+                    for client in recipients
+                ]
+                await sender.send(reset)
+                await asyncio.gather(*waiters)
+
+        return {
+            **summarize(timings),
+            "queries_per_event": queries / events if events else 0,
+        }
+
+    def format(self, stats):
+        if not stats.get("count"):
+            return "no samples"
+        text = (
+            f"p50 {stats['p50_ms']:8.2f} ms, p99 {stats['p99_ms']:8.2f} ms, "
+            f"{stats['queries_per_event']:.2f} queries/event"
+        )
+        if "per_second" in stats:
+            text += f", {stats['per_second']:.1f} connects/s"
+        return text
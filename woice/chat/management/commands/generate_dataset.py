@@ -0,0 +1,303 @@
+import csv
+import io
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chat.counters import mark_read, recount
+from chat.models import (
+    ChatRoom,
+    ChatRoomMember,
+    ChatRoomMessage,
+    InviteLink,
+    RoomType,
+)
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog hello world meeting today "
+    "tomorrow lunch release deploy review ticket merge branch coffee call "
+    "thanks please sure great idea later done working on it yes no maybe"
+).split()
+
+
+def insert(model, fields, rows, batch_size):
+    """
+    Bulk insert `rows`, tuples of values for `fields`, with `COPY` on
+    Postgres and `bulk_create` elsewhere. Signals are not sent, and model
+    defaults are not applied, so every non-null column must be given.
+    Args:
+        model: model class of the rows
+        fields: names of the fields given for each row
+        rows: iterable of tuples, consumed in batches of `batch_size`
+        batch_size: rows per `COPY` or `bulk_create`
+    """
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        batch = [row for _, row in zip(range(batch_size), rows)]
+        if not batch:
+            return inserted
+
+        if connection.vendor == "postgresql":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                [[r"\N" if v is None else v for v in row] for row in batch]
+            )
+            buffer.seek(0)
+            columns = ", ".join(
+                connection.ops.quote_name(model._meta.get_field(f).column)
+                for f in fields
+            )
+            with connection.cursor() as cursor:
+                cursor.cursor.copy_expert(
+                    f"COPY {connection.ops.quote_name(model._meta.db_table)} "
+                    f"({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                    buffer,
+                )
+        else:
+            attnames = [model._meta.get_field(f).attname for f in fields]
+            model.objects.bulk_create(
+                [model(**dict(zip(attnames, row))) for row in batch]
+            )
+        inserted += len(batch)
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-generate users, rooms with skewed sizes, members, invites and "
+        "messages for local performance work"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--rooms", type=int, default=1000)
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--invites", type=int, default=10000)
+        parser.add_argument(
+            "--private",
+            type=float,
+            default=0.2,
+            help="Fraction of rooms that are private",
+        )
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=1.2,
+            help="Pareto shape of room sizes; smaller is more skewed",
+        )
+        parser.add_argument("--min-members", type=int, default=2)
+        parser.add_argument("--days", type=int, default=90)
+        parser.add_argument("--batch-size", type=int, default=50000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--prefix",
+            default="gen",
+            help="Prefix of generated usernames and room names, which must "
+            "not be in use yet",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        batch_size = options["batch_size"]
+        prefix = options["prefix"]
+        User = get_user_model()
+        now = timezone.now()
+        start = time.perf_counter()
+
+        with transaction.atomic():
+            self.step("users")
+            insert(
+                User,
+                [
+                    "username",
+                    "email",
+                    "password",
+                    "first_name",
+                    "last_name",
+                    "is_active",
+                    "is_staff",
+                    "is_superuser",
+                    "date_joined",
+                ],
+                (
+                    (
+                        f"{prefix}{i}",
+                        f"{prefix}{i}@example.com",
+                        "!",
+                        "",
+                        "",
+                        True,
+                        False,
+                        False,
+                        now,
+                    )
+                    for i in range(options["users"])
+                ),
+                batch_size,
+            )
+            user_ids = list(
+                User.objects.filter(
+                    username__regex=rf"^{re.escape(prefix)}[0-9]+$"
+                ).values_list("pk", flat=True)
+            )
+
+            # Room sizes follow a Pareto distribution: most rooms are small
+            # and a few hold a large share of all users.
+            self.step("rooms and members")
+            rooms = []
+            for i in range(options["rooms"]):
+                size = min(
+                    len(user_ids),
+                    int(rng.paretovariate(options["skew"]))
+                    * options["min_members"],
+                )
+                room_members = rng.sample(user_ids, size)
+                private = rng.random() < options["private"]
+                rooms.append(
+                    (
+                        uuid.uuid4(),
+                        f"{prefix}-room-{i}",
+                        room_members[0],
+                        RoomType.PRIVATE if private else RoomType.PUBLIC,
+                        now,
+                        now,
+                        room_members,
+                    )
+                )
+            insert(
+                ChatRoom,
+                [
+                    "id",
+                    "name",
+                    "creator",
+                    "type",
+                    "created",
+                    "updated",
+                    "member_count",
+                    "message_count",
+                    "last_message_preview",
+                    "last_seq",
+                    "archived_seq",
+                ],
+                # Counters are filled in by `recount` once messages exist.
+                (room[:6] + (0, 0, "", 0, 0) for room in rooms),
+                batch_size,
+            )
+            insert(
+                ChatRoomMember,
+                [
+                    "chatroom",
+                    "user",
+                    "is_admin",
+                    "last_read_seq",
+                    "read_count",
+                    "counted_seq",
+                ],
+                (
+                    (room[0], user_id, position == 0, 0, 0, 0)
+                    for room in rooms
+                    for position, user_id in enumerate(room[6])
+                ),
+                batch_size,
+            )
+
+            self.step("invites")
+            private_rooms = [
+                room for room in rooms if room[3] == RoomType.PRIVATE
+            ]
+            invites = set()
+            if private_rooms:
+                for _ in range(options["invites"]):
+                    room = rng.choice(private_rooms)
+                    invites.add((room[0], f"invitee{rng.randrange(10**9)}"))
+            insert(
+                InviteLink,
+                ["chatroom", "email", "expires", "has_expired"],
+                (
+                    (
+                        room_id,
+                        f"{name}@example.com",
+                        now + timedelta(hours=rng.uniform(-10, 5)),
+                        rng.random() < 0.3,
+                    )
+                    for room_id, name in invites
+                ),
+                batch_size,
+            )
+
+            # Busier rooms get proportionally more messages.
+            self.step("messages")
+            weights = [len(room[6]) * rng.random() for room in rooms]
+            span = timedelta(days=options["days"]).total_seconds()
+            insert(
+                ChatRoomMessage,
+                [
+                    "chatroom",
+                    "user",
+                    "message",
+                    "edited",
+                    "created",
+                    "updated",
+                    "seq",
+                    "created_seq",
+                    "deleted",
+                ],
+                self.messages(
+                    rng, rooms, weights, options["messages"], now, span
+                ),
+                batch_size,
+            )
+
+            self.step("counters")
+            room_ids = [room[0] for room in rooms]
+            recount(ChatRoom.objects.filter(pk__in=room_ids))
+            mark_read(ChatRoomMember.objects.filter(chatroom_id__in=room_ids))
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Generated {len(user_ids)} users, {len(rooms)} rooms, "
+                f"{sum(len(room[6]) for room in rooms)} members, "
+                f"{len(invites)} invites and {options['messages']} messages "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+        )
+
+    def messages(self, rng, rooms, weights, count, now, span):
+        rooms = rng.choices(rooms, weights=weights, k=count)
+        # Oldest first, so ids, sequence numbers and creation times grow
+        # together.
+        offsets = sorted(
+            (rng.random() * span for _ in range(count)), reverse=True
+        )
+        seqs = Counter()
+        for room, offset in zip(rooms, offsets):
+            created = now - timedelta(seconds=offset)
+            text = " ".join(rng.choices(WORDS, k=rng.randint(3, 25)))
+            seqs[room[0]] += 1
+            yield (
+                room[0],
+                rng.choice(room[6]),
+                text,
+                False,
+                created,
+                created,
+                seqs[room[0]],
+                seqs[room[0]],
+                False,
+            )
+
+    def step(self, name):
+        self.stdout.write(f"Generating {name}...")
+        return None
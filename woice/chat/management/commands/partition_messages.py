@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.partitions import ensure_partitions, partition_messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Store chatroom messages in monthly partitions, converting the "
+        "messages table on the first run, and create the partitions of the "
+        "coming months. Run it monthly, e.g. from cron"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=settings.MESSAGE_PARTITIONS_AHEAD,
+            help="Number of future months to create partitions for",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Number of messages copied per transaction when converting",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning requires PostgreSQL")
+
+        # The conversion copies messages in batches while the table stays
+        # in use, and can be interrupted and run again.
+        if partition_messages(options["ahead"], options["batch_size"]):
+            self.stdout.write(self.style.SUCCESS("Partitioned messages"))
+
+        created = ensure_partitions(options["ahead"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {len(created)} partition(s)"
+                + (f": {', '.join(created)}" if created else "")
+            )
+        )
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from chat.counters import recount, recount_reads
+from chat.models import ChatRoom, ChatRoomMember
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the member and message counts and last message of "
+        "chatrooms from their members and messages, and the read counts of "
+        "their members"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "rooms",
+            nargs="*",
+            help="Ids of the rooms to recount (all rooms by default)",
+        )
+
+    def handle(self, *args, **options):
+        queryset = ChatRoom.objects.all()
+        if options["rooms"]:
+            queryset = queryset.filter(pk__in=options["rooms"])
+
+        updated = recount(queryset)
+        members = recount_reads(
+            ChatRoomMember.objects.filter(chatroom__in=queryset)
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Recounted {updated} room(s) and {members} member(s)"
+            )
+        )
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.sweeper import delete_expired_invites
+
+
+class Command(BaseCommand):
+    help = "Delete used or expired chatroom invites in bounded batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.INVITE_SWEEPER_BATCH_SIZE,
+            help="Maximum number of invites deleted per query",
+        )
+
+    def handle(self, *args, **options):
+        deleted = delete_expired_invites(options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Deleted {deleted} expired invite(s)")
+        )
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:30
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Built concurrently, which can't run in a transaction, so that writes
+    # to the messages table carry on while the index is built.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0016_chatroommessage_edited'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='chatroommessage',
+            index=models.Index(fields=['chatroom', '-created', '-id'], name='message_room_created_idx'),
+        ),
+    ]
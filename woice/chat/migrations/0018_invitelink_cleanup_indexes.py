@@ -0,0 +1,21 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_chatroommessage_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invitelink',
+            index=models.Index(fields=['expires'], name='invite_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invitelink',
+            index=models.Index(condition=models.Q(('has_expired', True)), fields=['has_expired'], name='invite_has_expired_idx'),
+        ),
+    ]
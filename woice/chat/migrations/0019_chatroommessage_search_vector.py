@@ -0,0 +1,74 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:39
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+# Rows backfilled per UPDATE.
+BATCH_SIZE = 10000
+
+
+def backfill_search_vectors(apps, schema_editor):
+    # One id range at a time, each committed on its own, so the backfill
+    # never holds the locks of the whole table. Rows written meanwhile get
+    # theirs from the trigger.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT min(id), max(id) FROM chat_chatroommessage")
+        first, last = cursor.fetchone()
+        if first is None:
+            return
+        for start in range(first, last + 1, BATCH_SIZE):
+            cursor.execute(
+                """
+                UPDATE chat_chatroommessage
+                SET search_vector = to_tsvector('english', coalesce(message, ''))
+                WHERE id >= %s AND id < %s AND search_vector IS NULL
+                """,
+                [start, start + BATCH_SIZE],
+            )
+
+
+class Migration(migrations.Migration):
+    # Runs outside of a transaction, so that the backfill commits batch by
+    # batch and the index is built concurrently, without blocking writes.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0018_invitelink_cleanup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommessage',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE FUNCTION chat_message_search_vector_update()
+                RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := to_tsvector('english', coalesce(NEW.message, ''));
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+                """,
+                """
+                CREATE TRIGGER chat_message_search_vector_trigger
+                BEFORE INSERT OR UPDATE OF message ON chat_chatroommessage
+                FOR EACH ROW EXECUTE PROCEDURE chat_message_search_vector_update();
+                """,
+            ],
+            reverse_sql=[
+                "DROP TRIGGER chat_message_search_vector_trigger ON chat_chatroommessage;",
+                "DROP FUNCTION chat_message_search_vector_update();",
+            ],
+        ),
+        migrations.RunPython(backfill_search_vectors, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='chatroommessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='message_search_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently, which can't run in a transaction,
+    # so that sign-ups and profile changes carry on meanwhile.
+    atomic = False
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0019_chatroommessage_search_vector'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        # Member search filters on the usernames of `auth_user`, so its
+        # indexes live here: a trigram index for the `%` operator and an
+        # expression index for case-insensitive prefix matches, which
+        # Django compiles to `UPPER(username::text) LIKE UPPER('q%')`.
+        migrations.RunSQL(
+            sql=[
+                "CREATE INDEX CONCURRENTLY chat_username_trgm_idx ON auth_user USING gin (username gin_trgm_ops);",
+                "CREATE INDEX CONCURRENTLY chat_username_prefix_idx ON auth_user (UPPER(username::text) text_pattern_ops);",
+            ],
+            reverse_sql=[
+                "DROP INDEX CONCURRENTLY chat_username_trgm_idx;",
+                "DROP INDEX CONCURRENTLY chat_username_prefix_idx;",
+            ],
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:46
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Left
+
+
+def backfill_counters(apps, schema_editor):
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    ChatRoomMember = apps.get_model("chat", "ChatRoomMember")
+    ChatRoomMessage = apps.get_model("chat", "ChatRoomMessage")
+
+    def count(model):
+        return Coalesce(
+            Subquery(
+                model.objects.filter(chatroom=OuterRef("pk"))
+                .order_by()
+                .values("chatroom")
+                .annotate(count=Count("pk"))
+                .values("count"),
+                output_field=IntegerField(),
+            ),
+            Value(0),
+        )
+
+    latest = ChatRoomMessage.objects.filter(
+        chatroom=OuterRef("pk")
+    ).order_by("-created", "-id")
+    ChatRoom.objects.update(
+        member_count=count(ChatRoomMember),
+        message_count=count(ChatRoomMessage),
+        last_message_id=Subquery(latest.values("id")[:1]),
+        last_message_at=Subquery(latest.values("created")[:1]),
+        last_message_preview=Coalesce(
+            Left(Subquery(latest.values("message")[:1]), 100), Value("")
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0020_username_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_id',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['-created', 'id'], name='room_created_idx'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0021_chatroom_directory_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('chunks', models.JSONField(editable=False, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('chatroom', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='message_archive', to='chat.chatroom')),
+            ],
+            options={
+                'verbose_name': 'Message archive',
+                'verbose_name_plural': 'Message archives',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchive',
+            constraint=models.UniqueConstraint(fields=('chatroom', 'start'), name='unique_chatroom_and_start'),
+        ),
+    ]
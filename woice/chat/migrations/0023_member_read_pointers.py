@@ -0,0 +1,37 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:04
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def mark_read(apps, schema_editor):
+    # Existing members start with every message read.
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    ChatRoomMember = apps.get_model("chat", "ChatRoomMember")
+
+    room = ChatRoom.objects.filter(pk=OuterRef("chatroom_id"))
+    ChatRoomMember.objects.update(
+        last_read_id=Subquery(room.values("last_message_id")),
+        read_count=Subquery(room.values("message_count")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0022_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_read_id',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='read_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(mark_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:09
+
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+
+def backfill_seqs(apps, schema_editor):
+    # Message ids already grow with every new message, so they serve as
+    # the sequence numbers of existing messages.
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    ChatRoomMessage = apps.get_model("chat", "ChatRoomMessage")
+    MessageArchive = apps.get_model("chat", "MessageArchive")
+
+    def latest(model, field):
+        return Coalesce(
+            Subquery(
+                model.objects.filter(chatroom=OuterRef("pk"))
+                .order_by()
+                .values("chatroom")
+                .annotate(latest=Max(field))
+                .values("latest"),
+            ),
+            Value(0),
+        )
+
+    ChatRoomMessage.objects.update(seq=F("id"))
+    ChatRoom.objects.update(
+        archived_seq=latest(MessageArchive, "last_id"),
+        last_seq=Greatest(
+            latest(ChatRoomMessage, "seq"), latest(MessageArchive, "last_id")
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0023_member_read_pointers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='archived_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroommessage',
+            name='deleted',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroommessage',
+            name='seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        # Backfilled before the index exists, so it is built only once.
+        migrations.RunPython(backfill_seqs, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatroommessage',
+            index=models.Index(fields=['chatroom', 'seq'], name='message_room_seq_idx'),
+        ),
+    ]
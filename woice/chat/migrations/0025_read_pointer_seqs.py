@@ -0,0 +1,57 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:46
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_read_seqs(apps, schema_editor):
+    # Existing messages were created no later than their last change, and
+    # read counts were kept current until now, so they carry over.
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    ChatRoomMember = apps.get_model("chat", "ChatRoomMember")
+    ChatRoomMessage = apps.get_model("chat", "ChatRoomMessage")
+
+    ChatRoomMessage.objects.update(created_seq=F("seq"))
+    last_read = ChatRoomMessage.objects.filter(pk=OuterRef("last_read_id"))
+    room = ChatRoom.objects.filter(pk=OuterRef("chatroom_id"))
+    ChatRoomMember.objects.update(
+        last_read_seq=Coalesce(
+            Subquery(last_read.values("created_seq")), Value(0)
+        ),
+        counted_seq=Subquery(room.values("last_seq")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0024_message_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroommember',
+            name='counted_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroommember',
+            name='last_read_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroommessage',
+            name='created_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_read_seqs, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatroommessage',
+            index=models.Index(fields=['chatroom', 'created_seq'], name='message_room_created_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroommessage',
+            index=models.Index(condition=models.Q(('deleted', True)), fields=['chatroom', 'seq'], name='message_room_deleted_seq_idx'),
+        ),
+    ]
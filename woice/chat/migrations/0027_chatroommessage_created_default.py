@@ -0,0 +1,19 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:21
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0025_read_pointer_seqs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatroommessage',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -1,9 +1,18 @@
 import uuid
 
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils import timezone
 
+# Text search configuration used for `ChatRoomMessage.search_vector`. It
+# must match the one used by the trigger in migration 0019.
+SEARCH_CONFIG = "english"
+
+# Characters of the last message kept on `ChatRoom` for room listings.
+LAST_MESSAGE_PREVIEW_LENGTH = 100
+
 
 def five_hours_hence():
     return timezone.now() + timezone.timedelta(hours=5)
@@ -29,6 +38,20 @@ class ChatRoom(models.Model):
     )
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    # Denormalized for room listings, and maintained by `chat.counters`.
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    last_message_id = models.BigIntegerField(null=True, editable=False)
+    last_message_at = models.DateTimeField(null=True, editable=False)
+    last_message_preview = models.CharField(
+        max_length=LAST_MESSAGE_PREVIEW_LENGTH, blank=True, editable=False
+    )
+    # Sequence number of the room's latest message change, allocated by
+    # `chat.counters.next_seq`, and of the latest change that may have been
+    # archived, or purged with its tombstone. Clients behind `archived_seq`
+    # can't catch up on changes.
+    last_seq = models.BigIntegerField(default=0, editable=False)
+    archived_seq = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         constraints = [
@@ -36,6 +59,9 @@ class ChatRoom(models.Model):
                 fields=["name", "creator"], name="unique_name_and_creator"
             )
         ]
+        indexes = [
+            models.Index(fields=["-created", "id"], name="room_created_idx"),
+        ]
         verbose_name = "Chatroom"
         verbose_name_plural = "Chatrooms"
 
@@ -54,6 +80,15 @@ class ChatRoomMember(models.Model):
         on_delete=models.PROTECT,
     )
     is_admin = models.BooleanField(default=False)
+    # The newest message the member has read, and its `created_seq`: every
+    # message created up to `last_read_seq` counts as read. `read_count` is
+    # how many of those weren't deleted when the room's `last_seq` was
+    # `counted_seq`. All maintained by `chat.counters`, which derives unread
+    # counts from them.
+    last_read_id = models.BigIntegerField(null=True, editable=False)
+    last_read_seq = models.BigIntegerField(default=0, editable=False)
+    read_count = models.PositiveIntegerField(default=0, editable=False)
+    counted_seq = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         constraints = [
@@ -80,10 +115,43 @@ class ChatRoomMessage(models.Model):
     )
     message = models.TextField()
     edited = models.BooleanField(default=False)
-    created = models.DateTimeField(auto_now_add=True)
+    # Set from `ChatRoom.last_seq` whenever the message is created, edited
+    # or deleted. Deleted messages are kept, emptied, as tombstones.
+    seq = models.BigIntegerField(default=0, editable=False)
+    # `seq` as of the message's creation. Unlike ids, these follow the
+    # order messages are committed in, so read pointers are based on them.
+    created_seq = models.BigIntegerField(default=0, editable=False)
+    deleted = models.BooleanField(default=False, editable=False)
+    # A default rather than `auto_now_add`, so that messages written behind
+    # their broadcast keep the time they were sent with.
+    created = models.DateTimeField(default=timezone.now, editable=False)
     updated = models.DateTimeField(auto_now=True)
+    # Maintained by a database trigger from `message` (see migration 0019),
+    # so it is always current, including for bulk inserts.
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
+        indexes = [
+            models.Index(
+                fields=["chatroom", "-created", "-id"],
+                name="message_room_created_idx",
+            ),
+            # Counts the messages passed when a read pointer moves.
+            models.Index(
+                fields=["chatroom", "created_seq"],
+                name="message_room_created_seq_idx",
+            ),
+            models.Index(
+                fields=["chatroom", "seq"], name="message_room_seq_idx"
+            ),
+            # Finds the messages deleted since a read count was taken.
+            models.Index(
+                fields=["chatroom", "seq"],
+                name="message_room_deleted_seq_idx",
+                condition=models.Q(deleted=True),
+            ),
+            GinIndex(fields=["search_vector"], name="message_search_idx"),
+        ]
         verbose_name = "Chatroom message"
         verbose_name_plural = "Chatroom messages"
 
@@ -91,6 +159,38 @@ class ChatRoomMessage(models.Model):
         return f"{self.chatroom} messages"
 
 
+class MessageArchive(models.Model):
+    # A room's messages from one month, moved out of the database into a
+    # gzipped JSON lines file under MESSAGE_ARCHIVE_DIR (see chat.archive).
+    chatroom = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.PROTECT,
+        related_name="message_archive",
+    )
+    path = models.CharField(max_length=255)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    # Index of the file's chunks, written by `chat.archive.write_archive`,
+    # or null for archives written as a single chunk.
+    chunks = models.JSONField(null=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chatroom", "start"], name="unique_chatroom_and_start"
+            )
+        ]
+        verbose_name = "Message archive"
+        verbose_name_plural = "Message archives"
+
+    def __str__(self):
+        return f"{self.chatroom} messages from {self.start:%Y-%m}"
+
+
 class InviteLink(models.Model):
     chatroom = models.ForeignKey(
         ChatRoom,
@@ -108,6 +208,14 @@ class InviteLink(models.Model):
                 fields=["chatroom", "email"], name="unique_email_and_chatroom"
             )
         ]
+        indexes = [
+            models.Index(fields=["expires"], name="invite_expires_idx"),
+            models.Index(
+                fields=["has_expired"],
+                name="invite_has_expired_idx",
+                condition=models.Q(has_expired=True),
+            ),
+        ]
         verbose_name = "Invite"
         verbose_name_plural = "Invites"
 
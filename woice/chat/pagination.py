@@ -0,0 +1,415 @@
+import base64
+import binascii
+from collections import OrderedDict
+
+from django.db.models import Q, Subquery
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .archive import archive_reader
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination for room messages, newest first.
+
+    Pages are anchored on a message id instead of an offset:
+    `?before=<id>` returns the page of messages older than that message
+    and `?after=<id>` the page of messages newer than it. Each page is a
+    single range scan over the (chatroom, created, id) index, so deep
+    history pages cost the same as the first one and no `COUNT(*)` is
+    ever run.
+
+    Pages that reach past the oldest message still in the database are
+    completed from the room's archives (see `chat.archive`), which only
+    hold messages older than any in the database.
+
+    Requests with a `?page=<number>` are still paginated by page number,
+    as before keyset pagination, for the clients that page that way. Those
+    pages are counted and offset, and never reach the archives.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    before_query_param = "before"
+    after_query_param = "after"
+    page_query_param = "page"
+
+    def __init__(self):
+        self.page_number_pagination = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_query_param in request.query_params:
+            self.page_number_pagination = PageNumberPagination()
+            return self.page_number_pagination.paginate_queryset(
+                queryset, request, view
+            )
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.before = self.get_anchor(request, self.before_query_param)
+        self.after = self.get_anchor(request, self.after_query_param)
+        room = view.kwargs.get("pk") if view is not None else None
+
+        if self.before is not None and self.after is not None:
+            raise ValidationError(
+                {
+                    "status": "error",
+                    "message": "Use either `before` or `after`, not both!",
+                }
+            )
+
+        hot = queryset
+        if self.after is not None:
+            anchor = self.get_anchor_created(queryset, self.after)
+            queryset = (
+                queryset.filter(created__gte=anchor)
+                .exclude(created=anchor, id__lte=self.after)
+                .order_by("created", "id")
+            )
+        else:
+            if self.before is not None:
+                anchor = self.get_anchor_created(queryset, self.before)
+                queryset = queryset.filter(created__lte=anchor).exclude(
+                    created=anchor, id__gte=self.before
+                )
+            queryset = queryset.order_by("-created", "-id")
+
+        page = list(queryset[: self.page_size + 1])
+        if len(page) <= self.page_size and room is not None:
+            page = self.add_archived(hot, room, page)
+        self.has_more = len(page) > self.page_size
+        page = page[: self.page_size]
+
+        if self.after is not None:
+            page.reverse()
+
+        self.set_page_bounds(
+            page[0].id if page else None, page[-1].id if page else None
+        )
+        return page
+
+    def add_archived(self, queryset, room, page):
+        """
+        Complete a short `page` from the archives of `room`. Newer pages
+        whose anchor is archived start in the archives and continue with
+        the oldest messages in `queryset`.
+        """
+        limit = self.page_size + 1
+        if self.after is not None:
+            if page:
+                return page
+            anchor = archive_reader.locate(room, self.after)
+            if anchor is None:
+                return page
+            page = archive_reader.newer(room, anchor, limit)
+            if len(page) < limit:
+                page += list(
+                    queryset.order_by("created", "id")[: limit - len(page)]
+                )
+            return page
+
+        if page:
+            boundary = (page[-1].created, page[-1].id)
+        elif self.before is not None:
+            boundary = queryset.filter(pk=self.before).values_list(
+                "created", "id"
+            ).first() or archive_reader.locate(room, self.before)
+            if boundary is None:
+                return page
+        else:
+            boundary = None
+        return page + archive_reader.older(room, boundary, limit - len(page))
+
+    def is_first_page(self, request):
+        return (
+            self.before_query_param not in request.query_params
+            and self.after_query_param not in request.query_params
+            and self.page_query_param not in request.query_params
+        )
+
+    def paginate_cached(self, messages, has_more, request):
+        """
+        Paginate the first page from already serialized `messages`, newest
+        first, as returned by the room history cache.
+        """
+        self.request = request
+        self.before = self.after = None
+        self.has_more = has_more
+        self.set_page_bounds(
+            messages[0]["id"] if messages else None,
+            messages[-1]["id"] if messages else None,
+        )
+        return messages
+
+    def set_page_bounds(self, first_id, last_id):
+        self.first_id = first_id
+        self.last_id = last_id
+
+    def get_paginated_response(self, data):
+        if self.page_number_pagination is not None:
+            return self.page_number_pagination.get_paginated_response(data)
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_next_link(self):
+        # Older messages exist if this page is full, or if the page was
+        # fetched relative to a newer anchor (the anchor itself is older).
+        if self.last_id is None:
+            return None
+        if self.after is None and not self.has_more:
+            return None
+        return self.build_link(self.before_query_param, self.last_id)
+
+    def get_previous_link(self):
+        if self.first_id is None:
+            return None
+        if self.after is not None and not self.has_more:
+            return None
+        if self.after is None and self.before is None:
+            return None
+        return self.build_link(self.after_query_param, self.first_id)
+
+    def build_link(self, param, message_id):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, message_id)
+
+    def get_anchor(self, request, param):
+        value = request.query_params.get(param)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError(
+                {
+                    "status": "error",
+                    "message": f"`{param}` must be a message id!",
+                }
+            )
+
+    def get_anchor_created(self, queryset, message_id):
+        # Resolved inside the page query itself, so paging costs a single
+        # round trip. An unknown anchor yields NULL and hence an empty page.
+        return Subquery(queryset.filter(pk=message_id).values("created")[:1])
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_schema_fields(self, view):
+        assert (
+            coreapi is not None
+        ), "coreapi must be installed to use `get_schema_fields()`"
+        assert (
+            coreschema is not None
+        ), "coreschema must be installed to use `get_schema_fields()`"
+        return [
+            coreapi.Field(
+                name=self.before_query_param,
+                required=False,
+                location="query",
+                schema=coreschema.Integer(
+                    title="Before",
+                    description="Return messages older than this message id.",
+                ),
+            ),
+            coreapi.Field(
+                name=self.after_query_param,
+                required=False,
+                location="query",
+                schema=coreschema.Integer(
+                    title="After",
+                    description="Return messages newer than this message id.",
+                ),
+            ),
+            coreapi.Field(
+                name=self.page_query_param,
+                required=False,
+                location="query",
+                schema=coreschema.Integer(
+                    title="Page",
+                    description="Page number, for clients paging by number "
+                    "instead of by message id.",
+                ),
+            ),
+            coreapi.Field(
+                name=self.page_size_query_param,
+                required=False,
+                location="query",
+                schema=coreschema.Integer(
+                    title="Page size",
+                    description="Number of messages to return per page.",
+                ),
+            ),
+        ]
+
+
+class ChangesPagination(BasePagination):
+    """
+    Pagination for the changes to a room's messages, oldest first.
+
+    `?since=<seq>` returns the messages created, edited or deleted after
+    sequence number `seq`, each in its current state, with a single range
+    scan over the (chatroom, seq) index. Responses carry the `seq` to ask
+    for next time, and a `next` link while more changes are pending.
+    Expects a queryset of a single room's messages.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 500
+    since_query_param = "since"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.since = self.get_since(request)
+
+        page = list(
+            queryset.filter(seq__gt=self.since).order_by("seq")[
+                : self.page_size + 1
+            ]
+        )
+        self.has_more = len(page) > self.page_size
+        page = page[: self.page_size]
+        # Changes to a room commit in sequence order (see
+        # `chat.counters.next_seq`), so nothing before it is still pending.
+        self.seq = page[-1].seq if page else self.since
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("seq", self.seq),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.since_query_param, self.seq
+        )
+
+    def get_since(self, request):
+        try:
+            since = int(request.query_params[self.since_query_param])
+            if since >= 0:
+                return since
+        except (KeyError, ValueError):
+            pass
+        raise ValidationError(
+            {
+                "status": "error",
+                "message": f"`{self.since_query_param}` must be a sequence "
+                "number!",
+            }
+        )
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+
+class SearchKeysetPagination(BasePagination):
+    """
+    Keyset pagination for ranked search results, best match first.
+
+    The `cursor` query parameter encodes the rank and id of the last result
+    of the previous page, so every page is fetched with a plain
+    `(rank, id) < (cursor)` condition instead of an offset. Expects a
+    queryset annotated with a double precision `rank`.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            rank, message_id = cursor
+            queryset = queryset.filter(
+                Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id)
+            )
+
+        page = list(queryset.order_by("-rank", "-id")[: self.page_size + 1])
+        self.has_more = len(page) > self.page_size
+        self.page = page[: self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict([("next", self.get_next_link()), ("results", data)])
+        )
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        last = self.page[-1]
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(last.rank, last.id),
+        )
+
+    def encode_cursor(self, rank, message_id):
+        # repr() round-trips the float exactly, which the `rank = cursor`
+        # half of the condition relies on.
+        cursor = f"{rank!r}:{message_id}".encode("ascii")
+        return base64.urlsafe_b64encode(cursor).decode("ascii")
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            cursor = base64.urlsafe_b64decode(encoded.encode("ascii"))
+            rank, message_id = cursor.decode("ascii").split(":")
+            return float(rank), int(message_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise ValidationError(
+                {"status": "error", "message": "Invalid cursor!"}
+            )
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
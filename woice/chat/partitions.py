@@ -0,0 +1,323 @@
+import re
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import ChatRoomMessage
+
+# Messages are partitioned by month of `created`. Partitions are named
+# after their month, and a default partition catches anything outside of
+# them so inserts never fail.
+TABLE = ChatRoomMessage._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"^{TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+
+def month_start(value):
+    value = value.astimezone(timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value, months):
+    years, month = divmod(value.month - 1 + months, 12)
+    return value.replace(year=value.year + years, month=month + 1)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start:%Y_%m}"
+
+
+def is_partitioned(cursor):
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+        [TABLE],
+    )
+    return cursor.fetchone() is not None
+
+
+def get_partitions(cursor):
+    """
+    Monthly partitions of the messages table, as `(name, start, end)`
+    tuples, oldest first. The default partition isn't included.
+    """
+    cursor.execute(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass
+        """,
+        [TABLE],
+    )
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match is not None:
+            start = datetime(
+                int(match[1]), int(match[2]), 1, tzinfo=timezone.utc
+            )
+            partitions.append((name, start, add_months(start, 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partition(cursor, start, parent=TABLE):
+    """
+    Create the partition for the month beginning at `start`. Rows of that
+    month that landed in the default partition are moved into it first, as
+    Postgres refuses to attach a partition whose rows are in the default.
+    """
+    name = connection.ops.quote_name(partition_name(start))
+    table = connection.ops.quote_name(parent)
+    default = connection.ops.quote_name(DEFAULT_PARTITION)
+    end = add_months(start, 1)
+
+    cursor.execute(
+        f"CREATE TABLE {name} "
+        f"(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+    )
+    cursor.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM {default}
+            WHERE created >= %s AND created < %s
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+        """,
+        [start, end],
+    )
+    # Attaching clones the parent's indexes, foreign keys and triggers.
+    cursor.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM (%s) TO (%s)",
+        [start, end],
+    )
+    return None
+
+
+def ensure_partitions(ahead):
+    """
+    Create the partitions of the current month and of the next `ahead`
+    months that don't exist yet. Returns the names of the new partitions.
+    """
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        existing = {name for name, _, _ in get_partitions(cursor)}
+        start = month_start(timezone.now())
+        for months in range(ahead + 1):
+            month = add_months(start, months)
+            if partition_name(month) not in existing:
+                create_partition(cursor, month)
+                created.append(partition_name(month))
+    return created
+
+
+# While the messages table is converted, rows are copied into a new
+# partitioned table, and a trigger mirrors every write to the old table
+# into it.
+NEW_TABLE = f"{TABLE}_partitioned"
+MIRROR = f"{TABLE}_mirror"
+INDEX_DEFINITION = re.compile(
+    r"^(CREATE (?:UNIQUE )?INDEX) (\S+) ON (\S+) (.*)$"
+)
+
+
+def new_index_name(name):
+    # Index names share a namespace with tables, so the new table's can't
+    # be the final ones until the old table is gone.
+    return f"{name[:59]}_new"
+
+
+def table_exists(cursor, name):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [name])
+    return cursor.fetchone()[0]
+
+
+def get_indexes(cursor):
+    """
+    `(name, definition)` of each index of the messages table, but its
+    primary key.
+    """
+    cursor.execute(
+        """
+        SELECT index.relname, pg_get_indexdef(indexrelid)
+        FROM pg_index
+        JOIN pg_class index ON index.oid = pg_index.indexrelid
+        WHERE indrelid = %s::regclass AND NOT indisprimary
+        """,
+        [TABLE],
+    )
+    return cursor.fetchall()
+
+
+def prepare_partitioned_table(cursor, ahead):
+    """
+    Create the partitioned table the messages are copied into, with the
+    partitions of every month from the oldest message to `ahead` months
+    from now, the indexes and foreign keys of the messages table, and the
+    trigger mirroring writes to it.
+    """
+    quote = connection.ops.quote_name
+    table = quote(TABLE)
+    new = quote(NEW_TABLE)
+
+    cursor.execute(
+        f"CREATE TABLE {new} "
+        f"(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        "PARTITION BY RANGE (created)"
+    )
+    cursor.execute(
+        f"ALTER TABLE {new} ADD CONSTRAINT {quote(NEW_TABLE + '_pkey')} "
+        "PRIMARY KEY (id, created)"
+    )
+    cursor.execute(
+        f"CREATE TABLE {quote(DEFAULT_PARTITION)} PARTITION OF {new} DEFAULT"
+    )
+    cursor.execute(f"SELECT min(created) FROM {table}")
+    (oldest,) = cursor.fetchone()
+    start = month_start(oldest or timezone.now())
+    end = add_months(month_start(timezone.now()), ahead)
+    while start <= end:
+        create_partition(cursor, start, parent=NEW_TABLE)
+        start = add_months(start, 1)
+
+    # Built now, so the copy keeps them up to date instead of the swap
+    # having to build them under its lock.
+    for name, definition in get_indexes(cursor):
+        create, _, _, rest = INDEX_DEFINITION.match(definition).groups()
+        cursor.execute(
+            f"{create} {quote(new_index_name(name))} ON {new} {rest}"
+        )
+    # Constraint names are per table, so foreign keys keep theirs.
+    cursor.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+        """,
+        [TABLE],
+    )
+    for name, definition in cursor.fetchall():
+        cursor.execute(
+            f"ALTER TABLE {new} ADD CONSTRAINT {quote(name)} {definition}"
+        )
+
+    # An AFTER trigger sees rows as stored, search vectors included.
+    # Updates replace the whole row, as they may come before it is copied.
+    cursor.execute(f"""
+        CREATE FUNCTION {quote(MIRROR)}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {new} WHERE id = OLD.id AND created = OLD.created;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {new} VALUES (NEW.*);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """)
+    cursor.execute(
+        f"CREATE TRIGGER {quote(MIRROR)} "
+        f"AFTER INSERT OR UPDATE OR DELETE ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {quote(MIRROR)}()"
+    )
+    return None
+
+
+def copy_messages(batch_size):
+    """
+    Copy the messages into the partitioned table, by ranges of
+    `batch_size` ids, each in its own transaction. Rows are locked while
+    they are copied, so a concurrent write either lands before and is
+    copied, or waits and is mirrored. Rows already there, mirrored or
+    copied by an earlier, interrupted run, are left alone.
+    """
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT max(id) FROM {quote(TABLE)}")
+        (last,) = cursor.fetchone()
+
+    start = 0
+    while last is not None and start <= last:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {quote(NEW_TABLE)}
+                SELECT * FROM {quote(TABLE)}
+                WHERE id >= %s AND id < %s
+                FOR SHARE
+                ON CONFLICT (id, created) DO NOTHING
+                """,
+                [start, start + batch_size],
+            )
+        start += batch_size
+    return None
+
+
+def swap_partitioned_table(cursor):
+    """
+    Replace the messages table with the partitioned table, which takes
+    over its id sequence, name, index names and triggers.
+    """
+    quote = connection.ops.quote_name
+    table = quote(TABLE)
+    new = quote(NEW_TABLE)
+
+    cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+    cursor.execute(f"DROP TRIGGER {quote(MIRROR)} ON {table}")
+    cursor.execute(f"DROP FUNCTION {quote(MIRROR)}()")
+    indexes = [name for name, _ in get_indexes(cursor)]
+    cursor.execute(
+        """
+        SELECT pg_get_triggerdef(oid) FROM pg_trigger
+        WHERE tgrelid = %s::regclass AND NOT tgisinternal
+        """,
+        [TABLE],
+    )
+    triggers = [definition for (definition,) in cursor.fetchall()]
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+    (sequence,) = cursor.fetchone()
+
+    # The id sequence would otherwise be dropped with the old table.
+    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {new}.id")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {new} RENAME TO {table}")
+    cursor.execute(
+        f"ALTER TABLE {table} RENAME CONSTRAINT "
+        f"{quote(NEW_TABLE + '_pkey')} TO {quote(TABLE + '_pkey')}"
+    )
+    for name in indexes:
+        cursor.execute(
+            f"ALTER INDEX {quote(new_index_name(name))} RENAME TO {quote(name)}"
+        )
+    # Definitions name the table, which is now the partitioned one.
+    for definition in triggers:
+        cursor.execute(definition)
+    return None
+
+
+def partition_messages(ahead, batch_size):
+    """
+    Convert the messages table into a table partitioned by month, with
+    partitions up to `ahead` months into the future. Returns False if the
+    table was already partitioned.
+
+    Messages are copied into the new table `batch_size` at a time while
+    the old one stays in use, so only swapping the two locks the table,
+    and a run that is interrupted picks up where it stopped. The primary
+    key becomes `(id, created)`, as Postgres requires it to include the
+    partition key: ids stay unique as they all come from the same
+    sequence, and no table references messages by foreign key.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            return False
+        if not table_exists(cursor, NEW_TABLE):
+            prepare_partitioned_table(cursor, ahead)
+
+    copy_messages(batch_size)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        swap_partitioned_table(cursor)
+    return True
@@ -1,7 +1,6 @@
-from django.core.exceptions import ObjectDoesNotExist
 from rest_framework.permissions import BasePermission
 
-from .models import ChatRoom, ChatRoomMember
+from .context import get_room
 
 
 class ChatRoomPermission(BasePermission):
@@ -25,26 +24,20 @@ class AdminPermission(BasePermission):
 
     def has_permission(self, request, view):
         if request.user.is_authenticated:
-            try:
-                chatroom = ChatRoom.objects.get(pk=view.kwargs["pk"])
-            except ObjectDoesNotExist:
+            chatroom = get_room(request, view.kwargs["pk"])
+            if chatroom is None:
                 return False
 
             # Room creator is automatically an admin (see signals).
-            # Only run this check if authenticated user is not the
-            # room creator.
-            if request.user != chatroom.creator:
-                try:
-                    other_admin = ChatRoomMember.objects.get(
-                        chatroom=chatroom, user=request.user
-                    )
-                except ObjectDoesNotExist:
-                    return False
-
-                if not other_admin.is_admin:
-                    return False
-                else:
-                    return True
-            else:
-                return True
+            return request.user.pk == chatroom.creator_id or chatroom.is_admin
+        return False
+
+
+class MemberPermission(BasePermission):
+    message = "Members only!"
+
+    def has_permission(self, request, view):
+        if request.user.is_authenticated:
+            chatroom = get_room(request, view.kwargs["pk"])
+            return chatroom is not None and chatroom.is_member
         return False
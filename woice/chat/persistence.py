@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+from woice.db import database_sync_to_async
+
+from .counters import assign_seqs, record_messages
+from .models import ChatRoomMessage
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBufferFull(Exception):
+    pass
+
+
+class MessageBuffer:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    Messages get their primary key up front from a block of ids reserved
+    on the Postgres sequence, so they can be broadcast straight away, and
+    are then written with `bulk_create` once `batch_size` messages are
+    pending or `flush_interval` seconds have passed. Flushes never overlap
+    and always take the oldest pending messages first, so rows reach the
+    database in id order. Anything still pending when the process exits is
+    written synchronously.
+
+    A batch that fails to write is retried up to `max_retries` times, then
+    dropped, so neither an outage nor a bad row holds back the messages
+    behind it forever. At most `max_pending` messages wait to be written:
+    `add` raises `MessageBufferFull` beyond that, for the message to be
+    written synchronously instead.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_retries, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self.failures = 0
+        self.pending = []
+        # Room of every message not written yet, by id.
+        self.pending_ids = {}
+        self.reserved_ids = []
+        self.reserve_lock = None
+        self.flush_lock = None
+        self.timer = None
+        self.sync_lock = threading.Lock()
+        atexit.register(self.flush_sync)
+
+    async def add(self, chatroom, user, message):
+        if len(self.pending) >= self.max_pending:
+            raise MessageBufferFull
+        if self.reserve_lock is None:
+            self.reserve_lock = asyncio.Lock()
+
+        async with self.reserve_lock:
+            if not self.reserved_ids:
+                self.reserved_ids = await database_sync_to_async(
+                    self.reserve_ids
+                )(self.batch_size)
+            # Broadcast and stored with the same `created`, stamped in id
+            # order. Its sequence number is only allocated in the
+            # transaction that writes it.
+            instance = ChatRoomMessage(
+                id=self.reserved_ids.pop(0),
+                chatroom=chatroom,
+                user=user,
+                message=message,
+                created=timezone.now(),
+                seq=None,
+            )
+            self.pending.append(instance)
+            self.pending_ids[instance.id] = instance.chatroom_id
+
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+            )
+        return instance
+
+    async def flush(self):
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+
+        async with self.flush_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            batch = self.pending[: self.batch_size]
+            if not batch:
+                return None
+            del self.pending[: len(batch)]
+
+            try:
+                await database_sync_to_async(self.write)(batch)
+            except Exception:
+                self.failures += 1
+                if self.failures <= self.max_retries:
+                    # Put the batch back in front of anything queued since,
+                    # so the next attempt still writes in id order.
+                    logger.exception(
+                        "Failed to flush %d chat message(s)", len(batch)
+                    )
+                    self.pending[:0] = batch
+                    loop = asyncio.get_running_loop()
+                    self.timer = loop.call_later(
+                        self.flush_interval,
+                        lambda: asyncio.ensure_future(self.flush()),
+                    )
+                    return None
+                logger.exception(
+                    "Dropping chat messages %s after %d failed flushes",
+                    [instance.id for instance in batch],
+                    self.failures,
+                )
+
+            self.failures = 0
+            for instance in batch:
+                del self.pending_ids[instance.id]
+
+        if self.pending:
+            await self.flush()
+        return None
+
+    async def flush_message(self, message_id):
+        """
+        Flush the buffer if `message_id` is still pending, so edits and
+        deletes always find the row in the database.
+        """
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return None
+
+        if message_id in self.pending_ids:
+            await self.flush()
+        return None
+
+    def is_pending(self, chatroom_id, message_id):
+        """
+        Whether message `message_id` of room `chatroom_id` is waiting in
+        this buffer to be written.
+        """
+        return self.pending_ids.get(message_id) == chatroom_id
+
+    def flush_sync(self):
+        with self.sync_lock:
+            while self.pending:
+                batch = self.pending[: self.batch_size]
+                del self.pending[: len(batch)]
+                self.write(batch)
+                for instance in batch:
+                    del self.pending_ids[instance.id]
+        return None
+
+    def write(self, batch):
+        # Room counters are updated in the same transaction, since
+        # `bulk_create` doesn't send the `post_save` that would.
+        try:
+            with transaction.atomic():
+                assign_seqs(batch)
+                ChatRoomMessage.objects.bulk_create(batch)
+                record_messages(batch)
+        except (DataError, IntegrityError):
+            # One bad row (e.g. its room was deleted) must not hold back
+            # the rest of the batch.
+            for instance in batch:
+                try:
+                    with transaction.atomic():
+                        assign_seqs([instance])
+                        ChatRoomMessage.objects.bulk_create([instance])
+                        record_messages([instance])
+                except (DataError, IntegrityError):
+                    logger.exception("Dropping chat message %s", instance.id)
+        return None
+
+    def reserve_ids(self, count):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                "FROM generate_series(1, %s)",
+                [ChatRoomMessage._meta.db_table, count],
+            )
+            return sorted(row[0] for row in cursor.fetchall())
+
+
+message_buffer = MessageBuffer(
+    batch_size=settings.MESSAGE_BATCH_SIZE,
+    flush_interval=settings.MESSAGE_FLUSH_INTERVAL,
+    max_retries=settings.MESSAGE_FLUSH_RETRIES,
+    max_pending=settings.MESSAGE_BUFFER_MAX_PENDING,
+)
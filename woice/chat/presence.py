@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import Counter
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .utils import encode_event
+
+logger = logging.getLogger(__name__)
+
+
+def encode_member(node, user_id, username):
+    return f"{node}:{user_id}:{username}"
+
+
+def decode_member(member):
+    if isinstance(member, bytes):
+        member = member.decode("utf8")
+    node, user_id, username = member.split(":", 2)
+    return node, int(user_id), username
+
+
+class MemoryPresenceStore:
+    """
+    Single-process stand-in for `RedisPresenceStore`.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+
+    async def touch(self, room, members, expires):
+        entries = self.rooms.setdefault(room, {})
+        for member in members:
+            entries[member] = expires
+
+    async def remove(self, room, members):
+        entries = self.rooms.get(room, {})
+        for member in members:
+            entries.pop(member, None)
+        if not entries:
+            self.rooms.pop(room, None)
+
+    async def prune(self, room, now):
+        entries = self.rooms.get(room, {})
+        for member, expires in list(entries.items()):
+            if expires <= now:
+                del entries[member]
+        if not entries:
+            self.rooms.pop(room, None)
+
+    async def members(self, room, now=None):
+        entries = self.rooms.get(room, {})
+        return [
+            member
+            for member, expires in entries.items()
+            if now is None or expires > now
+        ]
+
+
+class RedisPresenceStore:
+    """
+    Presence entries kept in the channel layer's Redis, as one sorted set
+    per room scored by expiry time, so entries left behind by a crashed
+    worker simply age out.
+    """
+
+    key_prefix = "presence:"
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def connection(self, key):
+        layer = get_channel_layer()
+        return layer.connection(layer.consistent_hash(key))
+
+    async def touch(self, room, members, expires):
+        if not members:
+            return None
+        key = self.key_prefix + room
+        pairs = []
+        for member in members:
+            pairs += [expires, member]
+        async with self.connection(key) as connection:
+            await connection.zadd(key, *pairs)
+            await connection.expire(key, int(self.ttl) + 1)
+
+    async def remove(self, room, members):
+        if not members:
+            return None
+        key = self.key_prefix + room
+        async with self.connection(key) as connection:
+            await connection.zrem(key, *members)
+
+    async def prune(self, room, now):
+        key = self.key_prefix + room
+        async with self.connection(key) as connection:
+            await connection.zremrangebyscore(key, max=now)
+
+    async def members(self, room, now=None):
+        key = self.key_prefix + room
+        async with self.connection(key) as connection:
+            if now is None:
+                members = await connection.zrange(key, 0, -1)
+            else:
+                members = await connection.zrangebyscore(key, min=now)
+        return [member.decode("utf8") for member in members]
+
+
+def online_users(members):
+    users = {}
+    for member in members:
+        _, user_id, username = decode_member(member)
+        users[user_id] = username
+    return users
+
+
+class PresenceTracker:
+    """
+    Tracks which members of each room are connected to this process and
+    publishes them to the presence store.
+
+    Joins and leaves are only recorded locally; every `interval` seconds
+    each room that changed gets a single `presence` event listing the
+    users who came online or went offline, so a mass reconnect produces one
+    diff per room instead of one message per socket per member. Every
+    `heartbeat` seconds all local entries are refreshed, and entries that
+    were not refreshed within `ttl` seconds (a crashed worker) expire and
+    are reported as having left.
+    """
+
+    def __init__(self, store, interval, heartbeat, ttl):
+        self.store = store
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.node = uuid.uuid4().hex
+        self.local = {}
+        self.dirty = set()
+        self.last_heartbeat = 0
+        self.task = None
+
+    def connect(self, room, user):
+        sockets = self.local.setdefault(room, Counter())
+        sockets[(user.pk, user.username)] += 1
+        if sockets[(user.pk, user.username)] == 1:
+            self.dirty.add(room)
+        self.start()
+        return None
+
+    def disconnect(self, room, user):
+        sockets = self.local.get(room)
+        if sockets is None or sockets[(user.pk, user.username)] == 0:
+            return None
+
+        sockets[(user.pk, user.username)] -= 1
+        if sockets[(user.pk, user.username)] == 0:
+            del sockets[(user.pk, user.username)]
+            self.dirty.add(room)
+        self.start()
+        return None
+
+    async def online(self, room):
+        """
+        Users currently online in `room`, across all workers, as a
+        `{user_id: username}` dict.
+        """
+        return online_users(await self.store.members(room, now=time.time()))
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return None
+
+    async def stop(self):
+        """
+        Cancel the periodic task and publish the changes still pending, so
+        the members of this process go offline without waiting for
+        their entries to expire.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+        return None
+
+    async def run(self):
+        try:
+            while self.local or self.dirty:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            self.task = None
+
+    async def flush(self):
+        now = time.time()
+        if now - self.last_heartbeat >= self.heartbeat:
+            self.last_heartbeat = now
+            rooms = set(self.local) | self.dirty
+        else:
+            rooms = self.dirty
+        self.dirty = set()
+
+        for room in rooms:
+            try:
+                await self.flush_room(room, now)
+            except Exception:
+                logger.exception("Failed to publish presence for %s", room)
+                self.dirty.add(room)
+        return None
+
+    async def flush_room(self, room, now):
+        sockets = self.local.get(room, Counter())
+        here = {
+            encode_member(self.node, user_id, username)
+            for user_id, username in sockets
+        }
+        before = await self.store.members(room)
+        gone = [
+            member
+            for member in before
+            if member.startswith(self.node + ":") and member not in here
+        ]
+
+        await self.store.remove(room, gone)
+        await self.store.prune(room, now)
+        await self.store.touch(room, here, now + self.ttl)
+        after = await self.store.members(room, now=now)
+
+        if not sockets:
+            self.local.pop(room, None)
+
+        before, after = online_users(before), online_users(after)
+        joined = [
+            {"id": user_id, "username": username}
+            for user_id, username in after.items()
+            if user_id not in before
+        ]
+        left = [
+            {"id": user_id, "username": username}
+            for user_id, username in before.items()
+            if user_id not in after
+        ]
+        if not joined and not left:
+            return None
+
+        await get_channel_layer().group_send(
+            room,
+            encode_event(
+                "presence",
+                {"type": "PRESENCE", "joined": joined, "left": left},
+            ),
+        )
+        return None
+
+
+def get_presence_store():
+    if settings.PRESENCE_BACKEND == "memory":
+        return MemoryPresenceStore()
+    return RedisPresenceStore(ttl=settings.PRESENCE_TTL)
+
+
+presence_tracker = PresenceTracker(
+    store=get_presence_store(),
+    interval=settings.PRESENCE_INTERVAL,
+    heartbeat=settings.PRESENCE_HEARTBEAT,
+    ttl=settings.PRESENCE_TTL,
+)
@@ -3,6 +3,7 @@ from django.db import IntegrityError
 from rest_framework.serializers import (
     BooleanField,
     EmailField,
+    FloatField,
     IntegerField,
     ListField,
     ModelSerializer,
@@ -25,6 +26,15 @@ class ChatRoomSerializer(ModelSerializer):
         }
 
 
+class MyChatRoomSerializer(ModelSerializer):
+    room = ChatRoomSerializer(source="chatroom")
+    unread_count = IntegerField()
+
+    class Meta:
+        model = ChatRoomMember
+        fields = ["room", "is_admin", "last_read_id", "unread_count"]
+
+
 class ChatRoomCreateSerializer(ModelSerializer):
     class Meta:
         model = ChatRoom
@@ -58,7 +68,16 @@ class ChatRoomMessageSerializer(ModelSerializer):
 
     class Meta:
         model = ChatRoomMessage
-        exclude = ["chatroom"]
+        exclude = ["chatroom", "search_vector"]
+
+
+class MessageSearchSerializer(ModelSerializer):
+    user = UserSerializer()
+    rank = FloatField()
+
+    class Meta:
+        model = ChatRoomMessage
+        exclude = ["search_vector"]
 
 
 class PrivateChatRoomInviteSerializer(Serializer):
@@ -68,3 +87,7 @@ class PrivateChatRoomInviteSerializer(Serializer):
 class MakeAdminSerializer(Serializer):
     user_id = IntegerField()
     make_admin = BooleanField(default=False)
+
+
+class MarkReadSerializer(Serializer):
+    message_id = IntegerField(min_value=1)
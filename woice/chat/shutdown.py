@@ -0,0 +1,101 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+
+from .persistence import message_buffer
+from .presence import presence_tracker
+from .sweeper import invite_sweeper
+from .typing import typing_aggregator
+
+logger = logging.getLogger(__name__)
+
+
+class GracefulShutdown:
+    """
+    Sockets open in this process, and how they and the background tasks
+    are wound down when the process is asked to exit.
+
+    `drain` tells every socket to reconnect, through its own channel so
+    that the handler it is running finishes first, and waits for them to
+    close. `stop` then writes the messages still buffered and stops the
+    sweeper, presence and typing tasks. Sockets that connect while
+    draining are turned away straight away.
+    """
+
+    def __init__(self):
+        self.sockets = set()
+        self.draining = False
+
+    def add(self, consumer):
+        self.sockets.add(consumer)
+        return None
+
+    def discard(self, consumer):
+        self.sockets.discard(consumer)
+        return None
+
+    async def drain(self, timeout):
+        """
+        Ask every socket to reconnect and wait up to `timeout` seconds for
+        them to close. Returns the number of sockets still open.
+        """
+        self.draining = True
+        if self.sockets:
+            logger.info("Draining %d socket(s)", len(self.sockets))
+
+        channel_layer = get_channel_layer()
+        for consumer in list(self.sockets):
+            try:
+                await channel_layer.send(
+                    consumer.channel_name, {"type": "server.shutdown"}
+                )
+            except Exception:
+                logger.exception("Failed to drain %s", consumer.channel_name)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.sockets and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        if self.sockets:
+            logger.warning(
+                "%d socket(s) still open after %ss", len(self.sockets), timeout
+            )
+        return len(self.sockets)
+
+    async def stop(self):
+        await message_buffer.flush()
+        if message_buffer.pending:
+            # Left to the exit handler of the buffer.
+            logger.warning(
+                "%d chat message(s) still buffered at shutdown",
+                len(message_buffer.pending),
+            )
+
+        invite_sweeper.stop()
+        await typing_aggregator.stop()
+        await presence_tracker.stop()
+        return None
+
+    async def lifespan(self, scope, receive, send):
+        """
+        ASGI application for the "lifespan" protocol, starting the invite
+        sweeper with the server and stopping the background tasks on
+        shutdown.
+        """
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                invite_sweeper.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                try:
+                    await self.stop()
+                except Exception:
+                    logger.exception("Failed to stop background tasks")
+                await send({"type": "lifespan.shutdown.complete"})
+                return None
+
+
+graceful_shutdown = GracefulShutdown()
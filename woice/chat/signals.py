@@ -1,12 +1,20 @@
+from django.conf import settings
 from django.core.signals import request_started
-from django.db import IntegrityError
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import Signal, receiver
-from django.utils import timezone
 from templated_email import send_templated_mail
 
-from .models import ChatRoom, ChatRoomMember, InviteLink
+from .cache import bump_directory_version, membership_cache, room_cache
+from .counters import (
+    mark_read,
+    record_delete,
+    record_edit,
+    record_members,
+    record_messages,
+)
+from .models import ChatRoom, ChatRoomMember, ChatRoomMessage, InviteLink
+from .sweeper import delete_expired_invites
 
 invites = Signal()
 
@@ -21,6 +29,63 @@ def add_creator_to_members(sender, instance, created, **kwargs):
     return None
 
 
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room_cache(sender, instance, **kwargs):
+    room_cache.delete(str(instance.pk))
+    # Bumped after commit so a concurrent read can't cache the old rows
+    # under the new version.
+    transaction.on_commit(bump_directory_version)
+
+    return None
+
+
+@receiver(post_save, sender=ChatRoomMember)
+@receiver(post_delete, sender=ChatRoomMember)
+def invalidate_membership_cache(sender, instance, **kwargs):
+    membership_cache.delete((str(instance.chatroom_id), instance.user_id))
+
+    return None
+
+
+@receiver(post_save, sender=ChatRoomMember)
+def count_new_member(sender, instance, created, **kwargs):
+    if created:
+        record_members(instance.chatroom_id, 1)
+        # New members start with everything sent before they joined read.
+        mark_read(ChatRoomMember.objects.filter(pk=instance.pk))
+
+    return None
+
+
+@receiver(post_delete, sender=ChatRoomMember)
+def count_removed_member(sender, instance, **kwargs):
+    record_members(instance.chatroom_id, -1)
+
+    return None
+
+
+# Messages written in bulk by `MessageBuffer` don't send `post_save`, so it
+# records them itself.
+@receiver(post_save, sender=ChatRoomMessage)
+def record_saved_message(sender, instance, created, update_fields, **kwargs):
+    if created:
+        record_messages([instance])
+    elif update_fields is None or "message" in update_fields:
+        record_edit(instance)
+
+    return None
+
+
+@receiver(post_delete, sender=ChatRoomMessage)
+def record_deleted_message(sender, instance, **kwargs):
+    # Tombstones were uncounted when the message was deleted.
+    if not instance.deleted:
+        record_delete(instance)
+
+    return None
+
+
 @receiver(invites)
 def send_invite_and_create_record(request, chatroom, recipients, **kwargs):
     _ = send_templated_mail(
@@ -35,19 +100,31 @@ def send_invite_and_create_record(request, chatroom, recipients, **kwargs):
         },
     )
 
-    for recipient in recipients:
-        try:
-            _ = InviteLink.objects.create(chatroom=chatroom, email=recipient)
-        except IntegrityError:
-            pass
+    # Recipients have no pending invite, so any row left for them is a
+    # used or expired one that would block the new invite.
+    _ = InviteLink.objects.filter(
+        chatroom=chatroom, email__in=recipients
+    ).delete()
+    _ = InviteLink.objects.bulk_create(
+        [
+            InviteLink(chatroom=chatroom, email=recipient)
+            for recipient in recipients
+        ],
+        ignore_conflicts=True,
+    )
 
     return None
 
 
-@receiver(request_started)
 def delete_expired_invite(sender, **kwargs):
-    _ = InviteLink.objects.filter(
-        Q(expires__lt=timezone.now()) | Q(has_expired=True)
-    ).delete()
+    _ = delete_expired_invites(
+        settings.INVITE_SWEEPER_BATCH_SIZE, max_batches=1
+    )
 
     return None
+
+
+# Legacy per-request cleanup. Prefer the `sweep_invites` command or the
+# in-process sweeper (see INVITE_SWEEPER_INTERVAL).
+if settings.INVITE_CLEANUP_ON_REQUEST:
+    request_started.connect(delete_expired_invite)
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from woice.db import database_sync_to_async
+
+from .models import InviteLink
+
+logger = logging.getLogger(__name__)
+
+
+def delete_expired_invites(batch_size, max_batches=None):
+    """
+    Delete used or expired invites, at most `batch_size` rows per query so
+    a large backlog never turns into one long-running, lock-heavy DELETE.
+    Stops after `max_batches` batches if given. Returns the number of rows
+    deleted.
+    """
+    expired = Q(expires__lt=timezone.now()) | Q(has_expired=True)
+    deleted = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        queryset = InviteLink.objects.filter(expired)
+        ids = list(queryset.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            break
+
+        count, _ = InviteLink.objects.filter(pk__in=ids).delete()
+        deleted += count
+        batches += 1
+        if len(ids) < batch_size:
+            break
+
+    return deleted
+
+
+class InviteSweeper:
+    """
+    In-process periodic task that runs `delete_expired_invites` every
+    `interval` seconds on the event loop of the server, started with the
+    application (see `chat.shutdown`). An `interval` of 0 disables it.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task = None
+
+    def start(self):
+        if self.interval <= 0 or self.task is not None:
+            return None
+        self.task = asyncio.ensure_future(self.run())
+        return None
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        return None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                deleted = await database_sync_to_async(delete_expired_invites)(
+                    self.batch_size
+                )
+            except Exception:
+                logger.exception("Failed to sweep expired invites")
+            else:
+                if deleted:
+                    logger.info("Swept %d expired invite(s)", deleted)
+
+
+invite_sweeper = InviteSweeper(
+    interval=settings.INVITE_SWEEPER_INTERVAL,
+    batch_size=settings.INVITE_SWEEPER_BATCH_SIZE,
+)
@@ -1,3 +1,1759 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.revocation import revocation_cache
+from woice.db import ConnectionPool, database_sync_to_async, pool
+from woice.query_budget import QueryBudgetExceeded, query_budget, track
+from woice.routing import application
+
+from .archive import FIELDS, archive_reader, write_archive
+from .cache import TTLCache, membership_cache, room_cache
+from .consumers import ChatRoomConsumer
+from .context import get_room
+from .counters import next_seq, record_delete
+from .eventlog import EventLog, MemoryEventLogStore, event_log
+from .history import RoomHistoryCache, history_cache
+from .management.commands._bench import percentile, summarize
+from .models import (
+    ChatRoom,
+    ChatRoomMember,
+    ChatRoomMessage,
+    InviteLink,
+    MessageArchive,
+    RoomType,
+)
+from .persistence import MessageBuffer, MessageBufferFull, message_buffer
+from .presence import (
+    MemoryPresenceStore,
+    PresenceTracker,
+    encode_member,
+    presence_tracker,
+)
+from .shutdown import graceful_shutdown
+from .sweeper import delete_expired_invites, invite_sweeper
+from .typing import TypingAggregator, typing_aggregator
+from .utils import encode_event
+
+# Every test runs under `QueryBudgetTestRunner`, so a view or handler
+# going over its query budget fails the test with `QueryBudgetExceeded`.
+
+PASSWORD = "correct-horse-battery"
+
+
+def create_user(username, **kwargs):
+    return get_user_model().objects.create_user(
+        username=username,
+        email=f"{username}@example.com",
+        password=PASSWORD,
+        **kwargs,
+    )
+
+
+def store_message(chatroom, user, message):
+    # As stored by `ChatRoomConsumer.store_message`.
+    with transaction.atomic():
+        seq = next_seq(chatroom.pk)
+        return ChatRoomMessage.objects.create(
+            chatroom=chatroom,
+            user=user,
+            message=message,
+            seq=seq,
+            created_seq=seq,
+        )
+
+
+class QueryBudgetTests(TestCase):
+    def run_queries(self, count):
+        for _ in range(count):
+            ChatRoom.objects.count()
+        return None
+
+    def test_within_budget(self):
+        with track("rooms", 2) as tracker:
+            self.run_queries(2)
+        self.assertEqual(len(tracker.queries), 2)
+
+    def test_report_has_sql_and_call_site(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with track("rooms", 1):
+                self.run_queries(2)
+        report = str(raised.exception)
+        self.assertIn("rooms ran 2 queries, over its budget of 1", report)
+        self.assertIn('FROM "chat_chatroom"', report)
+        self.assertIn(f"{__file__}:", report)
+        self.assertIn("in run_queries", report)
+
+    def test_nested_blocks_count_for_both(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with track("outer", 1):
+                with track("inner", 2):
+                    self.run_queries(2)
+        self.assertIn("outer ran 2 queries", str(raised.exception))
+
+    def test_decorated_handler(self):
+        handler = query_budget(0)(self.run_queries)
+        handler(0)
+        with self.assertRaises(QueryBudgetExceeded):
+            handler(1)
+
+    @override_settings(QUERY_BUDGET="log")
+    def test_log_mode(self):
+        with self.assertLogs("woice.query_budget", "WARNING") as logs:
+            with track("rooms", 0):
+                self.run_queries(1)
+        self.assertIn("rooms ran 1 queries", logs.output[0])
+
+
+class ViewTestCase(APITestCase):
+    def setUp(self):
+        # Refresh revoked tokens on every request, the most a request can
+        # be charged for it.
+        patcher = mock.patch.object(revocation_cache, "interval", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The room directory is cached across requests, and tests.
+        cache.clear()
+
+        self.creator = create_user("creator")
+        self.member = create_user("member")
+        self.chatroom = ChatRoom.objects.create(
+            name="General", creator=self.creator
+        )
+        ChatRoomMember.objects.create(chatroom=self.chatroom, user=self.member)
+        self.private = ChatRoom.objects.create(
+            name="Staff", creator=self.creator, type=RoomType.PRIVATE
+        )
+        self.authenticate(self.creator)
+
+    def authenticate(self, user):
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"JWT {AccessToken.for_user(user)}"
+        )
+        return None
+
+    def read(self, message_id):
+        return self.client.post(
+            f"/chat/room/{self.chatroom.pk}/read/",
+            {"message_id": message_id},
+            format="json",
+        )
+
+    def test_read_message_of_another_room(self):
+        store_message(self.chatroom, self.member, "hello")
+        other = store_message(self.private, self.creator, "psst")
+        for message_id in [other.pk, other.pk + 1000]:
+            response = self.read(message_id)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(
+            ChatRoomMember.objects.get(
+                chatroom=self.chatroom, user=self.creator
+            ).last_read_id
+        )
+
+    def test_read_buffered_message(self):
+        stored = store_message(self.chatroom, self.member, "hello")
+        # Not written yet, so read up to the last message stored.
+        with mock.patch.dict(
+            message_buffer.pending_ids, {stored.pk + 1000: self.chatroom.pk}
+        ):
+            response = self.read(stored.pk + 1000)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["data"],
+            {"last_read_id": stored.pk, "unread_count": 0},
+        )
+
+
+class ChatRoomViewSetTests(ViewTestCase):
+    def test_list(self):
+        response = self.client.get("/chat/room/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [room["name"] for room in response.data["results"]], ["General"]
+        )
+
+        cached = self.client.get(
+            "/chat/room/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_retrieve(self):
+        response = self.client.get(f"/chat/room/{self.chatroom.pk}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["member_count"], 2)
+
+    def test_create(self):
+        response = self.client.post(
+            "/chat/room/", {"name": "Random"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(
+            ChatRoomMember.objects.filter(
+                chatroom_id=response.data["data"]["id"],
+                user=self.creator,
+                is_admin=True,
+            ).exists()
+        )
+
+    def test_update(self):
+        response = self.client.put(
+            f"/chat/room/{self.chatroom.pk}/",
+            {"name": "Renamed", "type": RoomType.PUBLIC},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_partial_update(self):
+        response = self.client.patch(
+            f"/chat/room/{self.chatroom.pk}/",
+            {"name": "Renamed"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.chatroom.refresh_from_db()
+        self.assertEqual(self.chatroom.name, "Renamed")
+
+    def test_destroy_private_room(self):
+        # Private rooms aren't in the directory the viewset serves.
+        response = self.client.delete(f"/chat/room/{self.private.pk}/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invite(self):
+        response = self.client.post(
+            f"/chat/room/{self.private.pk}/invite/",
+            {"recipients": ["guest@example.com", "GUEST@example.com"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(mail.outbox), 1)
+
+        pending = self.client.post(
+            f"/chat/room/{self.private.pk}/invite/",
+            {"recipients": ["guest@example.com"]},
+            format="json",
+        )
+        self.assertEqual(pending.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invite_requires_admin(self):
+        self.authenticate(self.member)
+        response = self.client.post(
+            f"/chat/room/{self.private.pk}/invite/",
+            {"recipients": ["guest@example.com"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_make_admin(self):
+        response = self.client.post(
+            f"/chat/room/{self.chatroom.pk}/make_admin/",
+            {"user_id": self.member.pk, "make_admin": True},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(
+            ChatRoomMember.objects.get(
+                chatroom=self.chatroom, user=self.member
+            ).is_admin
+        )
+
+    def test_mine(self):
+        store_message(self.chatroom, self.member, "hello")
+        store_message(self.chatroom, self.member, "anyone?")
+
+        response = self.client.get("/chat/room/mine/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        unread = {
+            membership["room"]["name"]: membership["unread_count"]
+            for membership in response.data["data"]
+        }
+        self.assertEqual(unread, {"General": 2, "Staff": 0})
+
+    def test_read(self):
+        first = store_message(self.chatroom, self.member, "hello")
+        store_message(self.chatroom, self.member, "anyone?")
+
+        response = self.client.post(
+            f"/chat/room/{self.chatroom.pk}/read/",
+            {"message_id": first.pk},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["data"],
+            {"last_read_id": first.pk, "unread_count": 1},
+        )
+
+    def test_read_counts_deleted_messages(self):
+        first = store_message(self.chatroom, self.member, "hello")
+        second = store_message(self.chatroom, self.member, "anyone?")
+        self.client.post(
+            f"/chat/room/{self.chatroom.pk}/read/",
+            {"message_id": first.pk},
+            format="json",
+        )
+        # Tombstoned as by `ChatRoomConsumer.remove_message`, after the
+        # message read was counted.
+        for message in [first, second]:
+            with transaction.atomic():
+                ChatRoomMessage.objects.filter(pk=message.pk).update(
+                    message="", deleted=True, seq=next_seq(self.chatroom.pk)
+                )
+                record_delete(message)
+
+        response = self.client.get("/chat/room/mine/")
+        unread = {
+            membership["room"]["name"]: membership["unread_count"]
+            for membership in response.data["data"]
+        }
+        self.assertEqual(unread["General"], 0)
+
+
+class RoomContextTests(ViewTestCase):
+    def request(self, user):
+        return SimpleNamespace(user=user)
+
+    def test_room_is_loaded_once(self):
+        request = self.request(self.member)
+        with self.assertNumQueries(1):
+            chatroom = get_room(request, str(self.chatroom.pk))
+            self.assertIs(get_room(request, str(self.chatroom.pk)), chatroom)
+        self.assertEqual(chatroom.creator, self.creator)
+        self.assertTrue(chatroom.is_member)
+        self.assertFalse(chatroom.is_admin)
+
+    def test_missing_rooms(self):
+        request = self.request(self.member)
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_room(request, str(uuid.uuid4())))
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_room(request, "not-a-room"))
+
+    def test_make_admin_loads_room_once(self):
+        # Authentication, the room with the caller's admin status shared by
+        # the permission and the view, the member, then saving it.
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                f"/chat/room/{self.chatroom.pk}/make_admin/",
+                {"user_id": self.member.pk, "make_admin": True},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_admin_actions_on_missing_rooms(self):
+        for pk in [uuid.uuid4(), "not-a-room"]:
+            response = self.client.post(
+                f"/chat/room/{pk}/make_admin/",
+                {"user_id": self.member.pk, "make_admin": True},
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RoomDirectoryTests(ViewTestCase):
+    def test_constant_query_count(self):
+        # Authentication (revocations, then the user), then counting and
+        # listing the rooms with their creators, however many there are.
+        with self.assertNumQueries(4):
+            self.client.get("/chat/room/")
+        for number in range(5):
+            ChatRoom.objects.create(
+                name=f"Room {number}", creator=create_user(f"user{number}")
+            )
+        cache.clear()
+        with self.assertNumQueries(4):
+            response = self.client.get("/chat/room/")
+        self.assertEqual(len(response.data["results"]), 6)
+
+    def test_cached_across_users(self):
+        response = self.client.get("/chat/room/")
+        self.authenticate(self.member)
+        with self.assertNumQueries(2):
+            cached = self.client.get("/chat/room/")
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached["ETag"], response["ETag"])
+
+    def test_room_changes_invalidate(self):
+        response = self.client.get(f"/chat/room/{self.chatroom.pk}/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                f"/chat/room/{self.chatroom.pk}/",
+                {"name": "Renamed"},
+                format="json",
+            )
+
+        changed = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/",
+            HTTP_IF_NONE_MATCH=response["ETag"],
+        )
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertEqual(changed.data["name"], "Renamed")
+        self.assertNotEqual(changed["ETag"], response["ETag"])
+
+    def test_counters_invalidate(self):
+        # Counters are kept with `F()` updates, which send no `post_save`.
+        path = f"/chat/room/{self.chatroom.pk}/"
+        self.client.get(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            store_message(self.chatroom, self.member, "hello")
+        response = self.client.get(path)
+        self.assertEqual(response.data["message_count"], 1)
+        self.assertEqual(response.data["last_message_preview"], "hello")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatRoomMember.objects.create(
+                chatroom=self.chatroom, user=create_user("newcomer")
+            )
+        changed = self.client.get(path, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertEqual(changed.data["member_count"], 3)
+
+    def test_errors_are_not_cached(self):
+        path = f"/chat/room/{self.private.pk}/"
+        self.assertEqual(
+            self.client.get(path).status_code, status.HTTP_404_NOT_FOUND
+        )
+        with self.assertNumQueries(3):
+            self.client.get(path)
+
+
+class InviteTests(ViewTestCase):
+    def invite(self, recipients):
+        response = self.client.post(
+            f"/chat/room/{self.private.pk}/invite/",
+            {"recipients": recipients},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_constant_query_count(self):
+        # Authentication (revocations, then the user), the room with the
+        # caller's admin status, pending invites, and deleting used ones
+        # before inserting the new ones, whatever the number of recipients.
+        for recipients in [
+            ["guest@example.com"],
+            [f"guest{number}@example.com" for number in range(20)],
+        ]:
+            with self.assertNumQueries(6):
+                self.invite(recipients)
+        self.assertEqual(
+            InviteLink.objects.filter(chatroom=self.private).count(), 21
+        )
+
+    def test_skips_pending_invites(self):
+        self.invite(["guest@example.com"])
+        self.invite(["GUEST@example.com", "other@example.com"])
+        self.assertEqual(
+            sorted(
+                InviteLink.objects.filter(chatroom=self.private).values_list(
+                    "email", flat=True
+                )
+            ),
+            ["guest@example.com", "other@example.com"],
+        )
+        self.assertEqual(mail.outbox[-1].to, ["other@example.com"])
+
+    def test_replaces_used_invites(self):
+        InviteLink.objects.create(
+            chatroom=self.private, email="guest@example.com", has_expired=True
+        )
+        self.invite(["guest@example.com"])
+        invite = InviteLink.objects.get(
+            chatroom=self.private, email="guest@example.com"
+        )
+        self.assertFalse(invite.has_expired)
+
+    def test_public_room(self):
+        response = self.client.post(
+            f"/chat/room/{self.chatroom.pk}/invite/",
+            {"recipients": ["guest@example.com"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RoomViewTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            presence_tracker, "store", MemoryPresenceStore()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.outsider = create_user("outsider")
+        self.messages = [
+            store_message(self.chatroom, self.member, text)
+            for text in ["hello", "the quick brown fox", "anyone?"]
+        ]
+
+    def test_member_search(self):
+        response = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/search/", {"q": "mem", "limit": 1}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [member["user"]["username"] for member in response.data["results"]],
+            ["member"],
+        )
+
+    def test_member_search_similar_usernames(self):
+        response = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/search/", {"q": "membr"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(
+            "member",
+            [member["user"]["username"] for member in response.data["results"]],
+        )
+
+    def test_member_search_malformed_room(self):
+        response = self.client.get("/chat/room/general/search/", {"q": "mem"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_messages(self):
+        url = f"/chat/room/{self.chatroom.pk}/messages/"
+        newest = self.client.get(url, {"page_size": 2})
+        self.assertEqual(newest.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in newest.data["results"]],
+            [self.messages[2].pk, self.messages[1].pk],
+        )
+
+        older = self.client.get(
+            url, {"page_size": 2, "before": self.messages[1].pk}
+        )
+        self.assertEqual(older.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in older.data["results"]],
+            [self.messages[0].pk],
+        )
+
+    def test_messages_from_history_cache(self):
+        room = str(self.chatroom.pk)
+        history_cache.subscribe(room)
+        self.addCleanup(history_cache.unsubscribe, room)
+        url = f"/chat/room/{room}/messages/"
+
+        response = self.client.get(url)
+        # Only authentication queries once the page is cached.
+        with self.assertNumQueries(2):
+            cached = self.client.get(url)
+        self.assertEqual(cached.data, response.data)
+
+    def test_messages_malformed_room(self):
+        response = self.client.get("/chat/room/general/messages/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_message_changes(self):
+        response = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/messages/changes/",
+            {"since": self.messages[0].seq},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]],
+            [self.messages[1].pk, self.messages[2].pk],
+        )
+        self.assertEqual(response.data["seq"], self.messages[2].seq)
+
+    def test_message_changes_include_edits_and_deletes(self):
+        edited, deleted, last = self.messages
+        # As by `ChatRoomConsumer.replace_message` and `remove_message`.
+        with transaction.atomic():
+            edited.message = "hello again"
+            edited.edited = True
+            edited.seq = next_seq(self.chatroom.pk)
+            edited.save(update_fields=["message", "edited", "seq"])
+        with transaction.atomic():
+            ChatRoomMessage.objects.filter(pk=deleted.pk).update(
+                message="", deleted=True, seq=next_seq(self.chatroom.pk)
+            )
+
+        response = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/messages/changes/",
+            {"since": last.seq},
+        )
+        changes = response.data["results"]
+        self.assertEqual(
+            [change["id"] for change in changes], [edited.pk, deleted.pk]
+        )
+        self.assertEqual(changes[0]["message"], "hello again")
+        self.assertTrue(changes[1]["deleted"])
+        self.assertEqual(changes[1]["message"], "")
+        self.assertEqual(response.data["seq"], changes[1]["seq"])
+
+        history = self.client.get(f"/chat/room/{self.chatroom.pk}/messages/")
+        self.assertNotIn(
+            deleted.pk, [message["id"] for message in history.data["results"]]
+        )
+
+    def test_message_changes_members_only(self):
+        self.authenticate(self.outsider)
+        response = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/messages/changes/", {"since": 0}
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_online_members(self):
+        response = self.client.get(f"/chat/room/{self.chatroom.pk}/online/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["data"], [])
+
+    def test_message_search(self):
+        response = self.client.get("/chat/messages/search/", {"q": "fox"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]],
+            [self.messages[1].pk],
+        )
+
+        self.authenticate(self.outsider)
+        response = self.client.get(
+            f"/chat/room/{self.chatroom.pk}/messages/search/", {"q": "fox"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"], [])
+
+    def test_message_search_follows_edits(self):
+        # The search vector is kept current by a trigger.
+        message = self.messages[1]
+        message.message = "the lazy dog"
+        message.save(update_fields=["message"])
+
+        url = f"/chat/room/{self.chatroom.pk}/messages/search/"
+        for query, found in [("fox", []), ("dogs", [message.pk])]:
+            response = self.client.get(url, {"q": query})
+            self.assertEqual(
+                [result["id"] for result in response.data["results"]], found
+            )
+
+    def test_message_search_malformed_room(self):
+        for params in [{"q": "fox"}, {}]:
+            response = self.client.get(
+                "/chat/room/general/messages/search/", params
+            )
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_metrics(self):
+        response = self.client.get("/chat/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.authenticate(create_user("staff", is_staff=True))
+        response = self.client.get("/chat/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("db_pool", response.data["data"])
+
+    def test_room_page(self):
+        response = self.client.get(f"/chat/chatroom/{self.chatroom.pk}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class MemberSearchTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        for username in ["member2", "member3"]:
+            ChatRoomMember.objects.create(
+                chatroom=self.chatroom, user=create_user(username)
+            )
+        self.url = f"/chat/room/{self.chatroom.pk}/search/"
+
+    def usernames(self, response):
+        return [
+            member["user"]["username"] for member in response.data["results"]
+        ]
+
+    def test_prefix_matches_first(self):
+        # Authentication, then prefix matches, which fill the results
+        # without a trigram lookup.
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {"q": "MEM", "limit": 3})
+        self.assertEqual(
+            self.usernames(response), ["member", "member2", "member3"]
+        )
+
+    @override_settings(MEMBER_SEARCH_LIMIT=2)
+    def test_limit_is_capped(self):
+        response = self.client.get(self.url, {"q": "mem", "limit": 50})
+        self.assertEqual(self.usernames(response), ["member", "member2"])
+
+    def test_empty_query(self):
+        response = self.client.get(self.url, {"q": " "})
+        self.assertEqual(response.data, {"results": []})
+
+
+class MessagePaginationTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = f"/chat/room/{self.chatroom.pk}/messages/"
+        self.messages = [
+            store_message(self.chatroom, self.member, f"message {number}")
+            for number in range(12)
+        ]
+
+    def ids(self, response):
+        return [message["id"] for message in response.data["results"]]
+
+    def test_pages_follow_links(self):
+        newest = self.client.get(self.url, {"page_size": 5})
+        self.assertEqual(
+            self.ids(newest), [message.pk for message in self.messages[:6:-1]]
+        )
+        self.assertIsNone(newest.data["previous"])
+
+        older = self.client.get(newest.data["next"])
+        self.assertEqual(
+            self.ids(older), [message.pk for message in self.messages[6:1:-1]]
+        )
+
+        newer = self.client.get(older.data["previous"])
+        self.assertEqual(self.ids(newer), self.ids(newest))
+        self.assertIsNone(newer.data["previous"])
+
+    def test_oldest_page(self):
+        response = self.client.get(
+            self.url, {"page_size": 5, "before": self.messages[2].pk}
+        )
+        self.assertEqual(
+            self.ids(response), [self.messages[1].pk, self.messages[0].pk]
+        )
+        self.assertIsNone(response.data["next"])
+
+    def test_before_and_after(self):
+        response = self.client.get(
+            self.url,
+            {"before": self.messages[5].pk, "after": self.messages[1].pk},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_page_number(self):
+        response = self.client.get(self.url, {"page": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 12)
+        self.assertEqual(
+            self.ids(response), [self.messages[1].pk, self.messages[0].pk]
+        )
+
+
+class ArchivedMessageTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(MESSAGE_ARCHIVE_DIR=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        # Parsed chunks are cached by path, which tests share.
+        patcher = mock.patch.object(
+            archive_reader, "chunks", TTLCache(maxsize=16, ttl=60)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.url = f"/chat/room/{self.chatroom.pk}/messages/"
+        self.messages = [
+            store_message(self.chatroom, self.member, f"message {number}")
+            for number in range(6)
+        ]
+        self.archive(self.messages[:4])
+
+    def archive(self, messages):
+        # As `chat.archive.archive_partition` does, two messages per chunk.
+        last_month = timezone.now() - timedelta(days=40)
+        for offset, message in enumerate(messages):
+            message.created = last_month + timedelta(seconds=offset)
+            ChatRoomMessage.objects.filter(pk=message.pk).update(
+                created=message.created
+            )
+        rows = [
+            list(row)
+            for row in ChatRoomMessage.objects.filter(
+                pk__in=[message.pk for message in messages]
+            )
+            .order_by("created", "id")
+            .values_list(*FIELDS)
+        ]
+        path = f"{self.chatroom.pk}.jsonl.gz"
+        chunks = write_archive(
+            os.path.join(settings.MESSAGE_ARCHIVE_DIR, path), rows, 2
+        )
+        MessageArchive.objects.create(
+            chatroom=self.chatroom,
+            path=path,
+            chunks=chunks,
+            start=last_month,
+            end=timezone.now(),
+            first_id=rows[0][0],
+            last_id=rows[-1][0],
+            message_count=len(rows),
+        )
+        ChatRoomMessage.objects.filter(
+            pk__in=[message.pk for message in messages]
+        ).delete()
+        return None
+
+    def ids(self, response):
+        return [message["id"] for message in response.data["results"]]
+
+    def test_pages_continue_into_archives(self):
+        newest = self.client.get(self.url, {"page_size": 3})
+        self.assertEqual(
+            self.ids(newest), [message.pk for message in self.messages[:2:-1]]
+        )
+        self.assertEqual(newest.data["results"][-1]["message"], "message 3")
+
+        older = self.client.get(newest.data["next"])
+        self.assertEqual(
+            self.ids(older), [message.pk for message in self.messages[2::-1]]
+        )
+        self.assertIsNone(older.data["next"])
+
+    def test_newer_pages_start_in_archives(self):
+        response = self.client.get(
+            self.url, {"page_size": 3, "after": self.messages[1].pk}
+        )
+        self.assertEqual(
+            self.ids(response),
+            [message.pk for message in self.messages[4:1:-1]],
+        )
+
+    def test_only_needed_chunks_are_read(self):
+        with mock.patch.object(
+            archive_reader, "load", wraps=archive_reader.load
+        ) as load:
+            response = self.client.get(
+                self.url, {"page_size": 1, "before": self.messages[2].pk}
+            )
+        self.assertEqual(self.ids(response), [self.messages[1].pk])
+        # The anchor is located in its chunk, and the page read from the
+        # chunk before it only.
+        chunks = MessageArchive.objects.get(chatroom=self.chatroom).chunks
+        self.assertEqual(
+            [call.args[1] for call in load.call_args_list],
+            [chunks[1][0], chunks[0][0]],
+        )
+
+    def test_archived_changes_are_gone(self):
+        ChatRoom.objects.filter(pk=self.chatroom.pk).update(
+            archived_seq=self.messages[3].seq
+        )
+        url = f"{self.url}changes/"
+        response = self.client.get(url, {"since": self.messages[2].seq})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        response = self.client.get(url, {"since": self.messages[3].seq})
+        self.assertEqual(
+            self.ids(response), [message.pk for message in self.messages[4:]]
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+    }
+)
+class ChatRoomConsumerTests(TransactionTestCase):
+    def setUp(self):
+        for target, attribute, value in [
+            (presence_tracker, "store", MemoryPresenceStore()),
+            # Presence diffs would otherwise interleave with the frames the
+            # tests wait for.
+            (presence_tracker, "interval", 60),
+            (
+                event_log,
+                "store",
+                MemoryEventLogStore(
+                    size=settings.EVENT_LOG_SIZE, ttl=settings.EVENT_LOG_TTL
+                ),
+            ),
+            # Handlers query from the pool's threads, whose connections
+            # must not outlive the test database.
+            (pool, "max_age", 0),
+            (graceful_shutdown, "draining", False),
+            (graceful_shutdown, "sockets", set()),
+        ]:
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.creator = create_user("creator")
+        self.member = create_user("member")
+        self.chatroom = ChatRoom.objects.create(
+            name="General", creator=self.creator
+        )
+        self.private = ChatRoom.objects.create(
+            name="Staff", creator=self.creator, type=RoomType.PRIVATE
+        )
+
+    async def connect(self, user=None, chatroom=None, query=""):
+        chatroom = chatroom or self.chatroom
+        path = f"/ws/chat/{chatroom.pk}/?token="
+        if user is not None:
+            path += str(AccessToken.for_user(user))
+        communicator = WebsocketCommunicator(application, path + query)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def rejoin(self, user, query=""):
+        # Connect `user`, a member of the room already.
+        communicator = await self.connect(user, query=query)
+        self.assertEqual(
+            await communicator.receive_json_from(), {"message": "Welcome back!"}
+        )
+        return communicator
+
+    async def close(self, *communicators):
+        for communicator in communicators:
+            await communicator.disconnect()
+        # The background tasks belong to the event loop of this test.
+        await presence_tracker.stop()
+        await typing_aggregator.stop()
+        return None
+
+    async def test_connect_joins_room(self):
+        communicator = await self.connect(self.member)
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertTrue(
+            await database_sync_to_async(
+                ChatRoomMember.objects.filter(
+                    chatroom=self.chatroom, user=self.member
+                ).exists
+            )()
+        )
+
+        again = await self.connect(self.member)
+        self.assertEqual(
+            await again.receive_json_from(), {"message": "Welcome back!"}
+        )
+        await self.close(communicator, again)
+
+    async def test_connect_requires_login(self):
+        communicator = await self.connect()
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"message": "You must login to continue!"},
+        )
+        self.assertEqual(
+            await communicator.receive_output(),
+            {"type": "websocket.close", "code": 4001},
+        )
+        await self.close(communicator)
+
+    async def test_connect_private_room_requires_invite(self):
+        communicator = await self.connect(self.member, self.private)
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"message": "You need an invite to join this group!"},
+        )
+        self.assertEqual(
+            await communicator.receive_output(),
+            {"type": "websocket.close", "code": 4001},
+        )
+        await self.close(communicator)
+
+    async def test_connect_private_room_with_invite(self):
+        invite = await database_sync_to_async(InviteLink.objects.create)(
+            chatroom=self.private, email=self.member.email
+        )
+        communicator = await self.connect(self.member, self.private)
+        self.assertTrue(await communicator.receive_nothing())
+
+        await database_sync_to_async(invite.refresh_from_db)()
+        self.assertTrue(invite.has_expired)
+        await self.close(communicator)
+
+    async def test_connect_unknown_room(self):
+        for room in [uuid.uuid4(), "general"]:
+            communicator = WebsocketCommunicator(
+                application,
+                f"/ws/chat/{room}/?token={AccessToken.for_user(self.member)}",
+            )
+            await communicator.connect()
+            self.assertEqual(
+                await communicator.receive_json_from(),
+                {"message": "Chatroom doesn't exist!"},
+            )
+            await self.close(communicator)
+
+    async def test_handshake_cache(self):
+        for handshake_cache in [room_cache, membership_cache]:
+            patcher = mock.patch.object(handshake_cache, "ttl", 60)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+            self.addCleanup(handshake_cache.clear)
+
+        consumer = ChatRoomConsumer()
+        room_id = str(self.chatroom.pk)
+        chatroom, joined = await consumer.join_room(room_id, self.member)
+        self.assertEqual(chatroom, self.chatroom)
+        self.assertTrue(joined)
+
+        # Returning members are let in without a query.
+        with track("join_room", 0):
+            chatroom, joined = await consumer.join_room(room_id, self.member)
+        self.assertEqual(chatroom, self.chatroom)
+        self.assertFalse(joined)
+
+    async def test_new_message(self):
+        await database_sync_to_async(ChatRoomMember.objects.create)(
+            chatroom=self.chatroom, user=self.member
+        )
+        sender = await self.rejoin(self.creator)
+        # Returning members are only welcomed once subscribed to the room.
+        receiver = await self.rejoin(self.member)
+        await sender.send_json_to(
+            {"type": "NEW_MESSAGE", "message": "hello", "username": "creator"}
+        )
+
+        for communicator in [sender, receiver]:
+            frame = await communicator.receive_json_from(timeout=10)
+            self.assertEqual(frame["type"], "NEW_MESSAGE")
+            self.assertEqual(frame["message"], "hello")
+        message = await database_sync_to_async(ChatRoomMessage.objects.get)(
+            pk=frame["message_id"]
+        )
+        self.assertEqual(message.seq, frame["seq"])
+        self.assertEqual(message.created_seq, frame["seq"])
+        await self.close(sender, receiver)
+
+    @override_settings(MESSAGE_PERSISTENCE="batched")
+    async def test_new_message_with_full_buffer(self):
+        sender = await self.rejoin(self.creator)
+        with mock.patch.object(message_buffer, "max_pending", 0):
+            await sender.send_json_to(
+                {"type": "NEW_MESSAGE", "message": "hello"}
+            )
+            frame = await sender.receive_json_from(timeout=10)
+
+        # Written before it was broadcast.
+        self.assertEqual(message_buffer.pending, [])
+        message = await database_sync_to_async(ChatRoomMessage.objects.get)(
+            pk=frame["message_id"]
+        )
+        self.assertEqual(message.message, "hello")
+        await self.close(sender)
+
+    async def test_edit_message(self):
+        message = await database_sync_to_async(store_message)(
+            self.chatroom, self.creator, "hello"
+        )
+        communicator = await self.rejoin(self.creator)
+        await communicator.send_json_to(
+            {
+                "type": "EDIT_MESSAGE",
+                "message": "hello, world",
+                "username": "creator",
+                "message_id": message.pk,
+            }
+        )
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "EDIT_MESSAGE")
+        await database_sync_to_async(message.refresh_from_db)()
+        self.assertEqual(message.message, "hello, world")
+        self.assertEqual(message.seq, frame["seq"])
+        self.assertTrue(message.edited)
+        await self.close(communicator)
+
+    async def test_edit_missing_message(self):
+        communicator = await self.rejoin(self.creator)
+        await communicator.send_json_to(
+            {"type": "EDIT_MESSAGE", "message": "hello", "message_id": 1}
+        )
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"message": "Message doesn't exist!"},
+        )
+        await self.close(communicator)
+
+    async def test_delete_message(self):
+        message = await database_sync_to_async(store_message)(
+            self.chatroom, self.creator, "hello"
+        )
+        communicator = await self.rejoin(self.creator)
+        await communicator.send_json_to(
+            {"type": "DELETE_MESSAGE", "message_id": message.pk}
+        )
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "DELETE_MESSAGE")
+        await database_sync_to_async(message.refresh_from_db)()
+        self.assertTrue(message.deleted)
+        self.assertEqual(message.seq, frame["seq"])
+        await self.close(communicator)
+
+    async def test_replay(self):
+        sender = await self.rejoin(self.creator)
+        for text in ["first", "second"]:
+            await sender.send_json_to({"type": "NEW_MESSAGE", "message": text})
+        first = await sender.receive_json_from()
+        await sender.receive_json_from()
+
+        communicator = await self.rejoin(
+            self.creator, query=f"&last_event_id={first['event_id']}"
+        )
+        replayed = await communicator.receive_json_from()
+        self.assertEqual(replayed["message"], "second")
+        await self.close(sender, communicator)
+
+    async def test_replay_of_evicted_events(self):
+        communicator = await self.rejoin(
+            self.creator, query="&last_event_id=1-0"
+        )
+        self.assertEqual(
+            (await communicator.receive_json_from())["type"], "RESYNC"
+        )
+        await self.close(communicator)
+
+    async def test_typing(self):
+        typist = await self.connect(self.member)
+        watcher = await self.rejoin(self.creator)
+        await typist.send_json_to({"type": "TYPING"})
+
+        frame = await watcher.receive_json_from(
+            timeout=settings.TYPING_INTERVAL + 1
+        )
+        self.assertEqual(frame["type"], "TYPING")
+        self.assertEqual(frame["usernames"], ["member"])
+        # Typists aren't told about themselves.
+        self.assertTrue(await typist.receive_nothing())
+        await self.close(typist, watcher)
+
+    async def test_server_shutdown(self):
+        communicator = await self.rejoin(self.creator)
+        self.assertEqual(await graceful_shutdown.drain(timeout=1), 0)
+        self.assertEqual(
+            (await communicator.receive_json_from())["type"], "RECONNECT"
+        )
+        self.assertEqual(
+            await communicator.receive_output(),
+            {"type": "websocket.close", "code": 1012},
+        )
+        await self.close(communicator)
+
+    async def test_connect_while_draining(self):
+        graceful_shutdown.draining = True
+        communicator = await self.connect(self.creator)
+        self.assertEqual(
+            (await communicator.receive_json_from())["type"], "RECONNECT"
+        )
+        self.assertEqual(
+            await communicator.receive_output(),
+            {"type": "websocket.close", "code": 1012},
+        )
+        await self.close(communicator)
+
+
+class ConnectionPoolTests(TransactionTestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(
+            size=1, max_age=600, health_check_interval=30
+        )
+        self.addCleanup(self.pool.executor.shutdown)
+        patcher = mock.patch("woice.db.pool", self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def count(self, times=1):
+        for _ in range(times):
+            await database_sync_to_async(ChatRoom.objects.count)()
+        return None
+
+    async def close(self):
+        # The pool's connections must not outlive the test database.
+        self.pool.max_age = 0
+        await database_sync_to_async(lambda: None)()
+        return None
+
+    async def test_connections_are_reused(self):
+        await self.count(3)
+        stats = self.pool.stats()
+        self.assertEqual((stats["calls"], stats["connects"]), (3, 1))
+        await self.close()
+
+    async def test_connections_closed_without_max_age(self):
+        self.pool.max_age = 0
+        await self.count(2)
+        self.assertEqual(self.pool.stats()["connects"], 2)
+
+    async def test_broken_connections_are_replaced(self):
+        self.pool.health_check_interval = 0
+        await self.count()
+        # Closed behind Django's back, as by a database restart.
+        await database_sync_to_async(lambda: connection.connection.close())()
+        await self.count()
+        stats = self.pool.stats()
+        self.assertEqual(stats["health_check_failures"], 1)
+        self.assertEqual(stats["connects"], 2)
+        await self.close()
+
+
+class MessageBufferTests(TransactionTestCase):
+    def setUp(self):
+        # Written from the pool's threads, whose connections must not
+        # outlive the test database.
+        patcher = mock.patch.object(pool, "max_age", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = create_user("member")
+        self.chatroom = ChatRoom.objects.create(
+            name="General", creator=self.user
+        )
+        self.buffer = MessageBuffer(
+            batch_size=2, flush_interval=60, max_retries=1, max_pending=3
+        )
+
+    async def add(self, *texts, user=None):
+        return [
+            await self.buffer.add(self.chatroom, user or self.user, text)
+            for text in texts
+        ]
+
+    async def stored(self):
+        return await database_sync_to_async(
+            lambda: list(
+                ChatRoomMessage.objects.order_by("id").values_list(
+                    "id", "message", "created", "created_seq"
+                )
+            )
+        )()
+
+    async def test_full_batch_is_written(self):
+        added = await self.add("hello", "anyone?")
+
+        self.assertEqual(self.buffer.pending, [])
+        self.assertEqual(
+            await self.stored(),
+            [
+                (message.id, message.message, message.created, seq)
+                for seq, message in enumerate(added, 1)
+            ],
+        )
+        await database_sync_to_async(self.chatroom.refresh_from_db)()
+        self.assertEqual(self.chatroom.message_count, 2)
+        self.assertEqual(self.chatroom.last_message_id, added[-1].id)
+
+    async def test_failed_flush_is_retried(self):
+        write = self.buffer.write
+        attempts = []
+
+        def flaky_write(batch):
+            attempts.append(batch)
+            if len(attempts) == 1:
+                raise OperationalError("database is down")
+            return write(batch)
+
+        with mock.patch.object(self.buffer, "write", flaky_write):
+            (message,) = await self.add("hello")
+            await self.buffer.flush()
+            self.assertEqual(self.buffer.pending, [message])
+            await self.buffer.flush()
+
+        self.assertEqual(self.buffer.pending, [])
+        self.assertEqual(self.buffer.pending_ids, {})
+        self.assertEqual(len(await self.stored()), 1)
+
+    async def test_batch_is_dropped_after_retries(self):
+        with mock.patch.object(
+            self.buffer,
+            "write",
+            side_effect=OperationalError("database is down"),
+        ):
+            await self.add("hello")
+            for _ in range(self.buffer.max_retries + 1):
+                await self.buffer.flush()
+
+        self.assertEqual(self.buffer.pending, [])
+        self.assertEqual(self.buffer.pending_ids, {})
+        self.assertEqual(self.buffer.failures, 0)
+
+    async def test_bad_row_is_dropped(self):
+        missing = get_user_model()(pk=self.user.pk + 1000)
+        (bad,) = await self.add("hello", user=missing)
+        (good,) = await self.add("anyone?")
+
+        self.assertEqual(
+            [message_id for message_id, *_ in await self.stored()], [good.id]
+        )
+
+    async def test_full_buffer(self):
+        self.buffer.batch_size = 10
+        await self.add("one", "two", "three")
+        with self.assertRaises(MessageBufferFull):
+            await self.add("four")
+        await self.buffer.flush()
+        self.assertEqual(len(await self.stored()), 3)
+
+    async def test_shutdown_writes_buffered_messages(self):
+        await self.add("one")
+        with mock.patch("chat.shutdown.message_buffer", self.buffer):
+            await graceful_shutdown.stop()
+        self.assertEqual(
+            [message for _, message, _, _ in await self.stored()], ["one"]
+        )
+        self.assertEqual(self.buffer.pending, [])
+
+
+class InviteSweeperTests(TestCase):
+    def setUp(self):
+        creator = create_user("creator")
+        chatroom = ChatRoom.objects.create(
+            name="Staff", creator=creator, type=RoomType.PRIVATE
+        )
+        past = timezone.now() - timedelta(minutes=1)
+        InviteLink.objects.bulk_create(
+            [
+                InviteLink(
+                    chatroom=chatroom,
+                    email=f"old{number}@example.com",
+                    expires=past,
+                )
+                for number in range(5)
+            ]
+            + [
+                InviteLink(
+                    chatroom=chatroom,
+                    email=f"used{number}@example.com",
+                    has_expired=True,
+                )
+                for number in range(2)
+            ]
+            + [
+                InviteLink(chatroom=chatroom, email=f"new{number}@example.com")
+                for number in range(3)
+            ]
+        )
+
+    def test_deletes_in_batches(self):
+        # A query for the ids and one deleting them per batch of 3.
+        with self.assertNumQueries(6):
+            self.assertEqual(delete_expired_invites(batch_size=3), 7)
+        self.assertEqual(
+            sorted(InviteLink.objects.values_list("email", flat=True)),
+            [f"new{number}@example.com" for number in range(3)],
+        )
+
+    def test_max_batches(self):
+        self.assertEqual(delete_expired_invites(batch_size=3, max_batches=1), 3)
+        self.assertEqual(InviteLink.objects.count(), 7)
+
+    async def test_lifespan_starts_sweeper(self):
+        messages = [
+            {"type": "lifespan.startup"},
+            {"type": "lifespan.shutdown"},
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            if message["type"] == "lifespan.startup.complete":
+                self.assertIsNotNone(invite_sweeper.task)
+            sent.append(message["type"])
+
+        with mock.patch.object(invite_sweeper, "interval", 60):
+            await graceful_shutdown.lifespan(
+                {"type": "lifespan"}, receive, send
+            )
+
+        self.assertEqual(
+            sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+        )
+        self.assertIsNone(invite_sweeper.task)
+
+
+class EventLogTests(SimpleTestCase):
+    def setUp(self):
+        self.log = EventLog(
+            store=MemoryEventLogStore(size=3, ttl=60), size=3, ttl=60
+        )
+
+    async def append(self, *texts):
+        return [
+            await self.log.append("room", {"message": text}) for text in texts
+        ]
+
+    async def test_replays_missed_events(self):
+        first, second, third = await self.append("a", "b", "c")
+        replayed = await self.log.replay("room", first)
+        self.assertEqual(
+            [event_id for event_id, _ in replayed], [second, third]
+        )
+        self.assertEqual(
+            json.loads(replayed[0][1]), {"message": "b", "event_id": second}
+        )
+        self.assertEqual(await self.log.replay("room", third), [])
+
+    async def test_evicted_events_need_resync(self):
+        first, *_ = await self.append("a", "b", "c", "d")
+        self.assertIsNone(await self.log.replay("room", first))
+
+    async def test_expired_events_need_resync(self):
+        first, *_ = await self.append("a", "b")
+        with mock.patch("time.time", return_value=time.time() + 61):
+            self.assertIsNone(await self.log.replay("room", first))
+
+    async def test_malformed_event_id(self):
+        await self.append("a")
+        self.assertIsNone(await self.log.replay("room", "not-an-id"))
+
+    async def test_disabled(self):
+        self.log.size = 0
+        self.assertEqual(await self.append("a"), [None])
+        self.assertIsNone(await self.log.replay("room", "1-0"))
+
+
+class TypingAggregatorTests(SimpleTestCase):
+    def setUp(self):
+        self.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch(
+            "chat.typing.get_channel_layer", return_value=self.channel_layer
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.aggregator = TypingAggregator(interval=60, ttl=60)
+
+    def sent(self):
+        states = [
+            (room, event["usernames"])
+            for (room, event), _ in self.channel_layer.group_send.call_args_list
+        ]
+        self.channel_layer.group_send.reset_mock()
+        return states
+
+    async def test_coalesces_typing(self):
+        for _ in range(3):
+            self.aggregator.typing("room", "socket", "member")
+        await self.aggregator.flush()
+        self.assertEqual(self.sent(), [("room", ["member"])])
+
+        # Nothing changed since.
+        self.aggregator.typing("room", "socket", "member")
+        await self.aggregator.flush()
+        self.assertEqual(self.sent(), [])
+        await self.aggregator.stop()
+
+    async def test_typists_per_socket(self):
+        self.aggregator.typing("room", "tab", "member")
+        self.aggregator.typing("room", "other tab", "member")
+        await self.aggregator.flush()
+        self.sent()
+
+        # Still typing in the other tab.
+        self.aggregator.not_typing("room", "tab")
+        await self.aggregator.flush()
+        self.assertEqual(self.sent(), [])
+
+        self.aggregator.not_typing("room", "other tab")
+        await self.aggregator.flush()
+        self.assertEqual(self.sent(), [("room", [])])
+        await self.aggregator.stop()
+
+    async def test_typists_expire(self):
+        self.aggregator.ttl = 0
+        self.aggregator.typing("room", "socket", "member")
+        await self.aggregator.flush()
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(self.aggregator.rooms, {})
+        await self.aggregator.stop()
+
+
+class BroadcastTests(SimpleTestCase):
+    def consumer(self, username):
+        # What `connect` sets up for a socket in the room.
+        consumer = ChatRoomConsumer()
+        consumer.user = SimpleNamespace(username=username)
+        consumer.room_group_name = str(uuid.uuid4())
+        consumer.typists = {}
+        consumer.replayed = None
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    async def test_room_events_are_encoded_once(self):
+        event = encode_event(
+            "delete_message",
+            {"type": "DELETE_MESSAGE", "message_id": 1, "seq": 2},
+            event_id=None,
+            message_id=1,
+        )
+        consumers = [self.consumer(f"member{number}") for number in range(3)]
+        with mock.patch("chat.consumers.json.dumps") as dumps:
+            for consumer in consumers:
+                await consumer.delete_message(event)
+
+        dumps.assert_not_called()
+        for consumer in consumers:
+            consumer.send.assert_awaited_once_with(text_data=event["text"])
+
+    async def test_typists_get_their_own_list(self):
+        event = encode_event(
+            "typing_state",
+            {"type": "TYPING", "source": "worker", "usernames": ["a", "b"]},
+            source="worker",
+            usernames=["a", "b"],
+        )
+        typist, watcher = self.consumer("a"), self.consumer("c")
+        for consumer in [typist, watcher]:
+            await consumer.typing_state(event)
+
+        watcher.send.assert_awaited_once_with(text_data=event["text"])
+        ((_, kwargs),) = typist.send.await_args_list
+        self.assertEqual(
+            json.loads(kwargs["text_data"]),
+            {"type": "TYPING", "source": "worker", "usernames": ["b"]},
+        )
+
+
+class PresenceTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch(
+            "chat.presence.get_channel_layer", return_value=self.channel_layer
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.store = MemoryPresenceStore()
+        self.tracker = PresenceTracker(
+            store=self.store, interval=60, heartbeat=60, ttl=60
+        )
+        self.alice = SimpleNamespace(pk=1, username="alice")
+        self.bob = SimpleNamespace(pk=2, username="bob")
+
+    def diffs(self):
+        diffs = [
+            (room, json.loads(event["text"]))
+            for (room, event), _ in self.channel_layer.group_send.call_args_list
+        ]
+        self.channel_layer.group_send.reset_mock()
+        return [
+            (
+                room,
+                sorted(user["username"] for user in frame["joined"]),
+                sorted(user["username"] for user in frame["left"]),
+            )
+            for room, frame in diffs
+        ]
+
+    async def test_joins_are_batched(self):
+        for user in [self.alice, self.alice, self.bob]:
+            self.tracker.connect("room", user)
+        await self.tracker.flush()
+
+        self.assertEqual(self.diffs(), [("room", ["alice", "bob"], [])])
+        self.assertEqual(
+            await self.tracker.online("room"), {1: "alice", 2: "bob"}
+        )
+        await self.tracker.stop()
+
+    async def test_leaves_once_every_socket_closed(self):
+        self.tracker.connect("room", self.alice)
+        self.tracker.connect("room", self.alice)
+        await self.tracker.flush()
+        self.diffs()
+
+        self.tracker.disconnect("room", self.alice)
+        await self.tracker.flush()
+        self.assertEqual(self.diffs(), [])
+
+        self.tracker.disconnect("room", self.alice)
+        await self.tracker.flush()
+        self.assertEqual(self.diffs(), [("room", [], ["alice"])])
+        self.assertEqual(await self.tracker.online("room"), {})
+        await self.tracker.stop()
+
+    async def test_expired_entries_leave(self):
+        # Left behind by a worker that crashed.
+        await self.store.touch(
+            "room", [encode_member("crashed", 2, "bob")], time.time() - 1
+        )
+        self.tracker.connect("room", self.alice)
+        await self.tracker.flush()
+
+        self.assertEqual(self.diffs(), [("room", ["alice"], ["bob"])])
+        await self.tracker.stop()
+
+
+class RoomHistoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = RoomHistoryCache(size=3, max_rooms=2)
+        self.cache.subscribe("room")
+
+    def message(self, message_id, seq=None, text="hello"):
+        return {
+            "id": message_id,
+            "message": text,
+            "edited": False,
+            "seq": message_id if seq is None else seq,
+        }
+
+    def fill(self, *message_ids, complete=True):
+        self.cache.fill(
+            "room",
+            [self.message(message_id) for message_id in message_ids],
+            complete,
+            self.cache.version("room"),
+        )
+
+    def ids(self, count=3):
+        messages, has_more = self.cache.get("room", count)
+        return [message["id"] for message in messages], has_more
+
+    def test_fill_and_get(self):
+        self.fill(3, 2, 1)
+        self.assertEqual(self.ids(), ([3, 2, 1], False))
+        self.assertEqual(self.ids(2), ([3, 2], True))
+        self.assertIsNone(self.cache.get("other", 1))
+
+    def test_only_subscribed_rooms(self):
+        self.cache.fill("other", [self.message(1)], True, 0)
+        self.assertIsNone(self.cache.get("other", 1))
+
+        self.cache.unsubscribe("room")
+        self.fill(1)
+        self.assertIsNone(self.cache.get("room", 1))
+
+    def test_stale_fill_is_ignored(self):
+        version = self.cache.version("room")
+        # A message broadcast while the page was read from the database.
+        self.cache.add("room", self.message(2))
+        self.cache.fill("room", [self.message(1)], True, version)
+        self.assertIsNone(self.cache.get("room", 1))
+
+    def test_kept_current(self):
+        self.fill(2, 1)
+        self.cache.add("room", self.message(3))
+        self.cache.edit("room", 2, "edited", 4)
+        self.cache.remove("room", 1)
+
+        messages, has_more = self.cache.get("room", 3)
+        self.assertEqual([message["id"] for message in messages], [3, 2])
+        self.assertEqual(messages[1]["message"], "edited")
+        self.assertFalse(has_more)
+
+    def test_edits_applied_once(self):
+        self.fill(1)
+        self.cache.edit("room", 1, "first", 2)
+        self.cache.edit("room", 1, "second", 3)
+        # The same edit, delivered again by another socket of the room, is
+        # recognized by its sequence number alone.
+        self.cache.edit("room", 1, "skipped", 3)
+        messages, _ = self.cache.get("room", 1)
+        self.assertEqual(messages[0]["message"], "second")
+
+    def test_remove_from_partial_history(self):
+        self.fill(3, 2, 1, complete=False)
+        self.cache.remove("room", 2)
+        # The message below the cached ones would be needed to fill in.
+        self.assertIsNone(self.cache.get("room", 1))
+
+    def test_waits_for_buffered_messages(self):
+        self.cache.add("room", {**self.message(2), "seq": None})
+        self.fill(1)
+        self.assertIsNone(self.cache.get("room", 1))
+
+        self.fill(2, 1)
+        self.assertEqual(self.ids(2), ([2, 1], False))
+
+
+class BenchmarkTests(TransactionTestCase):
+    def setUp(self):
+        for target, attribute, value in [
+            (presence_tracker, "store", MemoryPresenceStore()),
+            (
+                event_log,
+                "store",
+                MemoryEventLogStore(
+                    size=settings.EVENT_LOG_SIZE, ttl=settings.EVENT_LOG_TTL
+                ),
+            ),
+            (pool, "max_age", 0),
+        ]:
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = os.path.join(directory.name, "results.json")
+
+    def test_percentile(self):
+        timings = [0.001 * number for number in range(1, 101)]
+        self.assertEqual(percentile(timings, 50), timings[49])
+        self.assertEqual(percentile(timings, 99), timings[98])
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(summarize([]), {"count": 0})
+
+    def test_api_benchmark_leaves_no_invites(self):
+        creator = create_user("creator")
+        chatroom = ChatRoom.objects.create(name="General", creator=creator)
+        store_message(chatroom, creator, "hello")
+        private = ChatRoom.objects.create(
+            name="Staff", creator=creator, type=RoomType.PRIVATE
+        )
+
+        call_command(
+            "bench_api",
+            requests=2,
+            endpoints=["history", "room_list", "invite"],
+            output=self.output,
+            stdout=StringIO(),
+        )
+        with open(self.output) as file:
+            results = json.load(file)
+        self.assertEqual(results["invite"]["count"], 2)
+        self.assertFalse(InviteLink.objects.filter(chatroom=private).exists())
+
+    def test_websocket_benchmark(self):
+        call_command(
+            "bench_websocket",
+            clients=3,
+            events=2,
+            output=self.output,
+            stdout=StringIO(),
+        )
+        with open(self.output) as file:
+            results = json.load(file)
+        self.assertEqual(results["connect"]["count"], 3)
+        # Every client receives every message, and all but the sender
+        # every typing notification.
+        self.assertEqual(results["NEW_MESSAGE"]["count"], 6)
+        self.assertEqual(results["EDIT_MESSAGE"]["count"], 6)
+        self.assertEqual(results["TYPING"]["count"], 4)
+
+        stdout = StringIO()
+        call_command(
+            "bench_websocket",
+            clients=3,
+            events=2,
+            baseline=self.output,
+            stdout=stdout,
+        )
+        self.assertIn(f"Compared to {self.output}", stdout.getvalue())
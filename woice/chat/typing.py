@@ -0,0 +1,121 @@
+import asyncio
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .utils import encode_event
+
+
+class TypingAggregator:
+    """
+    Per-process aggregator of who is typing in each room.
+
+    TYPING/NOT_TYPING frames only update local state; every `interval`
+    seconds each room whose set of typists changed gets a single
+    `typing_state` event with the full list. State is kept per socket, by
+    channel name, and users are listed while any of their sockets is
+    typing, so one of their tabs going idle or closing doesn't hide
+    another. Repeated TYPING frames just push a socket's expiry back, and
+    sockets that stop sending them drop out after `ttl` seconds. Each
+    process tags its events with a `source` id so clients can merge the
+    lists coming from different workers.
+    """
+
+    def __init__(self, interval, ttl):
+        self.interval = interval
+        self.ttl = ttl
+        self.source = uuid.uuid4().hex
+        self.rooms = {}
+        self.dirty = set()
+        self.last_sent = {}
+        self.task = None
+
+    def typing(self, room, channel_name, username):
+        typists = self.rooms.setdefault(room, {})
+        if channel_name not in typists:
+            self.dirty.add(room)
+        typists[channel_name] = (username, time.monotonic() + self.ttl)
+        self.start()
+        return None
+
+    def not_typing(self, room, channel_name):
+        typists = self.rooms.get(room)
+        if typists is not None and typists.pop(channel_name, None) is not None:
+            self.dirty.add(room)
+            self.start()
+        return None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return None
+
+    async def stop(self):
+        """
+        Cancel the periodic task and publish the changes still pending, so
+        other workers' clients drop the typists of this process.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+        return None
+
+    async def run(self):
+        try:
+            while self.rooms or self.dirty:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            self.task = None
+
+    async def flush(self):
+        now = time.monotonic()
+        for room, typists in list(self.rooms.items()):
+            expired = [
+                channel_name
+                for channel_name, (_, expires) in typists.items()
+                if expires <= now
+            ]
+            for channel_name in expired:
+                del typists[channel_name]
+            if expired:
+                self.dirty.add(room)
+            if not typists:
+                del self.rooms[room]
+
+        dirty, self.dirty = self.dirty, set()
+        channel_layer = get_channel_layer()
+        for room in dirty:
+            usernames = sorted(
+                {username for username, _ in self.rooms.get(room, {}).values()}
+            )
+            if self.last_sent.get(room, []) == usernames:
+                continue
+
+            if usernames:
+                self.last_sent[room] = usernames
+            else:
+                self.last_sent.pop(room, None)
+
+            await channel_layer.group_send(
+                room,
+                encode_event(
+                    "typing_state",
+                    {
+                        "type": "TYPING",
+                        "source": self.source,
+                        "usernames": usernames,
+                    },
+                    source=self.source,
+                    usernames=usernames,
+                ),
+            )
+        return None
+
+
+typing_aggregator = TypingAggregator(
+    interval=settings.TYPING_INTERVAL, ttl=settings.TYPING_TTL
+)
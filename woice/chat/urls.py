@@ -1,7 +1,16 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from .views import ChatRoomViewSet, MemberSearchView, MessageListView, room
+from .views import (
+    ChatRoomViewSet,
+    MemberSearchView,
+    MessageChangesView,
+    MessageListView,
+    MessageSearchView,
+    MetricsView,
+    OnlineMembersView,
+    room,
+)
 
 router = DefaultRouter()
 router.register("room", ChatRoomViewSet, "chatroom")
@@ -13,9 +22,30 @@ urlpatterns = [
         MemberSearchView.as_view(),
         name="member-search",
     ),
+    path(
+        "messages/search/",
+        MessageSearchView.as_view(),
+        name="message-search",
+    ),
+    path(
+        "room/<str:pk>/messages/search/",
+        MessageSearchView.as_view(),
+        name="room-message-search",
+    ),
     path(
         "room/<str:pk>/messages/",
         MessageListView.as_view(),
         name="messages",
     ),
+    path(
+        "room/<str:pk>/messages/changes/",
+        MessageChangesView.as_view(),
+        name="message-changes",
+    ),
+    path(
+        "room/<str:pk>/online/",
+        OnlineMembersView.as_view(),
+        name="online-members",
+    ),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
 ] + router.urls
@@ -1,3 +1,4 @@
+import json
 import re
 
 
@@ -20,3 +21,16 @@ def strip_str(str, format_as):
         stripped_str = re.sub(" +", " ", str)
 
     return stripped_str
+
+
+def encode_event(handler, frame, **extra):
+    """
+    Builds a channel layer event whose websocket payload is encoded once,
+    by the sender, instead of once per recipient
+    Args:
+        handler: name of the consumer method that handles the event
+        frame: dict sent to every recipient as JSON text
+        extra: additional event keys for handlers that need to filter or
+            re-encode the frame per recipient
+    """
+    return {"type": handler, "text": json.dumps(frame), **extra}
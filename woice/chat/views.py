@@ -1,47 +1,104 @@
-from django.contrib.postgres.search import TrigramSimilarity
+import hashlib
+import json
+import uuid
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    TrigramSimilarity,
+)
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Exists, F, FloatField, OuterRef, Value
+from django.db.models.functions import Cast, Lower
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.generics import ListAPIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
+from woice.db import pool
+from woice.query_budget import QueryBudgetMixin, query_budget
 
+from .cache import directory_cache_key
+from .context import get_room
+from .counters import record_read, unread_count
+from .history import history_cache
 from .models import (
     ChatRoom,
     ChatRoomMember,
     ChatRoomMessage,
     InviteLink,
     RoomType,
+    SEARCH_CONFIG,
+)
+from .pagination import (
+    ChangesPagination,
+    MessageKeysetPagination,
+    SearchKeysetPagination,
+)
+from .permissions import (
+    AdminPermission,
+    ChatRoomPermission,
+    MemberPermission,
 )
-from .permissions import AdminPermission, ChatRoomPermission
+from .persistence import message_buffer
+from .presence import presence_tracker
 from .serializers import (
     ChatRoomCreateSerializer,
     ChatRoomMemberSerializer,
     ChatRoomMessageSerializer,
     ChatRoomSerializer,
     MakeAdminSerializer,
+    MarkReadSerializer,
+    MessageSearchSerializer,
+    MyChatRoomSerializer,
     PrivateChatRoomInviteSerializer,
 )
 from .signals import invites
 
 
+@query_budget(0)
 def room(request, pk):
     return render(request, "chat/chatroom.html", {"pk": pk})
 
 
-class ChatRoomViewSet(ModelViewSet):
+class ChatRoomViewSet(QueryBudgetMixin, ModelViewSet):
     serializer_class = ChatRoomSerializer
     permission_classes = [ChatRoomPermission]
     serializer_action_classes = {
         "create": ChatRoomCreateSerializer,
         "invite": PrivateChatRoomInviteSerializer,
         "make_admin": MakeAdminSerializer,
+        "mine": MyChatRoomSerializer,
+        "read": MarkReadSerializer,
     }
     permission_action_classes = {
         "invite": [AdminPermission],
         "make_admin": [AdminPermission],
+        "read": [MemberPermission],
+    }
+    # Budgets of authenticated views count the user lookup, and one more
+    # query for the periodic refresh of revoked tokens.
+    query_budget = {
+        "list": 4,
+        "retrieve": 3,
+        "create": 6,
+        "update": 4,
+        "partial_update": 4,
+        "destroy": 4,
+        "invite": 6,
+        "make_admin": 5,
+        "mine": 3,
+        "read": 5,
     }
 
     def create(self, request, *args, **kwargs):
@@ -65,9 +122,9 @@ class ChatRoomViewSet(ModelViewSet):
         serializer.is_valid(raise_exception=True)
 
         recipients = serializer.validated_data.get("recipients")
-        try:
-            chatroom = ChatRoom.objects.get(pk=kwargs["pk"])
-        except ObjectDoesNotExist:
+        # Already loaded by `AdminPermission`.
+        chatroom = get_room(request, kwargs["pk"])
+        if chatroom is None:
             return Response(
                 {"status": "error", "message": "Chatroom doesn't exist!"},
                 status=status.HTTP_404_NOT_FOUND,
@@ -82,20 +139,33 @@ class ChatRoomViewSet(ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        emails_to_invite = []
-        for recipient in set(recipients):
-            invite_link = InviteLink.objects.filter(
-                chatroom=chatroom, email__iexact=recipient, has_expired=False
+        # Deduplicate case-insensitively, keeping the first spelling seen.
+        recipients_by_email = {}
+        for recipient in recipients:
+            recipients_by_email.setdefault(recipient.lower(), recipient)
+
+        pending = set(
+            InviteLink.objects.annotate(email_lower=Lower("email"))
+            .filter(
+                chatroom=chatroom,
+                email_lower__in=list(recipients_by_email),
+                expires__gt=timezone.now(),
+                has_expired=False,
             )
-            if not invite_link.exists():
-                emails_to_invite.append(recipient)
+            .values_list("email_lower", flat=True)
+        )
+        emails_to_invite = [
+            recipient
+            for email, recipient in recipients_by_email.items()
+            if email not in pending
+        ]
 
         if emails_to_invite:
             invites.send(
                 sender=__class__,
                 request=request,
                 chatroom=chatroom,
-                recipients=recipients,
+                recipients=emails_to_invite,
             )
             state = "success"
             message = "Invite(s) sent successfully"
@@ -132,9 +202,8 @@ class ChatRoomViewSet(ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        try:
-            chatroom = ChatRoom.objects.get(pk=kwargs["pk"])
-        except ObjectDoesNotExist:
+        chatroom = get_room(request, kwargs["pk"])
+        if chatroom is None:
             return Response(
                 {"status": "error", "message": "Chatroom doesn't exist!"},
                 status=status.HTTP_404_NOT_FOUND,
@@ -142,7 +211,7 @@ class ChatRoomViewSet(ModelViewSet):
 
         try:
             member = ChatRoomMember.objects.get(
-                chatroom=chatroom, user__id=user_id
+                chatroom=chatroom, user_id=user_id
             )
         except ObjectDoesNotExist:
             return Response(
@@ -192,6 +261,70 @@ class ChatRoomViewSet(ModelViewSet):
                     status=status.HTTP_200_OK,
                 )
 
+    @action(detail=False, methods=["get"])
+    def mine(self, request, *args, **kwargs):
+        # Every room the user belongs to, private ones included, with its
+        # unread count from the maintained counters, in a single query.
+        memberships = (
+            ChatRoomMember.objects.filter(user=request.user)
+            .select_related("chatroom__creator")
+            .annotate(unread_count=unread_count())
+            .order_by(
+                F("chatroom__last_message_at").desc(nulls_last=True),
+                "-chatroom__created",
+            )
+        )
+        serializer = self.get_serializer(memberships, many=True)
+        return Response(
+            {"status": "success", "data": serializer.data},
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=True, methods=["post"])
+    def read(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # Already loaded by `MemberPermission`.
+        chatroom = get_room(request, kwargs["pk"])
+        message_id = serializer.validated_data["message_id"]
+        pending = message_buffer.is_pending(chatroom.pk, message_id)
+        # A no-op for messages that aren't in the room, which are only
+        # rejected once the read pointer is fetched.
+        record_read(chatroom.pk, request.user.pk, message_id, pending)
+
+        last_read_id, unread, in_room = (
+            ChatRoomMember.objects.annotate(
+                unread_count=unread_count(),
+                in_room=Exists(
+                    ChatRoomMessage.objects.filter(
+                        chatroom_id=OuterRef("chatroom_id"), pk=message_id
+                    )
+                ),
+            )
+            .values_list("last_read_id", "unread_count", "in_room")
+            .get(chatroom=chatroom, user=request.user)
+        )
+        if not (in_room or pending):
+            return Response(
+                {
+                    "status": "error",
+                    "message": "This message doesn't belong in this room!",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(
+            {
+                "status": "success",
+                "message": "Messages marked as read",
+                "data": {
+                    "last_read_id": last_read_id,
+                    "unread_count": unread,
+                },
+            },
+            status=status.HTTP_200_OK,
+        )
+
     def get_permissions(self):
         try:
             return [
@@ -207,51 +340,271 @@ class ChatRoomViewSet(ModelViewSet):
         except (KeyError, AttributeError):
             return super().get_serializer_class()
 
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def get_cached_response(self, view, request, *args, **kwargs):
+        """
+        Serve the public room directory from the shared cache, with an
+        `ETag` so clients can revalidate with `If-None-Match`. The
+        directory is the same for every user, so entries are keyed by path
+        only, and invalidated when any room changes.
+        """
+        key = directory_cache_key(request.get_full_path())
+        cached = cache.get(key)
+        if cached is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+
+            content = json.dumps(response.data, cls=JSONEncoder)
+            etag = quote_etag(hashlib.md5(content.encode()).hexdigest())
+            cached = (response.data, etag)
+            cache.set(key, cached, settings.ROOM_DIRECTORY_CACHE_TIMEOUT)
+
+        data, etag = cached
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(
+                status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+            )
+        return Response(data, headers={"ETag": etag})
+
     def get_queryset(self):
-        queryset = ChatRoom.objects.exclude(type=RoomType.PRIVATE)
+        queryset = (
+            ChatRoom.objects.exclude(type=RoomType.PRIVATE)
+            .select_related("creator")
+            .order_by("-created", "pk")
+        )
         return queryset
 
 
-class MemberSearchView(ListAPIView):
+class MemberSearchView(QueryBudgetMixin, ListAPIView):
+    """
+    Autocomplete over a room's members by username. Prefix matches come
+    first, then trigram matches ordered by similarity, at most `limit`
+    (default and maximum `MEMBER_SEARCH_LIMIT`) results in total. Both
+    lookups are served by indexes on the username (see migration 0020).
+    """
+
     serializer_class = ChatRoomMemberSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = 4
+    pagination_class = None
 
-    def get_queryset(self):
-        q = self.request.query_params.get("q")
+    def list(self, request, *args, **kwargs):
+        q = request.query_params.get("q", "").strip()
+        if not q:
+            return Response({"results": []})
 
-        if q:
-            try:
-                chatroom = ChatRoom.objects.get(pk=self.kwargs["pk"])
-            except ObjectDoesNotExist:
-                return Response(
-                    {
-                        "status": "error",
-                        "message": "Chatroom doesn't exist",
-                    }
-                )
+        try:
+            room = uuid.UUID(self.kwargs["pk"])
+        except ValueError:
+            raise NotFound("Chatroom doesn't exist!")
 
-            queryset = ChatRoomMember.objects.annotate(
-                similarity=TrigramSimilarity("user__username", q)
-            ).filter(chatroom=chatroom, similarity__gt=0.3)
-        else:
-            queryset = ChatRoomMember.objects.none()
-        return queryset
+        limit = self.get_limit(request)
+        members = ChatRoomMember.objects.filter(
+            chatroom_id=room
+        ).select_related("user")
+
+        results = list(
+            members.filter(user__username__istartswith=q).order_by(
+                "user__username"
+            )[:limit]
+        )
+        if len(results) < limit:
+            # `trigram_similar` compiles to the `%` operator, which unlike
+            # a similarity() comparison can use the trigram index.
+            results += list(
+                members.filter(user__username__trigram_similar=q)
+                .exclude(pk__in=[member.pk for member in results])
+                .annotate(similarity=TrigramSimilarity("user__username", q))
+                .order_by("-similarity", "user__username")[
+                    : limit - len(results)
+                ]
+            )
+
+        serializer = self.get_serializer(results, many=True)
+        return Response({"results": serializer.data})
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params["limit"])
+            if limit > 0:
+                return min(limit, settings.MEMBER_SEARCH_LIMIT)
+        except (KeyError, ValueError):
+            pass
+        return settings.MEMBER_SEARCH_LIMIT
 
 
-class MessageListView(ListAPIView):
+class MessageListView(QueryBudgetMixin, ListAPIView):
     serializer_class = ChatRoomMessageSerializer
     permission_classes = [IsAuthenticated]
+    # Pages crossing into the archives look them up too.
+    query_budget = 7
+    pagination_class = MessageKeysetPagination
 
-    def get_queryset(self):
+    def list(self, request, *args, **kwargs):
+        # The newest page is served from the room history cache whenever
+        # possible, and used to fill it otherwise.
         try:
-            chatroom = ChatRoom.objects.get(pk=self.kwargs["pk"])
-        except ObjectDoesNotExist:
+            room = str(uuid.UUID(self.kwargs["pk"]))
+        except ValueError:
+            raise NotFound("Chatroom doesn't exist!")
+
+        if not self.paginator.is_first_page(request):
+            return super().list(request, *args, **kwargs)
+
+        page_size = self.paginator.get_page_size(request)
+        cached = history_cache.get(room, page_size)
+        if cached is not None:
+            messages, has_more = cached
+            page = self.paginator.paginate_cached(messages, has_more, request)
+            return self.get_paginated_response(page)
+
+        version = history_cache.version(room)
+        response = super().list(request, *args, **kwargs)
+        history_cache.fill(
+            room,
+            response.data["results"],
+            not self.paginator.has_more,
+            version,
+        )
+        return response
+
+    def get_queryset(self):
+        queryset = ChatRoomMessage.objects.filter(
+            chatroom_id=self.kwargs["pk"], deleted=False
+        ).select_related("user")
+        return queryset.order_by("-created", "-id")
+
+
+class MessageChangesView(QueryBudgetMixin, ListAPIView):
+    """
+    Messages of a room created, edited or deleted since a sequence number,
+    so reconnecting clients catch up without reloading the history.
+    Deleted messages are returned as tombstones. Members only.
+    """
+
+    serializer_class = ChatRoomMessageSerializer
+    permission_classes = [MemberPermission]
+    query_budget = 4
+    pagination_class = ChangesPagination
+
+    def list(self, request, *args, **kwargs):
+        # Already loaded by `MemberPermission`.
+        chatroom = get_room(request, self.kwargs["pk"])
+        if self.paginator.get_since(request) < chatroom.archived_seq:
             return Response(
                 {
                     "status": "error",
-                    "message": "Chatroom doesn't exist",
-                }
+                    "message": "These changes were archived, reload the "
+                    "history instead!",
+                },
+                status=status.HTTP_410_GONE,
+            )
+        return super().list(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return ChatRoomMessage.objects.filter(
+            chatroom_id=self.kwargs["pk"]
+        ).select_related("user")
+
+
+class OnlineMembersView(QueryBudgetMixin, APIView):
+    """
+    Members currently connected to the room, read from the presence store
+    without touching the database.
+    """
+
+    permission_classes = [IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        try:
+            room = str(uuid.UUID(kwargs["pk"]))
+        except ValueError:
+            return Response(
+                {"status": "error", "message": "Chatroom doesn't exist!"},
+                status=status.HTTP_404_NOT_FOUND,
             )
 
-        queryset = ChatRoomMessage.objects.filter(chatroom=chatroom)
-        return queryset.order_by("-created")
+        online = async_to_sync(presence_tracker.online)(room)
+        return Response(
+            {
+                "status": "success",
+                "data": [
+                    {"id": user_id, "username": username}
+                    for user_id, username in online.items()
+                ],
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class MessageSearchView(QueryBudgetMixin, ListAPIView):
+    """
+    Full-text search over messages in the rooms the user belongs to, or in
+    a single one of them, best match first.
+    """
+
+    serializer_class = MessageSearchSerializer
+    permission_classes = [IsAuthenticated]
+    query_budget = 3
+    pagination_class = SearchKeysetPagination
+
+    def get_queryset(self):
+        room = None
+        if "pk" in self.kwargs:
+            try:
+                room = uuid.UUID(self.kwargs["pk"])
+            except ValueError:
+                raise NotFound("Chatroom doesn't exist!")
+
+        q = self.request.query_params.get("q")
+        if not q:
+            # Annotated like real results, which the pagination orders by.
+            return ChatRoomMessage.objects.none().annotate(
+                rank=Value(0.0, output_field=FloatField())
+            )
+
+        query = SearchQuery(q, config=SEARCH_CONFIG, search_type="websearch")
+        queryset = ChatRoomMessage.objects.filter(
+            search_vector=query,
+            chatroom_id__in=ChatRoomMember.objects.filter(
+                user=self.request.user
+            ).values("chatroom_id"),
+        )
+        if room is not None:
+            queryset = queryset.filter(chatroom_id=room)
+
+        return queryset.annotate(
+            rank=Cast(SearchRank(F("search_vector"), query), FloatField())
+        ).select_related("user")
+
+
+class MetricsView(QueryBudgetMixin, APIView):
+    """
+    Staff-only metrics of the process serving the request: its database
+    thread pool, room history cache and message write buffer.
+    """
+
+    permission_classes = [IsAdminUser]
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        return Response(
+            {
+                "status": "success",
+                "data": {
+                    "db_pool": pool.stats(),
+                    "history_cache": history_cache.stats(),
+                    "message_buffer": {"pending": len(message_buffer.pending)},
+                },
+            },
+            status=status.HTTP_200_OK,
+        )
@@ -1,3 +1,3 @@
 python manage.py collectstatic --no-input
 python manage.py migrate
-python manage.py runserver 0.0.0.0:8000
+exec gunicorn woice.asgi:application -c gunicorn.conf.py
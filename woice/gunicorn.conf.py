@@ -0,0 +1,26 @@
+# Gunicorn settings, run with:
+#   gunicorn woice.asgi:application -c gunicorn.conf.py
+import multiprocessing
+
+# Not `from decouple import config`: gunicorn reads every name here as a
+# setting, and `config` is one.
+import decouple
+
+bind = decouple.config("BIND", default="0.0.0.0:8000")
+
+# Each worker is one process with its own event loop, serving HTTP and
+# websockets, and holding up to DB_POOL_SIZE database connections for
+# its sockets on top of those of its HTTP requests.
+workers = decouple.config(
+    "WEB_CONCURRENCY", default=multiprocessing.cpu_count(), cast=int
+)
+worker_class = "woice.workers.DrainingUvicornWorker"
+
+# Workers get this long to drain their sockets (SHUTDOWN_DRAIN_TIMEOUT)
+# and flush buffered messages after SIGTERM before they are killed.
+graceful_timeout = (
+    decouple.config("SHUTDOWN_DRAIN_TIMEOUT", default=10, cast=int) + 20
+)
+
+accesslog = "-"
+errorlog = "-"
@@ -9,8 +9,11 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "woice.settings")
 
-application = get_asgi_application()
+# Set up Django before the routing imports consumers and models.
+django.setup()
+
+from .routing import application  # noqa: E402
@@ -1,40 +1,67 @@
+import time
 from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.db import close_old_connections
-from jwt import decode as jwt_decode
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from rest_framework_simplejwt.tokens import UntypedToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.revocation import revocation_cache
+from chat.cache import TTLCache
+
+from .db import database_sync_to_async
+
+# Users resolved from access tokens, by token id, each kept for the
+# remaining lifetime of its token.
+user_cache = TTLCache(maxsize=settings.WS_AUTH_CACHE_SIZE, ttl=0)
 
 
 class JWTAuthMiddleware:
     """
-    Custom JWT authentication middleware
+    Authenticates websocket connections from an access token passed as the
+    `token` query parameter. Connections without one are passed through
+    unchanged, and connections with an invalid or expired token get an
+    `AnonymousUser`.
     """
 
     def __init__(self, application):
         self.application = application
 
     async def __call__(self, scope, receive, send):
-        close_old_connections()
-        token = parse_qs(scope["query_string"].decode("utf8"))["token"][0]
-        try:
-            UntypedToken(token)
-        except (InvalidToken, TokenError) as e:
-            return None
-        else:
-            decoded_data = jwt_decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            scope["user"] = await self.get_user(decoded_data)
+        query = parse_qs(scope.get("query_string", b"").decode("utf8"))
+        if "token" in query:
+            scope = dict(scope, user=await self.authenticate(query["token"][0]))
         return await self.application(scope, receive, send)
 
-    @database_sync_to_async
-    def get_user(self, data):
+    async def authenticate(self, raw_token):
+        # The signature, expiry and token type are all checked in this one
+        # decode, before any database work.
         try:
-            user = get_user_model().objects.get(id=data["user_id"])
-        except ObjectDoesNotExist:
-            user = AnonymousUser()
+            token = AccessToken(raw_token)
+            jti = token[api_settings.JTI_CLAIM]
+            user_id = token[api_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            return AnonymousUser()
+
+        if revocation_cache.is_stale():
+            await database_sync_to_async(revocation_cache.refresh)()
+        if revocation_cache.is_revoked(jti):
+            return AnonymousUser()
+
+        user = user_cache.get(jti)
+        if user is None:
+            user = await self.get_user(user_id)
+            if user.is_authenticated:
+                user_cache.set(jti, user, ttl=token["exp"] - time.time())
         return user
+
+    @database_sync_to_async
+    def get_user(self, user_id):
+        try:
+            return get_user_model().objects.get(
+                **{api_settings.USER_ID_FIELD: user_id}, is_active=True
+            )
+        except get_user_model().DoesNotExist:
+            return AnonymousUser()
@@ -0,0 +1,213 @@
+"""
+Database access from async code. `database_sync_to_async` runs ORM calls
+on a pool of DB_POOL_SIZE threads, each keeping its own connection open
+between calls, so a process holds at most DB_POOL_SIZE connections for
+its consumers and doesn't reconnect on every call. Connections are closed
+once they are DB_CONN_MAX_AGE seconds old or after an error, and checked
+before reuse once idle for DB_HEALTH_CHECK_INTERVAL seconds. Calls wait
+for a free thread when all of them are busy, and `pool.stats()` reports
+how long they waited.
+"""
+
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+from django.db import connections
+
+# State of the current call in the pool. Context variables are copied into
+# the pool thread along with the call.
+current_call = ContextVar("db_pool_call", default=None)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class ConnectionPool:
+    """
+    Threads running database calls for async code, and the persistent
+    connections they hold. Only the most recent `samples` waits are kept
+    for percentiles.
+    """
+
+    def __init__(self, size, max_age, health_check_interval, samples=1000):
+        self.size = size
+        self.max_age = max_age
+        self.health_check_interval = health_check_interval
+        self.executor = ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix="db-pool"
+        )
+        # Per thread: when each of its connections was opened and last used.
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=samples)
+        self.calls = 0
+        self.waiting = 0
+        self.busy = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.health_check_failures = 0
+
+    def submit(self):
+        """
+        Record a call waiting for a thread, returning its state for
+        `start` and `abandon`.
+        """
+        with self.lock:
+            self.waiting += 1
+        return {"submitted": time.monotonic(), "started": False}
+
+    def start(self, call):
+        wait = time.monotonic() - call["submitted"]
+        with self.lock:
+            if not call["started"]:
+                self.waiting -= 1
+            call["started"] = True
+            self.calls += 1
+            self.busy += 1
+            self.waits.append(wait)
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        return None
+
+    def finish(self):
+        with self.lock:
+            self.busy -= 1
+        return None
+
+    def abandon(self, call):
+        # Calls cancelled before a thread picked them up never start.
+        with self.lock:
+            if not call["started"]:
+                self.waiting -= 1
+            call["started"] = True
+        return None
+
+    def thread_connections(self):
+        """
+        `(connection, opened)` for each database alias of this thread, where
+        `opened` maps aliases to `(raw connection, created, last used)`.
+        """
+        opened = self.local.__dict__.setdefault("opened", {})
+        for connection in connections.all():
+            entry = opened.get(connection.alias)
+            if entry is not None and entry[0] is not connection.connection:
+                del opened[connection.alias]
+            yield connection, opened
+
+    def prepare_connections(self):
+        """
+        Close the connections of this thread that must not be reused, as
+        `close_old_connections` does between requests, so the next query
+        opens a new one. Connections idle for longer than the health check
+        interval are checked first.
+        """
+        now = time.monotonic()
+        for connection, opened in self.thread_connections():
+            if connection.connection is None or connection.in_atomic_block:
+                continue
+
+            _, created, used = opened.get(connection.alias, (None, now, now))
+            if connection.errors_occurred:
+                if connection.is_usable():
+                    connection.errors_occurred = False
+                else:
+                    connection.close()
+            elif now - created >= self.max_age:
+                connection.close()
+            elif now - used >= self.health_check_interval:
+                if not connection.is_usable():
+                    connection.close()
+                    with self.lock:
+                        self.health_check_failures += 1
+        return None
+
+    def release_connections(self):
+        """
+        Record when the connections of this thread were last used, or
+        close them with a DB_CONN_MAX_AGE of 0.
+        """
+        now = time.monotonic()
+        for connection, opened in self.thread_connections():
+            if connection.connection is None:
+                continue
+            if connection.alias not in opened:
+                with self.lock:
+                    self.connects += 1
+            if self.max_age <= 0 and not connection.in_atomic_block:
+                connection.close()
+                continue
+
+            _, created, _ = opened.get(connection.alias, (None, now, now))
+            opened[connection.alias] = (connection.connection, created, now)
+        return None
+
+    def stats(self):
+        with self.lock:
+            waits = list(self.waits)
+            return {
+                "size": self.size,
+                "busy": self.busy,
+                "waiting": self.waiting,
+                "calls": self.calls,
+                "connects": self.connects,
+                "health_check_failures": self.health_check_failures,
+                "wait_avg_ms": (
+                    self.wait_total / self.calls * 1000 if self.calls else 0.0
+                ),
+                "wait_p50_ms": percentile(waits, 0.5) * 1000,
+                "wait_p99_ms": percentile(waits, 0.99) * 1000,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+
+pool = ConnectionPool(
+    size=settings.DB_POOL_SIZE,
+    max_age=settings.DB_CONN_MAX_AGE,
+    health_check_interval=settings.DB_HEALTH_CHECK_INTERVAL,
+)
+
+
+class DatabaseSyncToAsync(SyncToAsync):
+    """
+    Drop-in replacement for `channels.db.database_sync_to_async` running
+    calls on the pool above instead of a single shared thread.
+    """
+
+    def __init__(self, func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            pool.start(current_call.get())
+            try:
+                pool.prepare_connections()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    pool.release_connections()
+            finally:
+                pool.finish()
+
+        super().__init__(run, thread_sensitive=False, executor=pool.executor)
+
+    async def __call__(self, *args, **kwargs):
+        call = pool.submit()
+        token = current_call.set(call)
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            current_call.reset(token)
+            pool.abandon(call)
+
+
+# Used as a decorator or callable, like the one from channels.
+database_sync_to_async = DatabaseSyncToAsync
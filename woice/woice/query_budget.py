@@ -0,0 +1,216 @@
+"""
+Query budgets: views and consumer handlers declare the most queries they
+may run, and every query they run is recorded with its call site. What
+happens when a budget is exceeded depends on the QUERY_BUDGET setting:
+"off" skips tracking, "log" logs a report, and "raise" raises
+`QueryBudgetExceeded` with it, which the test runner below turns on.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.runner import DiscoverRunner
+
+logger = logging.getLogger(__name__)
+
+# Context variables are copied into the threads of `database_sync_to_async`,
+# so queries a consumer runs there are seen by its tracker.
+current_tracker = ContextVar("query_budget_tracker", default=None)
+
+# Transaction control issued by `atomic`, which depends on whether the
+# caller is already in a transaction (as tests are) rather than on the work
+# done, so it is not charged to budgets.
+SAVEPOINT_STATEMENTS = (
+    "SAVEPOINT",
+    "RELEASE SAVEPOINT",
+    "ROLLBACK TO SAVEPOINT",
+)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class Tracker:
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.queries = []
+        # Tasks started inside a tracked block, like flushes of the message
+        # buffer, inherit its tracker but must not count once it is done.
+        self.active = True
+
+
+def call_site():
+    """
+    The innermost frame of project code, outside of this module, that led
+    to the current query, or of library code outside of the ORM for queries
+    run by third-party views and authentication.
+    """
+    project_dir = os.path.join(str(settings.BASE_DIR), "")
+    orm_dir = os.path.join("django", "db", "")
+    fallback = None
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename == __file__:
+            continue
+        if (
+            frame.filename.startswith(project_dir)
+            and "site-packages" not in frame.filename
+        ):
+            return f"{frame.filename}:{frame.lineno} in {frame.name}"
+        if fallback is None and orm_dir not in frame.filename:
+            fallback = f"{frame.filename}:{frame.lineno} in {frame.name}"
+    return fallback or "unknown"
+
+
+def record_query(execute, sql, params, many, context):
+    tracker = current_tracker.get()
+    if isinstance(sql, str) and sql.startswith(SAVEPOINT_STATEMENTS):
+        return execute(sql, params, many, context)
+    site = None
+    while tracker is not None:
+        if tracker.active:
+            site = site or call_site()
+            tracker.queries.append((sql, site))
+        tracker = tracker.parent
+    return execute(sql, params, many, context)
+
+
+def add_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def install():
+    connection_created.connect(add_query_recorder)
+    for connection in connections.all():
+        add_query_recorder(None, connection)
+    return None
+
+
+@contextmanager
+def track(name, budget):
+    """
+    Records the queries run in the block, and reports them if there are
+    more than `budget`. Yields the tracker, or None if tracking is off.
+    Args:
+        name: name of the tracked view or handler, used in the report
+        budget: maximum number of queries, or a callable returning it once
+            the block is done. None means no budget.
+    """
+    if settings.QUERY_BUDGET == "off" or budget is None:
+        yield None
+        return
+
+    tracker = Tracker(name, current_tracker.get())
+    token = current_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        tracker.active = False
+        current_tracker.reset(token)
+
+    if callable(budget):
+        budget = budget()
+    if budget is not None and len(tracker.queries) > budget:
+        report(tracker, budget)
+
+
+def report(tracker, budget):
+    lines = [
+        f"{tracker.name} ran {len(tracker.queries)} queries, "
+        f"over its budget of {budget}:"
+    ]
+    for number, (sql, site) in enumerate(tracker.queries, 1):
+        lines.append(f"  {number}. {sql}")
+        lines.append(f"     at {site}")
+    message = "\n".join(lines)
+
+    if settings.QUERY_BUDGET == "raise":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+    return None
+
+
+def query_budget(budget):
+    """
+    Decorator declaring the query budget of a function view or a consumer
+    handler, sync or async. The setting is read once, when the function is
+    decorated: with budgets off, it is returned as is and costs nothing per
+    call.
+    Args:
+        budget: maximum number of queries per call
+    """
+
+    def decorator(func):
+        if settings.QUERY_BUDGET == "off":
+            return func
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with track(func.__qualname__, budget):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with track(func.__qualname__, budget):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class QueryBudgetMixin:
+    """
+    Mixin for DRF views checking every request against `query_budget`:
+    a number of queries, or a dict of them by viewset action or, for other
+    views, by lowercase HTTP method. Authentication and permission checks
+    count towards it.
+    """
+
+    query_budget = None
+
+    def dispatch(self, request, *args, **kwargs):
+        with track(
+            type(self).__name__, lambda: self.get_query_budget(request)
+        ) as tracker:
+            response = super().dispatch(request, *args, **kwargs)
+            if tracker is not None:
+                tracker.name = f"{type(self).__name__}.{self.get_budget_key()}"
+            return response
+
+    def get_budget_key(self):
+        return getattr(self, "action", None) or self.request.method.lower()
+
+    def get_query_budget(self, request):
+        if isinstance(self.query_budget, dict):
+            return self.query_budget.get(self.get_budget_key())
+        return self.query_budget
+
+
+class QueryBudgetTestRunner(DiscoverRunner):
+    """
+    Test runner that fails any test exceeding a query budget. Budgets are
+    turned on before the tests, and so the views and handlers they import,
+    are loaded.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        settings.QUERY_BUDGET = "raise"
+
+
+install()
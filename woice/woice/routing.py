@@ -1,14 +1,27 @@
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.core.asgi import get_asgi_application
 import chat.routing
+from chat.shutdown import graceful_shutdown
 
-# from .auth_middleware import JWTAuthMiddleware
+from .auth_middleware import JWTAuthMiddleware
+
+http_application = get_asgi_application()
+if settings.DEBUG:
+    # Like runserver, only serve static files in development.
+    http_application = ASGIStaticFilesHandler(http_application)
 
 
 application = ProtocolTypeRouter(
     {
+        "http": http_application,
+        # Token authentication takes precedence over the session, which
+        # remains the fallback for connections without a `token`.
         "websocket": AuthMiddlewareStack(
-            URLRouter(chat.routing.websocket_urlpatterns)
-        )
+            JWTAuthMiddleware(URLRouter(chat.routing.websocket_urlpatterns))
+        ),
+        "lifespan": graceful_shutdown.lifespan,
     }
 )
@@ -87,7 +87,30 @@ ASGI_APPLICATION = "woice.routing.application"
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {"default": dj_database_url.config(default=config("DATABASE_URL"))}
+# HTTP requests keep their connection for HTTP_CONN_MAX_AGE seconds (0
+# closes it after every request). Under ASGI, Django 3.2 runs every sync
+# view of a process on the same thread, so each process holds one such
+# connection. Django only checks it for use after a request that hit a
+# database error (CONN_HEALTH_CHECKS needs Django 4.1), so keep this below
+# the idle timeout of the database or any proxy in front of it
+DATABASES = {
+    "default": dj_database_url.config(
+        default=config("DATABASE_URL"),
+        conn_max_age=config("HTTP_CONN_MAX_AGE", default=60, cast=int),
+    )
+}
+
+# Database calls of consumers and other async code run on a pool of
+# DB_POOL_SIZE threads, each keeping one connection open for at most
+# DB_CONN_MAX_AGE seconds (0 closes it after every call), and checked
+# before reuse once idle for DB_HEALTH_CHECK_INTERVAL seconds (see
+# woice/db.py). Every process may hold DB_POOL_SIZE connections on top of
+# those of its HTTP requests
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=8, cast=int)
+DB_CONN_MAX_AGE = config("DB_CONN_MAX_AGE", default=600, cast=int)
+DB_HEALTH_CHECK_INTERVAL = config(
+    "DB_HEALTH_CHECK_INTERVAL", default=30, cast=int
+)
 
 
 # Password validation
@@ -141,7 +164,7 @@ CORS_ALLOW_ALL_ORIGINS = True
 # REST Framework
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "accounts.authentication.RevocableJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
@@ -158,6 +181,23 @@ SIMPLE_JWT = {
     "UPDATE_LAST_LOGIN": True,
 }
 
+# Cache. The room directory response cache is only invalidated across
+# processes when they share a backend, such as memcached
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": config("CACHE_LOCATION", default=""),
+    }
+}
+
+# Seconds a cached room directory response is kept at most
+ROOM_DIRECTORY_CACHE_TIMEOUT = config(
+    "ROOM_DIRECTORY_CACHE_TIMEOUT", default=60, cast=int
+)
+
 # Channels
 CHANNEL_LAYERS = {
     "default": {
@@ -166,6 +206,124 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Message persistence: "sync" writes every message before it is
+# broadcast, "batched" broadcasts first and writes in bulk (Postgres only).
+# Batches are retried MESSAGE_FLUSH_RETRIES times before being dropped, and
+# messages sent while MESSAGE_BUFFER_MAX_PENDING are waiting are written
+# synchronously instead
+MESSAGE_PERSISTENCE = config("MESSAGE_PERSISTENCE", default="sync")
+MESSAGE_BATCH_SIZE = config("MESSAGE_BATCH_SIZE", default=100, cast=int)
+MESSAGE_FLUSH_INTERVAL = config(
+    "MESSAGE_FLUSH_INTERVAL", default=0.05, cast=float
+)
+MESSAGE_FLUSH_RETRIES = config("MESSAGE_FLUSH_RETRIES", default=5, cast=int)
+MESSAGE_BUFFER_MAX_PENDING = config(
+    "MESSAGE_BUFFER_MAX_PENDING", default=1000, cast=int
+)
+
+# Per-process cache of rooms and memberships used by the websocket
+# handshake. Set the TTL (in seconds) to 0 to disable it
+HANDSHAKE_CACHE_TTL = config("HANDSHAKE_CACHE_TTL", default=0, cast=int)
+HANDSHAKE_CACHE_SIZE = config("HANDSHAKE_CACHE_SIZE", default=10000, cast=int)
+
+# Expired invite cleanup. The in-process sweeper runs every
+# INVITE_SWEEPER_INTERVAL seconds (0 disables it) in servers that send ASGI
+# lifespan events, like gunicorn's workers; `manage.py sweep_invites` does
+# the same from cron, which runserver needs. INVITE_CLEANUP_ON_REQUEST
+# restores the old per-request cleanup
+INVITE_SWEEPER_INTERVAL = config(
+    "INVITE_SWEEPER_INTERVAL", default=300, cast=int
+)
+INVITE_SWEEPER_BATCH_SIZE = config(
+    "INVITE_SWEEPER_BATCH_SIZE", default=1000, cast=int
+)
+INVITE_CLEANUP_ON_REQUEST = config(
+    "INVITE_CLEANUP_ON_REQUEST", default=False, cast=bool
+)
+
+# Typing indicators: each room gets at most one combined update every
+# TYPING_INTERVAL seconds, and typists expire after TYPING_TTL seconds
+TYPING_INTERVAL = config("TYPING_INTERVAL", default=0.5, cast=float)
+TYPING_TTL = config("TYPING_TTL", default=5, cast=float)
+
+# Presence. Online members are kept in the channel layer's Redis
+# ("redis") or in this process only ("memory"). Diffs are published every
+# PRESENCE_INTERVAL seconds, entries are refreshed every PRESENCE_HEARTBEAT
+# seconds and expire after PRESENCE_TTL seconds without a refresh
+PRESENCE_BACKEND = config("PRESENCE_BACKEND", default="redis")
+PRESENCE_INTERVAL = config("PRESENCE_INTERVAL", default=1, cast=float)
+PRESENCE_HEARTBEAT = config("PRESENCE_HEARTBEAT", default=30, cast=float)
+PRESENCE_TTL = config("PRESENCE_TTL", default=90, cast=float)
+
+# Room event log. Message events are also logged per room, in the channel
+# layer's Redis ("redis", as streams) or in this process only ("memory"),
+# keeping the last EVENT_LOG_SIZE events for EVENT_LOG_TTL seconds, so that
+# sockets reconnecting with `last_event_id` get what they missed replayed.
+# Set EVENT_LOG_SIZE to 0 to disable it
+EVENT_LOG_BACKEND = config("EVENT_LOG_BACKEND", default="redis")
+EVENT_LOG_SIZE = config("EVENT_LOG_SIZE", default=500, cast=int)
+EVENT_LOG_TTL = config("EVENT_LOG_TTL", default=300, cast=int)
+
+# Graceful shutdown under gunicorn (see gunicorn.conf.py): a worker asked
+# to exit stops accepting connections, tells its sockets to reconnect and
+# waits up to SHUTDOWN_DRAIN_TIMEOUT seconds for them to close, before
+# writing buffered messages and exiting
+SHUTDOWN_DRAIN_TIMEOUT = config("SHUTDOWN_DRAIN_TIMEOUT", default=10, cast=int)
+
+# Newest messages cached per room to serve the first page of history
+# without a query. Set HISTORY_CACHE_SIZE to 0 to disable it
+HISTORY_CACHE_SIZE = config("HISTORY_CACHE_SIZE", default=50, cast=int)
+HISTORY_CACHE_ROOMS = config("HISTORY_CACHE_ROOMS", default=1000, cast=int)
+
+# Maximum number of results returned by the member search
+MEMBER_SEARCH_LIMIT = config("MEMBER_SEARCH_LIMIT", default=20, cast=int)
+
+# Maximum number of users cached by the websocket JWT middleware, each for
+# the remaining lifetime of the token it was resolved from
+WS_AUTH_CACHE_SIZE = config("WS_AUTH_CACHE_SIZE", default=10000, cast=int)
+
+# Revoked tokens are mirrored in each process and re-synced from the
+# blacklist every REVOCATION_REFRESH seconds, each time re-reading the
+# revocations of the last REVOCATION_OVERLAP seconds in case they were
+# committed late. `manage.py prune_tokens` deletes expired tokens
+# TOKEN_PRUNE_BATCH_SIZE rows at a time
+REVOCATION_REFRESH = config("REVOCATION_REFRESH", default=5, cast=int)
+REVOCATION_OVERLAP = config("REVOCATION_OVERLAP", default=60, cast=int)
+TOKEN_PRUNE_BATCH_SIZE = config(
+    "TOKEN_PRUNE_BATCH_SIZE", default=1000, cast=int
+)
+
+# Messages can be stored in monthly partitions (`manage.py
+# partition_messages`, Postgres only), created MESSAGE_PARTITIONS_AHEAD
+# months in advance. `manage.py archive_messages` moves partitions older
+# than MESSAGE_ARCHIVE_AFTER months into gzipped files under
+# MESSAGE_ARCHIVE_DIR, which must be shared by every web process, in
+# chunks of MESSAGE_ARCHIVE_CHUNK_SIZE messages read back separately. Up
+# to MESSAGE_ARCHIVE_CACHE_SIZE parsed chunks are cached per process for
+# MESSAGE_ARCHIVE_CACHE_TTL seconds
+MESSAGE_PARTITIONS_AHEAD = config(
+    "MESSAGE_PARTITIONS_AHEAD", default=3, cast=int
+)
+MESSAGE_ARCHIVE_AFTER = config("MESSAGE_ARCHIVE_AFTER", default=12, cast=int)
+MESSAGE_ARCHIVE_DIR = config(
+    "MESSAGE_ARCHIVE_DIR", default=str(BASE_DIR / "archive")
+)
+MESSAGE_ARCHIVE_CHUNK_SIZE = config(
+    "MESSAGE_ARCHIVE_CHUNK_SIZE", default=200, cast=int
+)
+MESSAGE_ARCHIVE_CACHE_SIZE = config(
+    "MESSAGE_ARCHIVE_CACHE_SIZE", default=256, cast=int
+)
+MESSAGE_ARCHIVE_CACHE_TTL = config(
+    "MESSAGE_ARCHIVE_CACHE_TTL", default=600, cast=int
+)
+
+# Query budgets declared by views and consumer handlers (see
+# woice/query_budget.py): "off", "log" to log a report of the queries run
+# when one is exceeded, or "raise", which the test runner always uses
+QUERY_BUDGET = config("QUERY_BUDGET", default="off")
+TEST_RUNNER = "woice.query_budget.QueryBudgetTestRunner"
+
 # Email
 EMAIL_HOST = config("EMAIL_HOST")
 EMAIL_HOST_USER = config("EMAIL_HOST_USER")
@@ -0,0 +1,48 @@
+"""
+Gunicorn worker serving the ASGI application with uvicorn, which drains
+its sockets before shutting down (see `chat.shutdown`).
+"""
+
+import sys
+
+from django.conf import settings
+from gunicorn.arbiter import Arbiter
+from uvicorn import Server
+from uvicorn.workers import UvicornWorker
+
+
+class DrainingServer(Server):
+    async def shutdown(self, sockets=None):
+        # Stop accepting connections, then let the open sockets close on
+        # their own terms, before uvicorn closes whatever is left, waits
+        # for the application and sends it the lifespan shutdown.
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+        for server in self.servers:
+            await server.wait_closed()
+
+        if not self.force_exit:
+            # Imported once the application, and so Django, is loaded.
+            from chat.shutdown import graceful_shutdown
+
+            await graceful_shutdown.drain(settings.SHUTDOWN_DRAIN_TIMEOUT)
+        await super().shutdown(sockets=sockets)
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        "loop": "auto",
+        "http": "auto",
+        "ws": "websockets",
+        "lifespan": "on",
+    }
+
+    async def _serve(self):
+        # As in `UvicornWorker`, with the server above.
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)